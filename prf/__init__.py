@@ -3,7 +3,7 @@ import logging
 from pkg_resources import get_distribution
 
 from slovar import slovar
-from prf.utils import maybe_dotted, DKeyError, DValueError
+from prf.utils import maybe_dotted, DKeyError, DValueError, set_json_backend
 
 APP_NAME = __package__.split('.')[0]
 _DIST = get_distribution(APP_NAME)
@@ -81,6 +81,15 @@ def add_api_view(config):
                     permission=NO_PERMISSION_REQUIRED)
 
 
+def add_batch_view(config, route='_batch'):
+    from prf.utility_views import BatchView
+
+    config.add_route('prf_batch', route)
+    config.add_view(view=BatchView, attr='create', route_name='prf_batch',
+                    request_method='POST',
+                    renderer='json')
+
+
 def set_default_acl(config, acl_model):
     acl_model = maybe_dotted(acl_model)
     config.set_root_factory(acl_model)
@@ -116,7 +125,10 @@ def includeme(config):
     config.add_directive('disable_exc_tweens', disable_exc_tweens)
     config.add_directive('prf_settings', prf_settings)
 
+    set_json_backend(settings.get('prf.json.backend', 'auto'))
     config.add_renderer('json', maybe_dotted('prf.renderers.JsonRenderer'))
+    config.add_renderer('ndjson', maybe_dotted('prf.renderers.NdjsonRenderer'))
+    config.add_renderer('arrow', maybe_dotted('prf.renderers.ArrowRenderer'))
 
     config.registry['prf.root_resources'] = {}
     config.registry['prf.resources_map'] = {}
@@ -147,10 +159,14 @@ def includeme(config):
 
     config.add_directive('add_account_views', add_account_views)
     config.add_directive('add_api_view', add_api_view)
+    config.add_directive('add_batch_view', add_batch_view)
 
     if settings.asbool('show_api', default=True):
         config.add_api_view()
 
+    if settings.asbool('prf.batch.enabled', default=False):
+        config.add_batch_view()
+
     config.set_root_factory(RootFactory)
 
 
@@ -0,0 +1,231 @@
+import logging
+from itertools import islice
+from datetime import datetime, date
+
+from slovar import slovar
+
+from prf.utils.errors import DValueError
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+log = logging.getLogger(__name__)
+
+ARROW_MIME = 'application/vnd.apache.arrow.stream'
+PARQUET_MIME = 'application/vnd.apache.parquet'
+
+ARROW_CHUNK_ROWS = 10000
+
+#ES mapping types and mongoengine fields -> arrow types
+ARROW_TYPES = {
+    'long': 'int64',
+    'integer': 'int32',
+    'short': 'int16',
+    'byte': 'int8',
+    'double': 'float64',
+    'float': 'float32',
+    'half_float': 'float32',
+    'scaled_float': 'float64',
+    'boolean': 'bool_',
+    'date': 'timestamp',
+    'keyword': 'string',
+    'text': 'string',
+    'ip': 'string',
+
+    'IntField': 'int64',
+    'LongField': 'int64',
+    'FloatField': 'float64',
+    'DecimalField': 'float64',
+    'BooleanField': 'bool_',
+    'DateTimeField': 'timestamp',
+    'DateField': 'timestamp',
+    'StringField': 'string',
+    'EmailField': 'string',
+    'URLField': 'string',
+    'UUIDField': 'string',
+    'ObjectIdField': 'string',
+    'ReferenceField': 'string',
+}
+
+
+def mongo_field_types(model, prefix=''):
+    types = {}
+
+    for name, field in getattr(model, '_fields', {}).items():
+        document_type = getattr(field, 'document_type', None)
+        if type(field).__name__ == 'EmbeddedDocumentField' and document_type:
+            types.update(mongo_field_types(document_type, '%s%s.' % (prefix, name)))
+        else:
+            types[prefix + name] = type(field).__name__
+
+    return types
+
+
+def backend_field_types(data, model=None):
+    '''
+    {dotted.field: ES type or mongoengine field name} of the backend behind `data`:
+    the mapping of the index for ES results, the document fields for mongo querysets.
+    '''
+    index = None
+    if isinstance(data, list) and data:
+        index = getattr(data[0], '_index', None)
+
+    if index:
+        from prf.es import ES
+        return {kk: vv.type for kk, vv in ES.get_field_types(index).items()}
+
+    return mongo_field_types(getattr(data, '_document', None) or model)
+
+
+def arrow_type(name):
+    if name == 'timestamp':
+        return pa.timestamp('ms')
+    return getattr(pa, name)()
+
+
+def converter(typ, name):
+    #python value -> value accepted by an arrow array of `typ`. Raises if it can not be converted.
+    from dateutil.parser import isoparse
+
+    def to_str(val):
+        return val if isinstance(val, str) else str(val)
+
+    def to_int(val):
+        #int() would truncate 1.5 to 1
+        if isinstance(val, float) and not val.is_integer():
+            raise ValueError(val)
+        return int(val)
+
+    def to_dt(val):
+        if isinstance(val, datetime):
+            return val
+        if isinstance(val, date):
+            return datetime(val.year, val.month, val.day)
+        return isoparse(val)
+
+    if pa.types.is_string(typ):
+        cast = to_str
+    elif pa.types.is_integer(typ):
+        cast = to_int
+    elif pa.types.is_floating(typ):
+        cast = float
+    elif pa.types.is_boolean(typ):
+        cast = bool
+    elif pa.types.is_timestamp(typ):
+        cast = to_dt
+    else:
+        return lambda val: val
+
+    def convert(val):
+        if val is None:
+            return None
+        try:
+            return cast(val)
+        except (TypeError, ValueError, OverflowError):
+            raise DValueError('`%s`: can not convert `%r` to %s' % (name, val, typ))
+
+    return convert
+
+
+def infer_type(values):
+    try:
+        typ = pa.array(values).type
+    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+        return pa.string()
+
+    return pa.string() if pa.types.is_null(typ) else typ
+
+
+class Sink(object):
+    '''write-only file object that gives back what was written since the last `drain`'''
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_arrow(data, columns=None, types=None, format_='arrow', chunk_rows=ARROW_CHUNK_ROWS):
+    '''
+    Yields `data` as an Arrow IPC stream or a Parquet file, one record batch (row group)
+    per `chunk_rows` items. Items are flattened, `columns` default to the keys of the
+    first chunk. Column types come from `types` (see `ARROW_TYPES`), the rest are inferred
+    from the first chunk.
+    The schema can not change once written, so new keys in the later chunks (without
+    `columns`) and values that do not fit the column type raise DValueError.
+    '''
+    types = types or {}
+    rows = (slovar(each).flat(keep_lists=1) for each in data)
+
+    chunk = list(islice(rows, chunk_rows))
+
+    def chunk_keys(chunk):
+        keys = set()
+        for each in chunk:
+            keys.update(each.keys())
+        return keys
+
+    inferred = not columns
+    if inferred:
+        columns = sorted(chunk_keys(chunk))
+
+    fields = []
+    for col in columns:
+        name = ARROW_TYPES.get(types.get(col))
+        if name:
+            fields.append(pa.field(col, arrow_type(name)))
+        else:
+            fields.append(pa.field(col, infer_type([each.get(col) for each in chunk])))
+
+    schema = pa.schema(fields)
+    converters = [converter(each.type, each.name) for each in fields]
+
+    sink = Sink()
+    if format_ == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+
+    try:
+        while chunk:
+            arrays = []
+            for col, field, convert in zip(columns, fields, converters):
+                arrays.append(pa.array([convert(each.get(col)) for each in chunk],
+                                       type=field.type))
+
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+
+            chunk = list(islice(rows, chunk_rows))
+
+            if inferred:
+                new_keys = chunk_keys(chunk) - set(columns)
+                if new_keys:
+                    raise DValueError('Columns %s are not in the first %s rows. Pass the columns '
+                                      'in `_fields`' % (sorted(new_keys), chunk_rows))
+    finally:
+        writer.close()
+
+    yield sink.drain()
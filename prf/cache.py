@@ -0,0 +1,273 @@
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from prf.utils import Params, typecast, parse_specials, json_dumps
+
+log = logging.getLogger(__name__)
+
+CacheEntry = namedtuple('CacheEntry', 'path status headers body created')
+
+#headers not replayed from the cache
+SKIP_HEADERS = ['Set-Cookie', 'Content-Length', 'Date', 'X-Cache']
+MAX_BODY_SIZE = 1024 * 1024
+
+
+def same_branch(path, other):
+    #`/users` and `/users/1/posts` are on the same branch, `/users` and `/users_x` are not
+    path = path.rstrip('/')
+    other = other.rstrip('/')
+    return path == other or other.startswith(path + '/') or path.startswith(other + '/')
+
+
+def cache_key(request):
+    '''
+    route path + params normalized with `parse_specials` + ACL principals + Accept header.
+    `?_sort=x&a=1&b=2` and `?b=2&a=1&_s=x` produce the same key.
+    The renderer is either `_renderer` (part of the specials) or negotiated from Accept.
+    '''
+    params, specials = parse_specials(Params(typecast(Params(request.params.mixed()))))
+
+    try:
+        principals = sorted(str(each) for each in request.effective_principals)
+    except AttributeError:
+        principals = []
+
+    return hashlib.sha1(json_dumps([
+        request.path,
+        sorted(params.flat().items()),
+        sorted(specials.flat().items()),
+        principals,
+        request.headers.get('Accept', ''),
+    ]).encode('utf-8')).hexdigest()
+
+
+class MemoryStore(object):
+    '''
+    per process LRU store. `purge` only clears the entries of the current process,
+    use `SqliteStore` to share the purges between the workers on the same host.
+    '''
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry:
+                self.items.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.items[key] = entry
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def purge(self, path):
+        with self.lock:
+            for key, entry in list(self.items.items()):
+                if same_branch(path, entry.path):
+                    del self.items[key]
+
+
+class SqliteStore(object):
+    '''LRU store in a sqlite file, shared by the workers on the same host'''
+
+    def __init__(self, path, max_items):
+        self.path = path
+        self.max_items = max_items
+        self.local = threading.local()
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, path TEXT, status INTEGER, headers TEXT,
+                body BLOB, created REAL, accessed REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    @property
+    def db(self):
+        if not hasattr(self.local, 'db'):
+            self.local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.db.execute('PRAGMA journal_mode=WAL')
+            self.local.db.create_function('same_branch', 2, same_branch)
+        return self.local.db
+
+    def get(self, key):
+        row = self.db.execute('SELECT path, status, headers, body, created FROM responses '
+                              'WHERE key=?', (key,)).fetchone()
+        if not row:
+            return
+
+        self.db.execute('UPDATE responses SET accessed=? WHERE key=?', (time.time(), key))
+        return CacheEntry(row[0], row[1], json.loads(row[2]), row[3], row[4])
+
+    def set(self, key, entry):
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (key, entry.path, entry.status, json.dumps(entry.headers),
+                         entry.body, entry.created, time.time()))
+        self.db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                        'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_items,))
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM responses WHERE key=?', (key,))
+
+    def purge(self, path):
+        self.db.execute('DELETE FROM responses WHERE same_branch(?, path)', (path,))
+
+
+class ResponseCache(object):
+    '''
+    Caches rendered GET responses for `ttl` seconds. Expired entries are served for `stale`
+    more seconds while one background sub-request refreshes them.
+    Bodies over `max_body_size` bytes and `Cache-Control: private` or `no-store` responses
+    are not cached.
+    Writes (POST, PUT, PATCH, DELETE) purge the entries on the same path branch.
+    '''
+
+    def __init__(self, ttl=60, stale=0, max_items=1000, path=None,
+                 max_body_size=MAX_BODY_SIZE):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_body_size = max_body_size
+        self.store = SqliteStore(path, max_items) if path else MemoryStore(max_items)
+        self.revalidating = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(ttl=settings.asfloat('response_cache.ttl', default=60),
+                   stale=settings.asfloat('response_cache.stale', default=0),
+                   max_items=settings.asint('response_cache.max_items', default=1000),
+                   path=settings.get('response_cache.path'),
+                   max_body_size=settings.asint('response_cache.max_body_size',
+                                                default=MAX_BODY_SIZE))
+
+    def get(self, key):
+        #returns entry, is_stale
+        entry = self.store.get(key)
+        if not entry:
+            return None, False
+
+        age = time.time() - entry.created
+        if age < self.ttl:
+            return entry, False
+
+        if age < self.ttl + self.stale:
+            return entry, True
+
+        self.store.delete(key)
+        return None, False
+
+    def cacheable(self, response):
+        #streamed responses have no content_length and are not cached
+        if response.status_code != 200 or 'Set-Cookie' in response.headers:
+            return False
+
+        if not response.content_length or response.content_length > self.max_body_size:
+            return False
+
+        return not (response.cache_control.private or response.cache_control.no_store)
+
+    def set(self, key, request, response):
+        headers = [[kk, vv] for kk, vv in response.headerlist if kk not in SKIP_HEADERS]
+        self.store.set(key, CacheEntry(request.path, response.status_code, headers,
+                                       response.body, time.time()))
+
+    def purge(self, path):
+        log.debug('response cache purge: %s', path)
+        self.store.purge(path)
+
+    def revalidate(self, key, request):
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        from pyramid.request import Request
+
+        subrequest = Request.blank(request.path_qs, headers=dict(request.headers),
+                                   base_url=request.application_url)
+        subrequest.environ['prf.response_cache.revalidate'] = True
+        if 'REMOTE_USER' in request.environ:
+            subrequest.environ['REMOTE_USER'] = request.environ['REMOTE_USER']
+
+        #`request` is done by the time the thread runs, only use what was copied from it.
+        #invoke_subrequest is bound to the router, not to the request.
+        invoke = request.invoke_subrequest
+        path_qs = request.path_qs
+
+        def run():
+            try:
+                invoke(subrequest, use_tweens=True)
+            except Exception as e:
+                log.error('response cache revalidate `%s` failed: %s', path_qs, e)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+class SingleFlight(object):
+    '''
+    Concurrent `do` calls with the same key wait for the first one and share its result
+    (or its exception). Waiters that time out run `func` themselves.
+    With `copy` (e.g. `copy.deepcopy`), each waiter gets its own copy of the result,
+    taken from a snapshot made only if there were waiters.
+    '''
+
+    class Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func, timeout=None, copy=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            if call.event.wait(timeout):
+                if call.error:
+                    raise call.error
+                return copy(call.result) if copy else call.result
+
+            log.warning('single flight wait for `%s` timed out after %ss', key, timeout)
+            return func()
+
+        result = None
+        try:
+            result = func()
+            return result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+            #the leader keeps using `result`, so the waiters copy from a snapshot
+            if call.waiters and not call.error:
+                call.result = copy(result) if copy else result
+            call.event.set()
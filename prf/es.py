@@ -1,3 +1,4 @@
+import json
 import logging
 from six.moves.urllib.parse import urlparse
 from pprint import pformat
@@ -5,7 +6,7 @@ from pprint import pformat
 from bson import ObjectId
 from bson.dbref import DBRef
 
-from elasticsearch.exceptions import ElasticsearchException, NotFoundError
+from elasticsearch.exceptions import ElasticsearchException, NotFoundError, SerializationError
 from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Search, Q, A
 from elasticsearch_dsl.connections import connections
@@ -21,13 +22,41 @@ from prf.utils import (parse_specials, process_fields, split_strip,
 from prf.utils.errors import DValueError, DKeyError
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
 log = logging.getLogger(__name__)
 
 PRECISION_THRESHOLD = 40000
 DEFAULT_AGGS_LIMIT = 20
 DEFAULT_AGGS_NESTED_LIMIT = 1000
+DEFAULT_COMPOSITE_SIZE = 1000
 TOP_HITS_MAX_SIZE = 100000
+#ES >= 7 takes these as `calendar_interval`, anything else is a `fixed_interval`
+CALENDAR_INTERVALS = ['minute', '1m', 'hour', '1h', 'day', '1d', 'week', '1w',
+                      'month', '1M', 'quarter', '1q', 'year', '1y']
 MAX_RESULT_WINDOW = 10000
+DEFAULT_SCROLL = '5m'
+REFRESH_POLICIES = ['true', 'false', 'wait_for']
+STRING_TYPES = ['text', 'keyword', 'constant_keyword', 'wildcard', 'search_as_you_type']
+GEO_TYPES = ['geo_point', 'geo_shape']
+
+#deep merges `params.doc` into the `_source`, same as partial `update` with `doc`
+UPDATE_BY_QUERY_SCRIPT = '''
+void merge(Map dst, Map src) {
+    for (entry in src.entrySet()) {
+        if (entry.getValue() instanceof Map && dst.get(entry.getKey()) instanceof Map) {
+            merge(dst.get(entry.getKey()), entry.getValue());
+        } else {
+            dst.put(entry.getKey(), entry.getValue());
+        }
+    }
+}
+merge(ctx._source, params.doc);
+'''
 
 
 def includeme(config):
@@ -64,6 +93,15 @@ class Serializer(JSONSerializer):
 
         return super(Serializer, self).default(obj)
 
+    def loads(self, s):
+        if orjson is None:
+            return super(Serializer, self).loads(s)
+
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
 def prep_sort(specials, nested=None):
     sort = specials._sort
     nested = nested or {}
@@ -98,38 +136,59 @@ def prep_sort(specials, nested=None):
 
 
 class ESDoc:
+    __slots__ = ('_data', '_index', '_doc_types', '_meta_')
 
     def __init__(self, data, index, doc_types):
         self._data = data
         self._index = index
         self._doc_types = doc_types
+        self._meta_ = None
 
     def __repr__(self):
         parts = ['_index: %s' % self._index, '_id: %s' % self._data.get('_id', 'NA')]
         return '<%s>' % ', '.join(parts)
 
+    @property
+    def _meta(self):
+        #built on first access only, most of the docs never need it.
+        if self._meta_ is None:
+            self._meta_ = slovar(
+                _index = self._data.get('_index', self._index),
+                _type = self._data.get('_type'),
+                _id = self._data.get('_id'),
+                _score = self._data.get('_score'),
+            )
+        return self._meta_
+
     def get(self, key):
         return self._data.get(key)
 
     def __getattr__(self, key):
-        if key in self._data:
-            return self._data[key]
+        if key in ESDoc.__slots__:
+            raise AttributeError(key)
 
-        raise AttributeError(key)
+        try:
+            return self._data[key]
+        except KeyError:
+            raise AttributeError(key)
 
     def __setattr__(self, key, val):
-        if key in ['_data', '_index', '_doc_types']:
-            super().__setattr__(key, val)
+        if key in ESDoc.__slots__:
+            object.__setattr__(self, key, val)
         else:
             self._data[key] = val
 
     def to_dict(self, fields=None):
+        #hits are plain dicts, see `ES.process_hits`. converted once, on first access.
+        if not isinstance(self._data, slovar):
+            object.__setattr__(self, '_data', slovar(self._data))
+
         if fields:
-            return slovar(self._data).extract(fields)
+            return self._data.extract(fields)
         return self._data
 
 class Results(list):
-    def __init__(self, index, specials, data, total, took, doc_types):
+    def __init__(self, index, specials, data, total, took, doc_types, alias=None):
         list.__init__(self, [ESDoc(each, index=index, doc_types=doc_types) for each in data])
         self.total = total
         self.specials = specials
@@ -137,7 +196,7 @@ class Results(list):
             total = total,
             took = took,
             doc_types = doc_types,
-            alias = ES.api.indices.get_alias(index)
+            alias = ES.api.indices.get_alias(index) if alias is None else alias
         )
 
 
@@ -147,12 +206,15 @@ class Aggregator(object):
         '_agg_avg', '_agg_sum', '_agg_max', '_agg_min',
         '_agg_stats', '_agg_percentiles', '_agg_cardinality' ]
 
-    def __init__(self, specials, search_obj, index):
+    def __init__(self, specials, search_obj, index, doc_types=None, alias=None):
         self.specials = specials
         self.specials.aslist('_group', default=[])
         self.specials.aslist('_bucket_items', default=[])
         self.specials.asbool('_raw_', default=False)
+        self.specials.asstr('_group_format', default='tree')
 
+        #`process_field` sets `_raw_` for `__as__` ops, keep what was requested.
+        self.raw = self.specials._raw_
         self.metrics = []
 
         if self.specials._start or self.specials._page:
@@ -167,7 +229,8 @@ class Aggregator(object):
 
         self.search_obj = search_obj
         self.index=index
-        self.doc_types = ES.get_doc_types(index)
+        self.doc_types = ES.get_doc_types(index) if doc_types is None else doc_types
+        self.alias = alias
 
         if self.specials._group or self.metrics:
             cardinality = A('cardinality',
@@ -176,6 +239,10 @@ class Aggregator(object):
 
             self.search_obj.aggs.bucket('total', cardinality)
 
+    @property
+    def version(self):
+        return ES.version
+
     @classmethod
     def is_metrics(cls, specials):
         for name in specials:
@@ -196,56 +263,143 @@ class Aggregator(object):
 
     def do_count(self):
         try:
-            resp = self.search_obj.execute()
-            return resp.aggregations.total.value
+            return self.search()['aggregations']['total']['value']
         except Exception as e:
             raise prf.exc.HTTPBadRequest(e)
 
+    def get_level_items(self):
+        '''
+        Groups `_bucket_items` by the `_group` level they apply to.
+        e.g. buckets.buckets.state__as__st applies to the 2nd level
+        '''
+
+        levels = {}
+        for fld in self.specials._bucket_items:
+            parts = fld.split('buckets.')
+            levels.setdefault(len(parts)-1, []).append(parts[-1])
+
+        return levels
+
+    def get_metric_keys(self):
+        #pairs of (aggregation name, output name)
+        return [('%s_%s' % (self.undot(vv), kk), '%s_%s' % (vv, kk))
+                    for kk, vals in self.metrics for vv in vals]
+
+    @staticmethod
+    def clean_metric(val):
+        if 'value' in val:
+            return val['value']
+        elif 'values' in val:
+            return val['values']
+        else:
+            return val
+
+    def transform_columnar(self, aggs):
+        '''
+        Flattens the bucket tree into rows, one per leaf bucket, with group keys,
+        leaf count and metrics as the columns. Much cheaper than the tree for deep groupings.
+        `_group_format=rows` returns list of flat dicts.
+        `_group_format=columns` returns one dict of column arrays.
+        `_bucket_items` renames (`field__as__name`) are applied to the column names.
+        `_group` ops (e.g. `date__as__date_histogram`) are read from their buckets
+        and named after the field.
+        '''
+
+        if self.raw:
+            return aggs
+
+        group = []
+        fields = []
+        for each in self.specials._group:
+            field, _, _op = each.partition('__as__')
+            group.append('%s__%s' % (field, _op) if _op else field)
+            fields.append(field)
+
+        metric_keys = self.get_metric_keys()
+
+        renames = {}
+        for items in self.get_level_items().values():
+            for item in items:
+                name, _, new_name = item.partition('__as__')
+                if new_name:
+                    renames[name] = new_name
+
+        columns = [renames.get(each, each) for each in fields]
+        columns.append(renames.get('count', 'count'))
+        columns.extend(renames.get(out, out) for _, out in metric_keys)
+
+        depth = len(group) - 1
+        rows = []
+
+        def walk(buckets, level, keys):
+            for bucket in buckets:
+                _keys = keys + (bucket.get('key_as_string', bucket['key']),)
+
+                if level < depth:
+                    walk(bucket[group[level+1]]['buckets'], level+1, _keys)
+                    continue
+
+                rows.append(_keys + (bucket['doc_count'],) +
+                    tuple(self.clean_metric(bucket[key]) if key in bucket else None
+                            for key, _ in metric_keys))
+
+        walk(aggs[group[0]]['buckets'], 0, ())
+
+        if self.specials._count:
+            return len(rows)
+
+        if self.specials._group_format == 'columns':
+            if rows:
+                data = [dict(zip(columns, [list(col) for col in zip(*rows)]))]
+            else:
+                data = [{col: [] for col in columns}]
+        else:
+            data = [dict(zip(columns, row)) for row in rows]
+
+        return Results(self.index, self.specials, data, len(rows), 0, doc_types=self.doc_types,
+                        alias=self.alias)
+
     def transform(self, aggs):
+        #columnar formats handle `__as__` group ops, so only skip them if raw was requested
+        if self.specials._group and self.specials._group_format in ['rows', 'columns']:
+            return self.transform_columnar(aggs)
+
         if self.specials._raw_:
             return aggs
 
+        metric_keys = self.get_metric_keys()
+        level_items = self.get_level_items()
+
         def _trans_metr(data):
             _d = slovar()
 
-            def _clean(val):
-                if 'value' in val:
-                    return val['value']
-                elif 'values' in val:
-                    return val['values']
-                else:
-                    return val
-
-            for kk, vals in self.metrics:
-                for vv in vals:
-                    metr_key = '%s_%s'%(vv, kk)
-                    if metr_key in data:
-                        _d[metr_key] = _clean(data[metr_key])
+            for key, out in metric_keys:
+                if key in data:
+                    _d[out] = self.clean_metric(data[key])
 
             return _d
 
-        def _trans(_aggs, bucket_name, agg_names):
+        def _trans(_aggs, bucket_name, agg_names, level=0):
             '''recursive transformation
             Use _bucket_items to modify an item in the bucket.
             e.g. _group=address.country.name,address.admin1.name&_bucket_items=buckets.address.admin1.name__as__state
             '''
 
             buckets = []
+            items = level_items.get(level, [])
 
             for bucket in _aggs[bucket_name]['buckets']:
                 _d = slovar({bucket_name: bucket['key'], 'count': bucket['doc_count']})
-                _d.update(_trans_metr(slovar(bucket)))
+                _d.update(_trans_metr(bucket))
 
-                for fld in self.specials._bucket_items:
-                    parts = fld.split('buckets.')
-                    if len(parts) == self.specials._group.index(bucket_name)+1:
-                        _d = _d.extract('*,%s' % parts[-1])
+                for item in items:
+                    _d = _d.extract('*,%s' % item)
 
                 if not self.specials._flat:
                     _d = _d.unflat()
 
                 if agg_names:
-                    _d['buckets'] = _trans(bucket, agg_names[0], agg_names[1:])
+                    _d['buckets'] = _trans(bucket, agg_names[0], agg_names[1:], level+1)
                 buckets.append(_d)
 
             return buckets
@@ -266,12 +420,18 @@ class Aggregator(object):
         if self.specials._count:
             return total
 
-        return Results(self.index, self.specials, data, total, 0, doc_types=self.doc_types)
+        return Results(self.index, self.specials, data, total, 0, doc_types=self.doc_types,
+                        alias=self.alias)
+
+    def search(self):
+        return ES.search_raw(self.search_obj)
+
+    def execute(self, transform=None):
+        transform = transform or self.transform
 
-    def execute(self):
         try:
-            resp = self.search_obj.execute()
-            return self.transform(resp.aggregations._d_)
+            resp = self.search()
+            return transform(resp.get('aggregations', {}))
 
         except Exception as e:
             raise prf.exc.HTTPBadRequest(e)
@@ -305,7 +465,106 @@ class Aggregator(object):
 
         return self.execute()
 
+    def get_after_key(self):
+        after = self.specials.get('_after')
+        if not after:
+            return None
+
+        if isinstance(after, dict):
+            return after
+
+        try:
+            after = json.loads(after)
+        except ValueError as e:
+            raise prf.exc.HTTPBadRequest('`_after` must be a json object: %s' % e)
+
+        if not isinstance(after, dict):
+            raise prf.exc.HTTPBadRequest('`_after` must be a json object. Got `%s`' % after)
+
+        return after
+
+    def transform_composite(self, aggs):
+        if self.specials._raw_:
+            return aggs
+
+        #composite buckets are flat: one bucket per unique combination of `_group` keys.
+        renames = [fld.split('buckets.')[-1] for fld in self.specials._bucket_items]
+        comp = aggs['composite']
+        metric_keys = self.get_metric_keys()
+
+        data = []
+        for bucket in comp['buckets']:
+            _d = slovar(bucket['key'])
+            _d['count'] = bucket['doc_count']
+
+            for key, out in metric_keys:
+                if key in bucket:
+                    _d[out] = self.clean_metric(bucket[key])
+
+            for fld in renames:
+                _d = _d.extract('*,%s' % fld)
+
+            if not self.specials._flat:
+                _d = _d.unflat()
+
+            data.append(_d)
+
+        if self.specials._count:
+            return len(data)
+
+        results = Results(self.index, self.specials, data, len(data), 0, doc_types=self.doc_types,
+                          alias=self.alias)
+        results._meta.after_key = comp.get('after_key')
+        return results
+
+    def do_group_composite(self):
+        '''
+        Pages through all the groups using `composite` aggregation.
+        The next page is requested by passing `_meta.after_key` of the previous results as `_after`.
+        e.g. _group=country,state&_composite=1&_limit=100&_after={"country":"US","state":"NY"}
+        '''
+
+        self.search_obj = self.search_obj[0:0]
+
+        size = self.get_size() or DEFAULT_COMPOSITE_SIZE
+        raw = self.specials._raw_
+
+        sources = []
+        for each in self.specials._group:
+            field = self.process_field(each)
+
+            if field.op_type == 'terms':
+                #`missing_bucket` is supported since 6.4
+                params = {'missing_bucket': True} \
+                    if (self.version.major, self.version.minor) >= (6, 4) else {}
+            elif field.op_type == 'date_histogram':
+                params = dict(field.params)
+            else:
+                raise prf.exc.HTTPBadRequest('`%s` is not supported in composite _group' % each)
+
+            sources.append({field.bucket_name: A(field.op_type, field=field.field, **params)})
+
+        #process_field marks `__as__` fields as raw, but composite keys are transformed the same way.
+        self.specials._raw_ = raw
+
+        comp_params = dict(sources=sources, size=size)
+
+        after = self.get_after_key()
+        if after:
+            comp_params['after'] = after
+
+        aggs = self.search_obj.aggs.bucket('composite', A('composite', **comp_params))
+
+        for (op, val) in self.metrics:
+            for each in val:
+                aggs.metric('%s_%s' % (self.undot(each), op), op, field=each)
+
+        return self.execute(transform=self.transform_composite)
+
     def do_group(self):
+        if self.specials.asbool('_composite', default=False):
+            return self.do_group_composite()
+
         if '_show_hits' not in self.specials:
             self.search_obj = self.search_obj[0:0]
 
@@ -351,25 +610,20 @@ class Aggregator(object):
         terms = A('terms', **term_params)
         self.search_obj.aggs.bucket('grouped', terms)
 
-        try:
-            resp = self.search_obj.execute()
-            data = []
-            for bucket in resp.aggregations.grouped.buckets:
-                if self.specials._fields:
-                    data.append({self.specials._fields[0]: bucket.key})
-                else:
-                    data.append(bucket.key)
+        return self.execute(transform=self.transform_distinct)
 
-            return data
+    def transform_distinct(self, aggs):
+        data = []
+        for bucket in aggs['grouped']['buckets']:
+            if self.specials._fields:
+                data.append({self.specials._fields[0]: bucket['key']})
+            else:
+                data.append(bucket['key'])
 
-        except Exception as e:
-            raise prf.exc.HTTPBadRequest(e)
+        return data
 
     def check_total(self, msg):
-        ss = Search.from_dict(self.search_obj.to_dict())
-        ss._index = self.index
-        resp = ss.execute()
-        total = resp.aggregations.total.value
+        total = self.search()['aggregations']['total']['value']
         if total > TOP_HITS_MAX_SIZE:
             raise prf.exc.HTTPBadRequest('`%s` results: %s' % (total, msg))
 
@@ -403,7 +657,7 @@ class Aggregator(object):
 
             elif _op == 'date_histogram':
                 _field.op_type = _op
-                _field.params.interval = self.specials._interval
+                _field.params.update(self.get_interval_params(self.specials._interval))
                 _field.params.pop('size', None)
                 _field.params.format = self.specials.asstr('_format', default='yyyy-MM-dd')
 
@@ -413,6 +667,16 @@ class Aggregator(object):
 
         return _field
 
+    def get_interval_params(self, interval):
+        #`interval` is deprecated in ES 7 and removed in ES 8
+        if self.version.major < 7:
+            return {'interval': interval}
+
+        if interval in CALENDAR_INTERVALS:
+            return {'calendar_interval': interval}
+
+        return {'fixed_interval': interval}
+
     def build_agg_item(self, field_name, **params):
         field = self.process_field(field_name)
         field.params.update(params)
@@ -423,46 +687,66 @@ class Aggregator(object):
 
 class ES(object):
     version = slovar(major=2, minor=4, patch=0)
+    aggregator_class = Aggregator
+    flush_listeners = []
+    _field_types = {}
 
     def __call__(self):
         return self
 
     @classmethod
     def process_hits(cls, hits):
+        '''
+        Adds the hit meta to `_source` in place and returns the plain dicts, `ESDoc.to_dict`
+        turns them into slovars. `_type` is None for ES >= 7, which has no doc types.
+        '''
         data = []
         for each in hits:
-            _d = slovar(each['_source'])
-            _d = _d.update({
-                '_score':each['_score'],
-                '_type':each['_type'],
-                '_index': each['_index'],
-                '_id': each['_id'],
-            })
+            _d = each.get('_source')
+            if _d is None:
+                _d = {}
+
+            _d['_score'] = each.get('_score')
+            _d['_type'] = each.get('_type')
+            _d['_index'] = each['_index']
+            _d['_id'] = each['_id']
             data.append(_d)
 
         return data
 
+    @classmethod
+    def search_raw(cls, search_obj):
+        #same as `search_obj.execute()` minus wrapping every hit into the dsl Response objects
+        return cls.api.search(index=search_obj._index, body=search_obj.to_dict(),
+                              **search_obj._params)
+
+    @classmethod
+    def connection_params(cls):
+        hosts = []
+        for each in cls.settings.aslist('urls'):
+            url = urlparse(each)
+            hosts.append(dict(host=url.hostname, port=url.port))
+
+        params = dict(
+            hosts = hosts,
+            timeout = cls.settings.asint('timeout', 30),
+            serializer = Serializer(),
+        )
+
+        if cls.settings.asbool('sniff', default=False):
+            params.update(
+                sniff_on_start = True,
+                sniff_on_connection_fail = True
+            )
+
+        return params
+
     @classmethod
     def setup(cls, settings):
         cls.settings = settings.unflat().es
 
         try:
-            hosts = []
-            for each in cls.settings.aslist('urls'):
-                url = urlparse(each)
-                hosts.append(dict(host=url.hostname, port=url.port))
-
-            params = {}
-            if cls.settings.asbool('sniff', default=False):
-                params = dict(
-                    sniff_on_start = True,
-                    sniff_on_connection_fail = True
-                )
-
-            cls.api = connections.create_connection(hosts=hosts,
-                                        timeout=cls.settings.asint('timeout', 30),
-                                        serializer=Serializer(),
-                                        **params)
+            cls.api = connections.create_connection(**cls.connection_params())
 
             cls.version = cls._version()
 
@@ -473,7 +757,10 @@ class ES(object):
 
     @classmethod
     def get_doc_types(cls, index):
-        meta = cls.get_meta(index)
+        return cls.process_doc_types(cls.get_meta(index))
+
+    @staticmethod
+    def process_doc_types(meta):
         if meta:
             for vv in meta.values():
                 if not isinstance(vv, dict):
@@ -491,6 +778,73 @@ class ES(object):
                 doc_type,
                 ignore_unavailable=True)
 
+    @classmethod
+    def process_mapping(cls, meta):
+        '''
+        Flattens the mappings of all the indices in `meta` into
+        {dotted.field: {type, nested, keyword}}, where `nested` is the path of
+        the closest nested parent and `keyword` is the keyword subfield if any.
+        '''
+
+        fields = slovar()
+
+        def walk(props, prefix, nested):
+            for name, fdef in props.items():
+                path = prefix + name
+                ftype = fdef.get('type', 'object')
+                keyword = None
+
+                for sub, sdef in fdef.get('fields', {}).items():
+                    sub_path = '%s.%s' % (path, sub)
+                    fields[sub_path] = slovar(type=sdef.get('type'), nested=nested, keyword=None)
+                    if not keyword and sdef.get('type') == 'keyword':
+                        keyword = sub_path
+
+                child_nested = path if ftype == 'nested' else nested
+                fields[path] = slovar(type=ftype, nested=child_nested, keyword=keyword)
+
+                if 'properties' in fdef:
+                    walk(fdef['properties'], path + '.', child_nested)
+
+        for index_meta in (meta or {}).values():
+            if not isinstance(index_meta, dict):
+                continue
+
+            mappings = index_meta.get('mappings', {})
+            if 'properties' in mappings:
+                mappings = {'_doc': mappings}
+
+            for doc_mapping in mappings.values():
+                if isinstance(doc_mapping, dict):
+                    walk(doc_mapping.get('properties', {}), '', None)
+
+        return fields
+
+    @classmethod
+    def get_field_types(cls, index):
+        #mappings are fetched once per process. use `reset_field_types` if the mapping changed.
+        #empty mappings (e.g. index does not exist yet) are not cached.
+        if index not in cls._field_types:
+            try:
+                fields = cls.process_mapping(cls.get_meta(index))
+            except ElasticsearchException as e:
+                log.error('Failed to get mapping for `%s`: %s', index, e)
+                return slovar()
+
+            if not fields:
+                return fields
+
+            cls._field_types[index] = fields
+
+        return cls._field_types[index]
+
+    @classmethod
+    def reset_field_types(cls, index=None):
+        if index:
+            cls._field_types.pop(index, None)
+        else:
+            cls._field_types.clear()
+
     @classmethod
     def get_alias_index_maps(cls, name):
         #name can be either alias or index
@@ -523,29 +877,81 @@ class ES(object):
         return slovar(major=int(vers[0]), minor=int(vers[1]), patch=int(vers[2]))
 
     @classmethod
-    def flush(cls, data, args={}):
+    def get_refresh(cls, refresh=None, default='true'):
+        '''
+        Returns refresh policy for the writes: `true`, `false` or `wait_for`.
+        Defaults to `es.refresh` setting, if not set then to `default`.
+        '''
+
+        if refresh is None:
+            refresh = cls.settings.get('refresh', default)
+
+        if isinstance(refresh, bool):
+            refresh = 'true' if refresh else 'false'
+
+        refresh = str(refresh).lower()
+        if refresh not in REFRESH_POLICIES:
+            raise DValueError('Bad refresh policy `%s`. Must be one of %s' % (refresh, REFRESH_POLICIES))
+
+        return refresh
+
+    @classmethod
+    def flush(cls, data, args=None):
+        args = dict(args or {})
         args.setdefault('raise_on_error', False)
         args.setdefault('raise_on_exception', False)
-        args.setdefault('refresh', True)
+        args['refresh'] = cls.get_refresh(args.get('refresh'))
 
         success, all_errors = helpers.bulk(cls.api, data, **args)
+        success, errors, retry_data = cls.process_bulk_errors(data, success, all_errors)
+
+        cls.notify_flush(data, errors, retry_data)
+        return success, errors, retry_data
+
+    @classmethod
+    def add_flush_listener(cls, listener):
+        '''
+        `listener(docs)` is called after each `flush` with the docs that were flushed successfully.
+        '''
+        if listener not in cls.flush_listeners:
+            cls.flush_listeners.append(listener)
+
+    @classmethod
+    def notify_flush(cls, data, errors, retry_data):
+        if not cls.flush_listeners:
+            return
+
+        failed = set([list(err.values())[0].get('_id') for err in errors if err])
+        failed.update(each.get('_id') for each in retry_data)
+
+        flushed = [each for each in data if each.get('_id') not in failed]
+
+        for listener in cls.flush_listeners:
+            try:
+                listener(flushed)
+            except Exception as e:
+                log.error('flush listener `%s` failed: %s', listener, e)
+
+    @classmethod
+    def process_bulk_errors(cls, data, success, all_errors):
         errors = []
-        retries = []
+        retries = set()
         retry_data = []
 
         if all_errors:
             #separate retriable errors
             for err in all_errors:
-                err = slovar(err)
-                if err.fget('index.status') == 429: #too many requests
-                    retries.append(err['index']['_id'])
+                #error is keyed by the op type: index, update, delete etc.
+                info = list(err.values())[0] if err else {}
+                if info.get('status') == 429: #too many requests
+                    retries.add(info['_id'])
                 else:
-                    errors.append(err)
+                    errors.append(slovar(err))
 
-                if retries:
-                    for each in data:
-                        if each['_id'] in retries:
-                            retry_data.append(each)
+            if retries:
+                for each in data:
+                    if each['_id'] in retries:
+                        retry_data.append(each)
 
         log.debug('BULK FLUSH: total=%s, success=%s, errors=%s, retries=%s',
                                 len(data), success, len(errors), len(retry_data))
@@ -560,12 +966,42 @@ class ES(object):
 
     def drop_collection(self):
         ES.api.indices.delete(self.index, ignore=[400, 404])
+        ES.reset_field_types(self.index)
 
     def unregister(self):
         pass
 
     def build_search_object(self, params, specials, **extra):
 
+        if self.settings.asbool('mapping_aware', default=True):
+            fields = self.get_field_types(self.index)
+        else:
+            fields = {}
+
+        def is_prefix(val):
+            return isinstance(val, str) and val.endswith('*')
+
+        def term_key(key):
+            #term level queries on analyzed `text` field should go to its keyword subfield
+            info = fields.get(key)
+            if info and info.type == 'text' and info.keyword:
+                return info.keyword
+            return key
+
+        def check_op(key, op, val):
+            info = fields.get(key)
+            if not info:
+                return
+
+            vals = val if isinstance(val, list) else [val]
+
+            if op == 'geobb' and info.type not in GEO_TYPES:
+                raise prf.exc.HTTPBadRequest('`%s` is `%s` field, `geobb` requires geo field' % (key, info.type))
+
+            if (op == 'startswith' or any(is_prefix(each) for each in vals)) \
+                    and info.type not in STRING_TYPES:
+                raise prf.exc.HTTPBadRequest('`%s` is `%s` field, prefix query requires string field' % (key, info.type))
+
         def prefixedQ(key, val):
             if not isinstance(val, list):
                 val = [val]
@@ -574,11 +1010,11 @@ class ES(object):
 
             for each in val:
                 op = 'term'
-                if isinstance(each, str) and each.endswith('*'):
+                if is_prefix(each):
                     each = each.split('*')[0]
                     op = 'prefix'
 
-                items.append(Q(op, **{key:each}))
+                items.append(Q(op, **{term_key(key):each}))
 
             return items
 
@@ -626,6 +1062,13 @@ class ES(object):
             key, op = process_key(key)
             root_key = key.split('.')[0]
 
+            if root_key in specials._nested:
+                nested_path = root_key
+            else:
+                nested_path = fields[key].nested if key in fields else None
+
+            check_op(key, op, val)
+
             _filter = None
 
             if op in ['lt', 'lte', 'gt', 'gte']:
@@ -634,10 +1077,10 @@ class ES(object):
             elif op in ['startswith']:
                 if isinstance(val, list):
                     _filter = Q('bool',
-                        should=[Q('prefix', **{key:each}) for each in val]
+                        should=[Q('prefix', **{term_key(key):each}) for each in val]
                     )
                 else:
-                    _filter = Q('prefix', **{key:val})
+                    _filter = Q('prefix', **{term_key(key):val})
 
             elif op == 'exists':
                 _filter = get_exists(key)
@@ -683,7 +1126,12 @@ class ES(object):
                     _filter = ~_filter
 
             elif isinstance(val, list) or op == 'in':
-                _filter = Q('bool', should=prefixedQ(key, val))
+                vals = val if isinstance(val, list) else [val]
+
+                if vals and not any(is_prefix(each) for each in vals):
+                    _filter = Q('terms', **{term_key(key): vals})
+                else:
+                    _filter = Q('bool', should=prefixedQ(key, val))
 
                 if list_has_null:
                     _filter |= ~get_exists(key)
@@ -695,13 +1143,16 @@ class ES(object):
                 if isinstance(val, str):
                     _filter = prefixedQ(key, val)[0]
                 else:
-                    _filter = Q('term', **{key:val})
+                    _filter = Q('term', **{term_key(key):val})
 
                 if op == 'ne':
                     _filter = ~_filter
 
-            if root_key in specials._nested:
-                _nested[root_key] = _nested[root_key] & _filter if root_key in _nested else _filter
+            if nested_path and _filter:
+                if nested_path not in specials._nested:
+                    specials._nested.append(nested_path)
+
+                _nested[nested_path] = _nested[nested_path] & _filter if nested_path in _nested else _filter
 
             elif _filter:
                 _filters = _filters & _filter if _filters else _filter
@@ -720,7 +1171,7 @@ class ES(object):
         if specials._sort:
             _s = _s.sort(*prep_sort(specials, _nested))
 
-        if ES.version.major > 2 and specials.get('_search_after'):
+        if self.version.major > 2 and specials.get('_search_after'):
             _s = _s.extra(search_after=specials.aslist('_search_after'))
 
         if specials._end is not None:
@@ -737,78 +1188,159 @@ class ES(object):
         _s = _s.params(**extra)
         return _s
 
+    def check_pagination_limit(self, specials):
+        pagination_limit = self.settings.asint('max_result_window', default=MAX_RESULT_WINDOW)
+        if (specials._start or 0) > pagination_limit:
+            raise prf.exc.HTTPBadRequest('Reached max pagination limit of `%s`' % pagination_limit)
+
+    def get_aggregation(self, specials, _s):
+        '''
+        Returns the bound `Aggregator` method to run for the specials,
+        or None if its a plain search.
+        '''
+
+        def aggregator():
+            return self.aggregator_class(specials, _s, self.index,
+                                         doc_types=self.doc_types,
+                                         alias=self.get_alias_meta())
+
+        if specials._group:
+            return aggregator().do_group
+
+        if specials.get('_group_range'):
+            return aggregator().do_group_range
+
+        if specials._distinct:
+            return aggregator().do_distinct
+
+        if Aggregator.is_metrics(specials):
+            return aggregator().do_metrics
+
+    def get_alias_meta(self):
+        #None makes `Results` to fetch it
+        return None
+
     def get_collection(self, **params):
         params = Params(params)
         log.debug('(ES) IN: %s, params: %s', self.index, pformat(params))
 
         _params, specials = parse_specials(params)
-
-        def check_pagination_limit():
-            pagination_limit = self.settings.asint('max_result_window', default=MAX_RESULT_WINDOW)
-            if (specials._start or 0) > pagination_limit:
-                raise prf.exc.HTTPBadRequest('Reached max pagination limit of `%s`' % pagination_limit)
-
         _s = self.build_search_object(_params, specials)
 
         try:
-            if specials._group:
-                return Aggregator(specials, _s, self.index).do_group()
-
-            if specials.get('_group_range'):
-                return Aggregator(specials, _s, self.index).do_group_range()
-
-            if specials._distinct:
-                return Aggregator(specials, _s, self.index).do_distinct()
-
-            if Aggregator.is_metrics(specials):
-                return Aggregator(specials, _s, self.index).do_metrics()
+            agg = self.get_aggregation(specials, _s)
+            if agg:
+                return agg()
 
             if specials._count:
                 return _s.count()
 
-            check_pagination_limit()
+            self.check_pagination_limit(specials)
 
-            resp = _s.execute()
-            data = self.process_hits(resp.hits.hits)
-            return Results(self.index, specials, data, self.get_total(**params), resp.took,
+            resp = self.search_raw(_s)
+            data = self.process_hits(resp['hits']['hits'])
+            return Results(self.index, specials, data, self.get_total(**params), resp['took'],
                             doc_types=self.doc_types)
 
         finally:
             log.debug('(ES) OUT: %s, QUERY:\n%s', self.index, pformat(_s.to_dict()))
 
-    def paginate(self, page_size, limit, params):
+    def build_scroll(self, page_size, limit, params):
         _params, specials = parse_specials(params)
 
-        _s = self.build_search_object(_params, specials, size=page_size, sort=['_doc'])
-        log.debug('(ES) SCAN: %s, QUERY:\n%s', self.index, pformat(_s.to_dict()))
+        body = self.build_search_object(_params, specials).to_dict()
+        body.pop('from', None)
+        body['size'] = page_size if limit == -1 else max(min(page_size, limit), 1)
 
-        data = []
+        if not specials._sort:
+            body['sort'] = ['_doc']
+
+        log.debug('(ES) SCROLL: %s, QUERY:\n%s', self.index, pformat(body))
+        return body, self.settings.get('scroll', DEFAULT_SCROLL)
+
+    def next_scroll_page(self, hits, total, limit):
+        if limit != -1:
+            hits = hits[:limit - total]
+        return hits, total + len(hits)
+
+    def paginate(self, page_size, limit, params):
+        '''
+        Streams the results page by page with scroll api.
+        Scroll context is cleared as soon as the iteration is done, stopped or failed.
+        '''
+
+        if limit == 0:
+            return
+
+        body, keep_alive = self.build_scroll(page_size, limit, params)
+        alias = ES.api.indices.get_alias(self.index)
+
+        scroll_id = None
         total = 0
 
-        for hit in _s.scan():
-            if total >= limit:
+        try:
+            resp = ES.api.search(index=self.index, body=body, scroll=keep_alive)
+            scroll_id = resp.get('_scroll_id')
+
+            while resp['hits']['hits']:
+                hits, total = self.next_scroll_page(resp['hits']['hits'], total, limit)
+                yield Results(self.index, {}, self.process_hits(hits), 0, 0, self.doc_types,
+                              alias=alias)
+
+                if limit != -1 and total >= limit:
+                    break
+
+                resp = ES.api.scroll(scroll_id=scroll_id, scroll=keep_alive)
+                scroll_id = resp.get('_scroll_id') or scroll_id
+
+        finally:
+            if scroll_id:
+                ES.api.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+    def paginate_groups(self, page_size, limit, params):
+        #streams all the buckets of composite `_group` following `after_key` cursor
+        if '_count' in params:
+            raise prf.exc.HTTPBadRequest('`_count` is not supported with paged composite `_group`')
+
+        params['_composite'] = 1
+        total = 0
+
+        while limit == -1 or total < limit:
+            count = page_size if limit == -1 else min(page_size, limit - total)
+            params['_limit'] = count
+
+            results = self.get_collection(**params)
+            if not results:
                 break
 
-            total += 1
-            data.append(hit.to_dict())
+            total += len(results)
+            yield results
+
+            after_key = results._meta.get('after_key')
+            if not after_key or len(results) < count:
+                break
 
-            if len(data) >= page_size:
-                yield Results(self.index, {}, data, 0, 0, self.doc_types)
-                data = []
+            params['_after'] = after_key
 
     def get_collection_paged(self, page_size, **params):
         params = Params(params or {})
         _start = int(params.pop('_start', 0))
         _limit = int(params.pop('_limit', -1))
 
-        if _limit == -1:
-            _limit = self.get_total(**params)
+        if params.get('_group') and params.asbool('_composite', default=False):
+            for results in self.paginate_groups(page_size, _limit, params):
+                yield results
+            return
 
         if params.asbool('_pagination', default=False, pop=True):
+            #scroll runs till the end, no need to count first
             for results in self.paginate(page_size, _limit, params):
                 yield results
             return
 
+        if _limit == -1:
+            _limit = self.get_total(**params)
+
         log.debug('page_size=%s, _limit=%s', page_size, _limit)
         pgr = pager(_start, page_size, _limit)
         results = []
@@ -835,38 +1367,418 @@ class ES(object):
     def get_total(self, **params):
         return self.get_collection(_count=1, **params)
 
-    def save(self, obj, data):
+    def get_collection_version(self):
+        '''
+        Cheap version of the index for ETags: docs count plus indexing and delete ops counters.
+        '''
+        stats = ES.api.indices.stats(index=self.index, metric='docs,indexing')['_all']['primaries']
+        return '%s:%s:%s' % (stats['docs']['count'],
+                             stats['indexing']['index_total'],
+                             stats['indexing']['delete_total'])
+
+    def doc_params(self, obj):
+        params = dict(
+            index = obj._meta._index,
+            id = obj._meta._id,
+        )
+
+        if self.version.major < 7:
+            params['doc_type'] = obj._meta._type
+
+        return params
+
+    def bulk_params(self, obj):
+        params = {'_%s' % kk: vv for kk, vv in self.doc_params(obj).items()}
+        if '_doc_type' in params:
+            params['_type'] = params.pop('_doc_type')
+        return params
+
+    def save(self, obj, data, refresh=None):
         data = slovar(data).unflat()
 
-        if self.version.major >= 7:
-            return ES.api.update(
-                index = obj._meta._index,
-                id = obj._meta._id,
-                refresh=True,
-                detect_noop=True,
-                body = {'doc': data}
-            )
-        else:
-            return ES.api.update(
-                index = obj._meta._index,
-                doc_type = obj._meta._type,
-                id = obj._meta._id,
-                refresh=True,
-                detect_noop=True,
-                body = {'doc': data}
-            )
+        return ES.api.update(
+            refresh=self.get_refresh(refresh),
+            detect_noop=True,
+            body = {'doc': data},
+            **self.doc_params(obj)
+        )
 
-    def delete(self, obj):
-        if self.version.major >= 7:
-            return ES.api.delete(
-                index = obj._meta._index,
-                id = obj._meta._id,
-            )
+    def delete(self, obj, refresh=None):
+        return ES.api.delete(refresh=self.get_refresh(refresh, default='false'),
+                             **self.doc_params(obj))
+
+    def save_many(self, objs, data, refresh=None):
+        '''
+        Partial update of `objs` with one bulk request.
+        `data` is either a dict applied to all objs or a list of dicts, one per obj.
+        Bulk writes do not refresh unless `refresh` or `es.refresh` asks for it.
+        Returns the same as `flush`.
+        '''
+
+        if isinstance(data, dict):
+            data = [data] * len(objs)
+
+        if len(objs) != len(data):
+            raise DValueError('objs and data must be the same size. %s != %s' % (len(objs), len(data)))
+
+        actions = []
+        for obj, _d in zip(objs, data):
+            action = self.bulk_params(obj)
+            action.update({
+                '_op_type': 'update',
+                'doc': slovar(_d).unflat(),
+                'detect_noop': True,
+            })
+            actions.append(action)
+
+        return self.flush(actions, {'refresh': self.get_refresh(refresh, default='false')})
+
+    def delete_many(self, objs, refresh=None):
+        actions = []
+        for obj in objs:
+            action = self.bulk_params(obj)
+            action['_op_type'] = 'delete'
+            actions.append(action)
+
+        return self.flush(actions, {'refresh': self.get_refresh(refresh, default='false')})
+
+    def build_by_query(self, params):
+        _params, specials = parse_specials(Params(params))
+        query = self.build_search_object(_params, specials).to_dict().get('query')
+        return {'query': query or {'match_all': {}}}
+
+    def by_query_params(self, refresh, kw):
+        #by_query apis only take boolean refresh.
+        kw.setdefault('conflicts', 'proceed')
+        kw['refresh'] = self.get_refresh(refresh, default='false') != 'false'
+        return kw
+
+    def update_by_query(self, params, data, refresh=None, **kw):
+        '''
+        Partial update of all the docs matching `params`, same params as `get_collection`.
+        e.g. es.update_by_query({'status': 'new', 'created_at__lt': '2020-01-01'}, {'status': 'old'})
+        '''
+
+        body = self.build_by_query(params)
+        body['script'] = {
+            'source': UPDATE_BY_QUERY_SCRIPT,
+            'lang': 'painless',
+            'params': {'doc': slovar(data).unflat()},
+        }
+
+        log.debug('(ES) UPDATE BY QUERY: %s, QUERY:\n%s', self.index, pformat(body))
+        return self.api.update_by_query(index=self.index, body=body,
+                                      **self.by_query_params(refresh, kw))
+
+    def delete_by_query(self, params, refresh=None, **kw):
+        body = self.build_by_query(params)
+
+        log.debug('(ES) DELETE BY QUERY: %s, QUERY:\n%s', self.index, pformat(body))
+        return self.api.delete_by_query(index=self.index, body=body,
+                                      **self.by_query_params(refresh, kw))
+
+
+class AsyncAggregator(Aggregator):
+    '''
+    Same as Aggregator, but `do_*` methods return coroutines.
+    '''
+
+    @property
+    def version(self):
+        return AsyncES.version
+
+    def search(self):
+        return AsyncES.search_raw(self.search_obj)
+
+    async def do_count(self):
+        try:
+            return (await self.search())['aggregations']['total']['value']
+        except Exception as e:
+            raise prf.exc.HTTPBadRequest(e)
+
+    async def check_total(self, msg):
+        total = (await self.search())['aggregations']['total']['value']
+        if total > TOP_HITS_MAX_SIZE:
+            raise prf.exc.HTTPBadRequest('`%s` results: %s' % (total, msg))
+
+    async def execute(self, transform=None):
+        transform = transform or self.transform
+
+        try:
+            resp = await self.search()
+            return transform(resp.get('aggregations', {}))
+
+        except Exception as e:
+            raise prf.exc.HTTPBadRequest(e)
+
+        finally:
+            log.debug('(ES) OUT: %s, QUERY:\n%s', self.index, pformat(self.search_obj.to_dict()))
+
+
+class AsyncES(ES):
+    '''
+    asyncio version of ES. Mirrors ES api, but all the calls must be awaited.
+    Requires `elasticsearch[async]` (aiohttp) to be installed.
+
+    Example:
+        AsyncES.setup(settings)
+        users = AsyncES('users')
+        results = await asyncio.gather(
+            users.get_collection(_limit=10),
+            users.get_total(active=1))
+    '''
+
+    aggregator_class = AsyncAggregator
+    _version_checked = False
+    _field_types = {}
+
+    @classmethod
+    def setup(cls, settings):
+        from elasticsearch import AsyncElasticsearch
+
+        cls.settings = settings.unflat().es
+
+        try:
+            cls.api = AsyncElasticsearch(**cls.connection_params())
+            log.info('Including async ElasticSearch. %s' % cls.settings)
+
+        except KeyError as e:
+            raise Exception('Bad or missing settings for elasticsearch. %s' % e)
+
+    @classmethod
+    async def close(cls):
+        await cls.api.close()
+
+    @classmethod
+    async def _version(cls):
+        try:
+            info = await cls.api.info()
+            vers = info['version']['number'].split('.')
+        except Exception as e:
+            return cls.version
+
+        return slovar(major=int(vers[0]), minor=int(vers[1]), patch=int(vers[2]))
+
+    @classmethod
+    async def get_meta(cls, index, doc_type=None, command='get_mapping'):
+        method = getattr(cls.api.indices, command)
+        if cls.version.major >= 7:
+            return await method(index,
+                ignore_unavailable=True)
         else:
-            return ES.api.delete(
-                index = obj._meta._index,
-                doc_type = obj._meta._type,
-                id = obj._meta._id,
-            )
+            return await method(index,
+                doc_type,
+                ignore_unavailable=True)
+
+    @classmethod
+    async def get_doc_types(cls, index):
+        return cls.process_doc_types(await cls.get_meta(index))
+
+    @classmethod
+    async def get_alias_index_maps(cls, name):
+        aliases = slovar()
+        indices = slovar()
+
+        for index, alias in (await cls.get_meta(name, command='get_alias')).items():
+            allist = list(alias['aliases'].keys())
+            indices.add_to_list(index, allist)
+            for al in allist:
+                aliases.add_to_list(al, index)
+
+        return aliases, indices
+
+    @classmethod
+    async def flush(cls, data, args=None):
+        from elasticsearch.helpers import async_bulk
+
+        args = dict(args or {})
+        args.setdefault('raise_on_error', False)
+        args.setdefault('raise_on_exception', False)
+        args['refresh'] = cls.get_refresh(args.get('refresh'))
+
+        success, all_errors = await async_bulk(cls.api, data, **args)
+        success, errors, retry_data = cls.process_bulk_errors(data, success, all_errors)
+
+        cls.notify_flush(data, errors, retry_data)
+        return success, errors, retry_data
+
+    def __init__(self, name):
+        #index meta is loaded on the first call. see `init`
+        self.index = name
+        self.name = name
+        self.doc_types = None
+        self.alias_map = None
+        self.index_map = None
+        self._alias_meta = None
+
+    async def init(self):
+        if not AsyncES._version_checked:
+            AsyncES.version = await AsyncES._version()
+            AsyncES._version_checked = True
+
+        if self.doc_types is None:
+            meta = await self.get_meta(self.index)
+            self.doc_types = self.process_doc_types(meta) or []
+            fields = self.process_mapping(meta)
+            if fields:
+                self._field_types[self.index] = fields
+
+            self.alias_map, self.index_map = await self.get_alias_index_maps(self.index)
+            self._alias_meta = await self.api.indices.get_alias(self.index)
+
+        return self
+
+    @classmethod
+    def get_field_types(cls, index):
+        #loaded in `init`, since build_search_object can not await
+        return cls._field_types.get(index, slovar())
+
+    def get_alias_meta(self):
+        return self._alias_meta
+
+    async def drop_collection(self):
+        await self.api.indices.delete(self.index, ignore=[400, 404])
+        self.reset_field_types(self.index)
+
+    async def count(self, search_obj):
+        resp = await self.api.count(index=search_obj._index,
+                                    body=search_obj.to_dict(count=True),
+                                    **search_obj._params)
+        return resp['count']
+
+    async def get_collection(self, **params):
+        await self.init()
+
+        params = Params(params)
+        log.debug('(ES) IN: %s, params: %s', self.index, pformat(params))
+
+        _params, specials = parse_specials(params)
+        _s = self.build_search_object(_params, specials)
+
+        try:
+            agg = self.get_aggregation(specials, _s)
+            if agg:
+                return await agg()
+
+            if specials._count:
+                return await self.count(_s)
+
+            self.check_pagination_limit(specials)
+
+            resp = await self.search_raw(_s)
+            data = self.process_hits(resp['hits']['hits'])
+            return Results(self.index, specials, data, await self.get_total(**params), resp['took'],
+                            doc_types=self.doc_types, alias=self._alias_meta)
+
+        finally:
+            log.debug('(ES) OUT: %s, QUERY:\n%s', self.index, pformat(_s.to_dict()))
+
+    async def paginate(self, page_size, limit, params):
+        if limit == 0:
+            return
+
+        body, keep_alive = self.build_scroll(page_size, limit, params)
+
+        scroll_id = None
+        total = 0
+
+        try:
+            resp = await self.api.search(index=self.index, body=body, scroll=keep_alive)
+            scroll_id = resp.get('_scroll_id')
+
+            while resp['hits']['hits']:
+                hits, total = self.next_scroll_page(resp['hits']['hits'], total, limit)
+                yield Results(self.index, {}, self.process_hits(hits), 0, 0, self.doc_types,
+                              alias=self._alias_meta)
+
+                if limit != -1 and total >= limit:
+                    break
+
+                resp = await self.api.scroll(scroll_id=scroll_id, scroll=keep_alive)
+                scroll_id = resp.get('_scroll_id') or scroll_id
+
+        finally:
+            if scroll_id:
+                await self.api.clear_scroll(scroll_id=scroll_id, ignore=(404,))
+
+    async def paginate_groups(self, page_size, limit, params):
+        if '_count' in params:
+            raise prf.exc.HTTPBadRequest('`_count` is not supported with paged composite `_group`')
+
+        params['_composite'] = 1
+        total = 0
+
+        while limit == -1 or total < limit:
+            count = page_size if limit == -1 else min(page_size, limit - total)
+            params['_limit'] = count
+
+            results = await self.get_collection(**params)
+            if not results:
+                break
+
+            total += len(results)
+            yield results
+
+            after_key = results._meta.get('after_key')
+            if not after_key or len(results) < count:
+                break
+
+            params['_after'] = after_key
+
+    async def get_collection_paged(self, page_size, **params):
+        params = Params(params or {})
+        _start = int(params.pop('_start', 0))
+        _limit = int(params.pop('_limit', -1))
+
+        if params.get('_group') and params.asbool('_composite', default=False):
+            async for results in self.paginate_groups(page_size, _limit, params):
+                yield results
+            return
+
+        if params.asbool('_pagination', default=False, pop=True):
+            async for results in self.paginate(page_size, _limit, params):
+                yield results
+            return
+
+        if _limit == -1:
+            _limit = await self.get_total(**params)
+
+        log.debug('page_size=%s, _limit=%s', page_size, _limit)
+        pgr = pager(_start, page_size, _limit)
+
+        for start, count in pgr():
+            params.update({'_start':start, '_limit': count})
+            yield await self.get_collection(**params)
+
+    async def get_resource(self, **params):
+        params['_limit'] = 1
+        try:
+            return (await self.get_collection(**params))[0].to_dict()
+        except IndexError:
+            raise prf.exc.HTTPNotFound("(ES) '%s(%s)' resource not found" % (self.index, params))
+
+    async def get(self, **params):
+        params['_limit'] = 1
+        try:
+            return (await self.get_collection(**params))[0].to_dict()
+        except IndexError:
+            pass
+
+    async def get_total(self, **params):
+        return await self.get_collection(_count=1, **params)
+
+    async def save(self, obj, data, refresh=None):
+        data = slovar(data).unflat()
+
+        return await self.api.update(
+            refresh=self.get_refresh(refresh),
+            detect_noop=True,
+            body = {'doc': data},
+            **self.doc_params(obj)
+        )
+
+    async def delete(self, obj, refresh=None):
+        return await self.api.delete(refresh=self.get_refresh(refresh, default='false'),
+                                     **self.doc_params(obj))
 
 
@@ -0,0 +1,200 @@
+import time
+import logging
+from datetime import datetime
+
+from slovar import slovar
+
+from prf.es import ES
+from prf.utils import get_dt_unique_name
+from prf.utils.errors import DKeyError, DValueError
+
+log = logging.getLogger(__name__)
+
+#settings ES sets on its own and refuses on index creation
+READONLY_SETTINGS = ['uuid', 'creation_date', 'version', 'provided_name', 'routing',
+                     'resize', 'blocks', 'history_uuid']
+
+BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+class Reindexer(object):
+    '''
+    Zero-downtime reindex of `name` (alias or index):
+        1. creates `new_index` with the mapping and settings of the source plus `BULK_SETTINGS`
+        2. runs sliced `_reindex` as a task, polling it for progress and throughput.
+           Docs keep the source versions (`version_type=external`).
+        3. if `updated_field` is set, runs a catch-up `_reindex` of the docs updated
+           since the first pass started. Only newer versions overwrite.
+        4. restores the settings and refreshes `new_index`
+        5. atomically points the alias to `new_index` if the counts differ by at most
+           `tolerance` docs (or `force`). If `name` is an index, it is removed
+           and `name` becomes an alias of `new_index` in the same call.
+
+    Writes to the source between the catch-up pass and the swap are lost, as are
+    the deletes made during the reindex.
+
+    Example:
+        Reindexer('tweets', mapping={'properties': {'lang': {'type': 'keyword'}}},
+                  updated_field='updated_at').run()
+    '''
+
+    def __init__(self, name, new_index=None, mapping=None, slices='auto',
+                 poll_interval=5, keep_source=True, updated_field=None, tolerance=0,
+                 force=False):
+        self.name = name
+        self.new_index = new_index or get_dt_unique_name(name)
+        self.mapping = mapping or {}
+        self.slices = slices
+        self.poll_interval = poll_interval
+        self.keep_source = keep_source
+        self.updated_field = updated_field
+        self.tolerance = tolerance
+        self.force = force
+
+        aliases, indices = ES.get_alias_index_maps(name)
+        if not indices:
+            raise DKeyError('`%s` index or alias not found' % name)
+
+        self.is_alias = name in aliases
+        self.source_indices = aliases[name] if self.is_alias else [name]
+
+        if self.new_index in self.source_indices:
+            raise DValueError('`%s` is already used by `%s`' % (self.new_index, name))
+
+    def source_meta(self):
+        index = self.source_indices[0]
+        mappings = ES.get_meta(index)[index]['mappings']
+        settings = ES.get_meta(index, command='get_settings')[index]['settings']['index']
+
+        for each in READONLY_SETTINGS:
+            settings.pop(each, None)
+
+        return mappings, settings
+
+    def merge_mapping(self, mappings):
+        def merge(base, changes):
+            return slovar(base).flat(keep_lists=True)\
+                        .update_with(slovar(changes).flat(keep_lists=True)).unflat()
+
+        if not mappings or 'properties' in mappings:
+            return merge(mappings, self.mapping)
+
+        #pre 7.x mappings are keyed by the doc type. `mapping` can be either typed or not.
+        return {doc_type: merge(each, self.mapping.get(doc_type, self.mapping))
+                    for doc_type, each in mappings.items()}
+
+    def create(self):
+        mappings, settings = self.source_meta()
+
+        self.restore_settings = {
+            'refresh_interval': settings.get('refresh_interval', None),
+            'number_of_replicas': settings.get('number_of_replicas', 1),
+        }
+
+        settings.update(BULK_SETTINGS)
+        mappings = self.merge_mapping(mappings)
+
+        log.info('Creating `%s` from `%s`', self.new_index, ','.join(self.source_indices))
+        ES.api.indices.create(self.new_index,
+                              body={'settings': {'index': settings}, 'mappings': mappings})
+
+    def start(self, query=None):
+        source = {'index': self.source_indices}
+        if query:
+            source['query'] = query
+
+        resp = ES.api.reindex(body={
+                    'source': source,
+                    'dest': {'index': self.new_index, 'version_type': 'external'},
+                    'conflicts': 'proceed',
+                }, slices=self.slices, wait_for_completion=False, refresh=False)
+
+        return resp['task']
+
+    def catch_up(self, since):
+        #copies the docs updated while the first pass was running
+        log.info('Catching up `%s` with the docs updated since %s', self.new_index, since)
+        return self.wait(self.start({'range': {self.updated_field: {'gte': since}}}))
+
+    def wait(self, task_id):
+        started = time.time()
+
+        while True:
+            task = ES.api.tasks.get(task_id=task_id)
+            status = task['task']['status']
+
+            done = status['created'] + status['updated'] + status['deleted']
+            elapsed = time.time() - started
+
+            log.info('Reindex `%s`: %s/%s docs (%.1f%%), %.0f docs/sec',
+                     self.new_index, done, status['total'],
+                     100.0 * done / status['total'] if status['total'] else 100,
+                     done / elapsed if elapsed else 0)
+
+            if task.get('completed'):
+                break
+
+            time.sleep(self.poll_interval)
+
+        resp = task.get('response', {})
+        failures = resp.get('failures') or task.get('error')
+
+        if failures:
+            raise DValueError('Reindex `%s` failed: %s' % (self.new_index, failures))
+
+        return slovar(total=status['total'], done=done, took=elapsed,
+                      throughput=done / elapsed if elapsed else 0)
+
+    def restore(self):
+        ES.api.indices.put_settings(index=self.new_index, body={'index': self.restore_settings})
+        ES.api.indices.refresh(index=self.new_index)
+
+    def swap(self):
+        actions = [{'add': {'index': self.new_index, 'alias': self.name}}]
+
+        if self.is_alias:
+            actions += [{'remove': {'index': each, 'alias': self.name}}
+                        for each in self.source_indices]
+        else:
+            actions.append({'remove_index': {'index': self.name}})
+
+        log.info('Swapping `%s` to `%s`', self.name, self.new_index)
+        ES.api.indices.update_aliases(body={'actions': actions})
+        ES.reset_field_types()
+
+    def run(self, swap=True):
+        self.create()
+        started_at = datetime.utcnow().isoformat()
+
+        try:
+            stats = self.wait(self.start())
+            if self.updated_field:
+                stats.caught_up = self.catch_up(started_at).done
+        except Exception:
+            log.error('Reindex failed, `%s` left untouched. Drop `%s` to retry.',
+                      self.name, self.new_index)
+            raise
+
+        self.restore()
+
+        source_total = ES.api.count(index=self.source_indices)['count']
+        new_total = ES.api.count(index=self.new_index)['count']
+
+        if abs(source_total - new_total) > self.tolerance:
+            if self.force:
+                log.warning('Counts differ: `%s`=%s, `%s`=%s. Swapping anyway.',
+                            self.name, source_total, self.new_index, new_total)
+            else:
+                log.warning('Counts differ: `%s`=%s, `%s`=%s. Not swapping.',
+                            self.name, source_total, self.new_index, new_total)
+                swap = False
+
+        if swap:
+            self.swap()
+            if self.is_alias and not self.keep_source:
+                for each in self.source_indices:
+                    ES.api.indices.delete(each, ignore=[400, 404])
+
+        stats.update({'index': self.new_index, 'swapped': swap})
+        log.info('Reindex done: %s', stats)
+        return stats
@@ -101,6 +101,12 @@ def HTTPFound(*arg, **kw):
     return create_response(http_exc.HTTPFound(*arg,
                             location=kw['location']), kw)
 
+def HTTPNotModified(*arg, **kw):
+    #304 must not have a body
+    resp = http_exc.HTTPNotModified(*arg)
+    resp.headers.extend(kw.get('headers', []))
+    return resp
+
 # 40x
 def HTTPNotFound(*arg, **kw):
     return create_response(http_exc.HTTPNotFound(*arg), kw)
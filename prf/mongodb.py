@@ -4,9 +4,9 @@ from datetime import datetime
 
 import pymongo
 from pymongo.errors import PyMongoError, BulkWriteError
-from bson import ObjectId, DBRef
 import mongoengine as mongo
 from mongoengine.base import TopLevelDocumentMetaclass as TLDMetaclass
+from mongoengine.queryset import QuerySet
 
 from slovar import slovar
 import prf.exc
@@ -18,6 +18,9 @@ import collections
 
 log = logging.getLogger(__name__)
 
+MOTOR_CLIENTS = {}
+#documents whose `updated_at` index was checked by `get_collection_version`
+VERSION_INDEX_CHECKED = set()
 
 class CommandLogger(pymongo.monitoring.CommandListener):
     def started(self, event):
@@ -104,6 +107,29 @@ def mongo_connect(settings):
 
 def mongo_disconnect(alias):
     mongo.connection.disconnect(alias)
+    client = MOTOR_CLIENTS.pop(alias, None)
+    if client:
+        client.close()
+
+
+def get_motor_db(alias=mongo.DEFAULT_CONNECTION_NAME):
+    '''
+    motor (asyncio) db for the mongoengine connection `alias`, created on the first call.
+    '''
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    settings = dict(mongo.connection._connection_settings[alias])
+    if alias not in MOTOR_CLIENTS:
+        params = {}
+        for kk, vv in settings.items():
+            if kk == 'name' or vv is None:
+                continue
+            params[{'authentication_source': 'authSource',
+                    'authentication_mechanism': 'authMechanism'}.get(kk, kk)] = vv
+
+        MOTOR_CLIENTS[alias] = AsyncIOMotorClient(**params)
+
+    return MOTOR_CLIENTS[alias][settings['name']]
 
 def is_exists_error(e):
     return 'E11000' in str(e)
@@ -138,12 +164,10 @@ def mongodb_exc_tween(handler, registry):
 
 
 class MongoJSONEncoder(_JSONEncoder):
-
-    def default(self, obj):
-        if isinstance(obj, (ObjectId, DBRef)):
-            return str(obj)
-
-        return super(MongoJSONEncoder, self).default(obj)
+    '''
+    For `json.dumps(cls=MongoJSONEncoder)` callers. prf encodes with `json_dumps`/`json_dumpb`
+    (see `set_json_backend`), which already turn ObjectId and DBRef into strings.
+    '''
 
 
 class Aggregator(object):
@@ -352,14 +376,49 @@ class Aggregator(object):
         except PyMongoError as e:
             raise prf.exc.HTTPBadRequest(e)
 
-    def aggregate_count(self, collection):
+    def add_count(self):
         self._agg.append({'$group': { '_id': None, 'count': {'$sum': 1}}})
-        result = self.aggregate(collection)
+        return self
+
+    def aggregate_count(self, collection):
+        result = self.add_count().aggregate(collection)
+        if result:
+            return result[0]['count']
+        else:
+            return 0
+
+
+class AsyncAggregator(Aggregator):
+    '''
+    Aggregator over a motor collection. `group` and `unwind` return coroutines.
+    '''
+
+    async def aggregate(self, collection):
+        log.debug('AGG: %s', pformat(self._agg))
+        try:
+            return [slovar(e) async for e in
+                    collection.aggregate(self._agg, allowDiskUse=True)]
+        except PyMongoError as e:
+            raise prf.exc.HTTPBadRequest(e)
+
+    async def aggregate_count(self, collection):
+        result = await self.add_count().aggregate(collection)
         if result:
             return result[0]['count']
         else:
             return 0
 
+
+class AsyncResults(list):
+    '''
+    Documents returned by `aget_collection`. `_total` is the count before pagination, same as
+    the query set returned by `get_collection`.
+    '''
+
+    def __init__(self, data, total):
+        super(AsyncResults, self).__init__(data)
+        self.total = self._total = total
+
 class BaseMixin(object):
 
     Q = mongo.Q
@@ -417,10 +476,14 @@ class BaseMixin(object):
 
     @classmethod
     def get_distinct(cls, queryset, specials):
+        return cls.process_distinct(queryset.distinct(specials._distinct), specials)
+
+    @classmethod
+    def process_distinct(cls, values, specials):
         reverse = False
 
         if specials.asbool('_count', False):
-            return len(queryset.distinct(specials._distinct))
+            return len(values)
 
         if specials._sort:
             if len(specials._sort) > 1:
@@ -434,8 +497,7 @@ class BaseMixin(object):
             if _sort != specials._distinct:
                 raise prf.exc.HTTPBadRequest('Must sort only on distinct')
 
-        dset = sorted([it for it in queryset.distinct(specials._distinct) if it is not None],
-                        reverse=reverse)
+        dset = sorted([it for it in values if it is not None], reverse=reverse)
 
         if specials._end is None:
             if specials._start != 0:
@@ -456,23 +518,37 @@ class BaseMixin(object):
     def get_unwind(cls, queryset, specials):
         return Aggregator(queryset._query, specials).unwind(cls._get_collection())
 
+    @staticmethod
+    def build_query_set(query_set, _q, params):
+        if isinstance(_q, str) or not _q:
+            return query_set(**params)
+        else: # needs better way to check if its a proper query object
+            return query_set(_q)(**params)
+
+    @staticmethod
+    def apply_fields(query_set, specials):
+        op = process_fields(specials._fields)
+        if op.star:
+            pass
+        elif op.only:
+            query_set = query_set.only(*op.only)
+        elif op.exclude:
+            query_set = query_set.exclude(*op.exclude)
+
+        return query_set
+
     @classmethod
     def get_collection(cls, _q=None, **params):
         params = Params(params)
         log.debug('IN: cls: %s, params: %.512s', cls.__name__, params)
         params, specials = parse_specials(params)
 
-        if isinstance(_q, str) or not _q:
-            query_set = cls.objects
-        else: # needs better way to check if its a proper query object
-            query_set = cls.objects(_q)
-
         if log.getEffectiveLevel() == logging.DEBUG:
             #TODO: move it out of here. put it in get_collection_paged?
             cls.check_indexes_exist(list(params.keys())+
                     [e[1:] if e.startswith('-') else e for e in specials._sort])
 
-        query_set = query_set(**params)
+        query_set = cls.build_query_set(cls.objects, _q, params)
 
         try:
             if specials._frequencies:
@@ -506,13 +582,7 @@ class BaseMixin(object):
                 return query_set.scalar(*specials.aslist('_scalar'))
 
             if specials._fields:
-                op = process_fields(specials._fields)
-                if op.star:
-                    pass
-                elif op.only:
-                    query_set = query_set.only(*op.only)
-                elif op.exclude:
-                    query_set = query_set.exclude(*op.exclude)
+                query_set = cls.apply_fields(query_set, specials)
 
             query_set._total = _total
             return query_set
@@ -521,6 +591,73 @@ class BaseMixin(object):
            log.debug('OUT: collection: %s, query: %.512s',
                                         cls.__name__, query_set._query)
 
+    @classmethod
+    def get_motor_collection(cls):
+        return get_motor_db(cls._meta.get('db_alias', mongo.DEFAULT_CONNECTION_NAME))\
+                    [cls._get_collection_name()]
+
+    @classmethod
+    async def aget_collection(cls, _q=None, **params):
+        '''
+        asyncio version of `get_collection` over motor. Queries are compiled by mongoengine
+        the same way, without touching the sync connection. `_frequencies` is not supported.
+        '''
+        params = Params(params)
+        log.debug('IN (async): cls: %s, params: %.512s', cls.__name__, params)
+        params, specials = parse_specials(params)
+
+        query_set = cls.build_query_set(
+                    cls._meta.get('queryset_class', QuerySet)(cls, None), _q, params)
+        query = query_set._query
+        collection = cls.get_motor_collection()
+
+        log.debug('OUT (async): collection: %s, query: %.512s', cls.__name__, query)
+
+        if specials._frequencies:
+            raise prf.exc.HTTPBadRequest('`_frequencies` is not supported in async mode')
+
+        elif specials._group:
+            return await AsyncAggregator(query, specials).group(collection)
+
+        elif specials._distinct:
+            return cls.process_distinct(
+                        await collection.distinct(specials._distinct, query), specials)
+
+        elif specials._unwind:
+            return await AsyncAggregator(query, specials).unwind(collection)
+
+        try:
+            _total = await collection.count_documents(query)
+
+            if specials._count:
+                return _total
+
+            if specials._sort:
+                query_set = query_set.order_by(*specials._sort)
+
+            if specials._scalar:
+                query_set = query_set.scalar(*specials.aslist('_scalar'))
+            elif specials._fields:
+                query_set = cls.apply_fields(query_set, specials)
+
+            #_start and _end are None without _limit
+            skip = specials._start or 0
+            cursor = collection.find(query,
+                        projection=query_set._loaded_fields.as_dict() or None,
+                        sort=query_set._ordering or None,
+                        skip=skip,
+                        limit=0 if specials._end is None else specials._end - skip)
+
+            data = []
+            async for each in cursor:
+                doc = cls._from_son(each, _auto_dereference=False)
+                data.append(query_set._get_scalar(doc) if specials._scalar else doc)
+
+        except PyMongoError as e:
+            raise prf.exc.HTTPBadRequest(e)
+
+        return AsyncResults(data, _total)
+
     @classmethod
     def get_resource(cls, **params):
         params['_limit']=1
@@ -555,6 +692,10 @@ class BaseMixin(object):
     def get_total(cls, **params):
         return cls.get_collection(_count=1, **params)
 
+    @classmethod
+    async def aget_total(cls, **params):
+        return await cls.aget_collection(_count=1, **params)
+
     def repr_parts(self):
         return []
 
@@ -657,6 +798,26 @@ class BaseMixin(object):
             else:
                 raise
 
+    @classmethod
+    def get_collection_version(cls):
+        '''
+        Cheap version of the collection for ETags: estimated count and max `updated_at`.
+        Read from the db only, so it holds across processes, but every write must set
+        `updated_at` and it should be indexed. None (no ETags) without `updated_at` field.
+        '''
+        if 'updated_at' not in cls._fields:
+            return
+
+        if cls.__name__ not in VERSION_INDEX_CHECKED:
+            cls.check_indexes_exist(['updated_at'])
+            VERSION_INDEX_CHECKED.add(cls.__name__)
+
+        collection = cls._get_collection()
+        field = cls._fields['updated_at'].db_field
+        last = collection.find_one({}, {field: 1}, sort=[(field, -1)])
+
+        return '%s:%s' % (collection.estimated_document_count(), last.get(field) if last else None)
+
     def save_safe(self):
         try:
             return self.save()
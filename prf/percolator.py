@@ -0,0 +1,264 @@
+import logging
+from pprint import pformat
+from datetime import datetime
+
+from slovar import slovar
+
+import prf
+from prf.es import ES
+from prf.view import BaseView
+from prf.utils import Params, chunks
+
+log = logging.getLogger(__name__)
+
+PERCOLATE_BATCH_SIZE = 500
+MATCHES_INDEX = 'prf_saved_search_matches'
+
+
+def includeme(config):
+    '''
+    Saved searches: queries stored in a percolator index, checked against
+    the docs flushed with `ES.flush`. Matches are stored in `es.percolator.matches_index`.
+    Requires elasticsearch >= 6.1 (multi-document percolate).
+    Indices listed in `es.percolator.indices` are registered at startup in every process.
+
+        config.include('prf.es')
+        config.include('prf.percolator')
+    '''
+
+    SavedSearches.setup(slovar(config.registry.settings))
+    ES.add_flush_listener(SavedSearches.on_flush)
+
+    for index in SavedSearches.settings.aslist('indices', default=[]):
+        SavedSearches(index).register()
+
+    config.add_directive('add_saved_search_views', add_saved_search_views)
+
+
+def add_saved_search_views(config, route_prefix='_saved_searches'):
+    for name, path, action, method in [
+            ['prf_saved_searches', route_prefix, '_index', 'GET'],
+            ['prf_saved_searches', route_prefix, '_create', 'POST'],
+            ['prf_saved_search', route_prefix + '/{id}', '_show', 'GET'],
+            ['prf_saved_search', route_prefix + '/{id}', '_delete', 'DELETE'],
+            ['prf_saved_search_matches', route_prefix + '/{id}/matches', 'matches', 'GET']]:
+
+        if not config.get_routes_mapper().get_route(name):
+            config.add_route(name, path)
+
+        config.add_view(view=SavedSearchesView, attr=action, route_name=name,
+                        request_method=method, renderer='json')
+
+
+class SavedSearches(object):
+    '''
+    Stores `build_search_object` compiled queries of `index` in a percolator index.
+    `registry` is per process: only the docs flushed by a process that registered
+    the index are percolated, so list the indices in `es.percolator.indices`.
+
+    Example:
+        searches = SavedSearches('tweets')
+        searches.save('mentions', {'text': 'prf*', 'lang': 'en'})
+        searches.match([{'text': 'prf rocks', 'lang': 'en'}]) -> {0: ['mentions']}
+    '''
+
+    registry = {}
+    settings = slovar()
+    matches_index = MATCHES_INDEX
+
+    @classmethod
+    def setup(cls, settings):
+        cls.settings = settings.unflat().get('es', slovar()).get('percolator', slovar())
+        cls.matches_index = cls.settings.get('matches_index', MATCHES_INDEX)
+
+    @classmethod
+    def on_flush(cls, docs):
+        #group by the index and percolate only indices that have saved searches.
+        by_index = {}
+        for each in docs:
+            if each.get('_index') in cls.registry and each.get('_op_type', 'index') == 'index':
+                by_index.setdefault(each['_index'], []).append(each)
+
+        for index, _docs in by_index.items():
+            cls.registry[index].match_and_store(_docs)
+
+    def __init__(self, index):
+        self.index = index
+        self.name = '%s_saved_searches' % index
+        self._es = None
+
+    @property
+    def es(self):
+        #ES() loads the index meta, so do not hit the cluster before it is needed
+        if self._es is None:
+            self._es = ES(self.index)
+        return self._es
+
+    @classmethod
+    def get(cls, index):
+        '''registered searches of `index`, or the ones created by another process'''
+
+        searches = cls.registry.get(index)
+        if not searches and index and ES.api.indices.exists(index=cls(index).name):
+            searches = cls(index).register()
+        return searches
+
+    def register(self):
+        #register to percolate the docs flushed into `self.index`
+        SavedSearches.registry[self.index] = self
+        return self
+
+    def create(self):
+        '''creates the percolator index using the mapping of `self.index`'''
+
+        properties = slovar()
+        for meta in (ES.get_meta(self.index) or {}).values():
+            mappings = meta.get('mappings', {})
+            if 'properties' not in mappings:
+                #pre 7.x mappings are keyed by doc type
+                mappings = list(mappings.values())[0] if mappings else {}
+            properties.update(mappings.get('properties', {}))
+
+        properties.update({
+            'query': {'type': 'percolator'},
+            '_search_name': {'type': 'keyword'},
+            '_search_params': {'type': 'object', 'enabled': False},
+            '_created_at': {'type': 'date'},
+        })
+
+        ES.api.indices.create(self.name, body={'mappings': {'properties': properties}},
+                              ignore=400)
+        return self.register()
+
+    def save(self, name, params):
+        params = Params(params)
+        query = self.es.build_by_query(params)['query']
+
+        log.debug('SAVED SEARCH: %s/%s, QUERY:\n%s', self.index, name, pformat(query))
+
+        ES.api.index(index=self.name, id=name, refresh='wait_for', body={
+            'query': query,
+            '_search_name': name,
+            '_search_params': params,
+            '_created_at': datetime.utcnow(),
+        })
+
+        return query
+
+    def delete(self, name):
+        return ES.api.delete(index=self.name, id=name, refresh='wait_for', ignore=404)
+
+    def get_collection(self, **params):
+        return ES(self.name).get_collection(**params)
+
+    def get_resource(self, name):
+        return ES(self.name).get_resource(_id=name)
+
+    @staticmethod
+    def doc_source(doc):
+        #bulk actions either carry the doc in `_source` or inline next to the meta fields
+        if '_source' in doc:
+            return doc['_source']
+        return {kk: vv for kk, vv in doc.items() if not kk.startswith('_')}
+
+    def match(self, docs):
+        '''
+        Percolates `docs` in one call per batch, paging through the matched searches
+        `es.percolator.page_size` at a time.
+        Returns {doc position in `docs`: [saved search names]}
+        '''
+
+        matches = {}
+        size = self.settings.asint('page_size', default=1000)
+
+        for offset, batch in enumerate(chunks(list(docs), PERCOLATE_BATCH_SIZE)):
+            base = offset * PERCOLATE_BATCH_SIZE
+            body = {
+                'query': {'percolate': {
+                    'field': 'query',
+                    'documents': [self.doc_source(each) for each in batch],
+                }},
+                '_source': ['_search_name'],
+                'sort': ['_search_name'],
+                'size': size,
+            }
+
+            while True:
+                hits = ES.api.search(index=self.name, body=body)['hits']['hits']
+
+                for hit in hits:
+                    slots = hit.get('fields', {}).get('_percolator_document_slot', [0])
+                    for slot in slots:
+                        matches.setdefault(base + slot, []).append(hit['_id'])
+
+                if len(hits) < size:
+                    break
+
+                body['search_after'] = hits[-1]['sort']
+
+        return matches
+
+    def match_and_store(self, docs):
+        matches = self.match(docs)
+        if not matches:
+            return matches
+
+        now = datetime.utcnow()
+        actions = []
+
+        for slot, names in matches.items():
+            doc = docs[slot]
+            for name in names:
+                actions.append({
+                    '_index': self.matches_index,
+                    '_id': '%s:%s:%s' % (self.index, name, doc.get('_id')),
+                    '_source': {
+                        'search': name,
+                        'index': self.index,
+                        'doc_id': doc.get('_id'),
+                        'matched_at': now,
+                    }
+                })
+
+        #matches index is not registered, so this does not percolate again.
+        ES.flush(actions, {'refresh': 'false'})
+        log.debug('SAVED SEARCH MATCHES: %s, docs=%s, matches=%s', self.index, len(docs), len(actions))
+        return matches
+
+
+class SavedSearchesView(BaseView):
+    '''
+    GET _saved_searches?index=tweets             list saved searches
+    POST _saved_searches {index, name, params}   save a search
+    GET _saved_searches/<name>?index=tweets      show a saved search
+    DELETE _saved_searches/<name>?index=tweets   delete a saved search
+    GET _saved_searches/<name>/matches?index=tweets&matched_at__gte=2020-01-01
+    '''
+
+    def get_searches(self):
+        index = self._params.asstr('index', pop=True)
+        searches = SavedSearches.get(index)
+        if not searches:
+            raise prf.exc.HTTPNotFound('No saved searches for `%s`' % index)
+        return searches
+
+    def index(self):
+        return self.get_searches().get_collection(**self._params)
+
+    def show(self, id):
+        return self.get_searches().get_resource(id)
+
+    def create(self):
+        searches = self.get_searches()
+        name = self._params.asstr('name')
+        searches.save(name, self._params.get('params', {}))
+        return prf.exc.HTTPCreated(location=self.request.route_url('prf_saved_search', id=name))
+
+    def delete(self, id):
+        self.get_searches().delete(id)
+
+    def matches(self, id):
+        index = self.get_searches().index
+        return self._process(
+            ES(SavedSearches.matches_index).get_collection(search=id, index=index, **self._params),
+            many=True)
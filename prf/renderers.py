@@ -1,5 +1,9 @@
 import json
-from prf.utils import JSONEncoder as _JSONEncoder
+
+import prf.exc
+from prf.utils import JSONEncoder as _JSONEncoder, json_dumpb, renderer_specials, tab_headers
+
+NDJSON_CHUNK_LINES = 500
 
 
 class JsonRenderer(object):
@@ -15,4 +19,90 @@ class JsonRenderer(object):
             if ct == response.default_content_type:
                 response.content_type = 'application/json'
 
-        return json.dumps(value, cls=_JSONEncoder)
+        return json_dumpb(value)
+
+
+def iter_ndjson(value, meta=False, chunk_lines=NDJSON_CHUNK_LINES):
+    lines = []
+    count = 0
+
+    for each in value['data']:
+        lines.append(json_dumpb(each))
+        count += 1
+
+        if len(lines) >= chunk_lines:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+
+    if meta:
+        _meta = dict(value.get('_meta') or {})
+        _meta.update(total=value.get('total'), count=count, query=value.get('query'))
+        lines.append(json_dumpb({'_meta': _meta}))
+
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+class NdjsonRenderer(object):
+    '''
+    One JSON document per line (JSON Lines). Collection items are written as the view
+    serializes them, see `BaseView.streaming`. The total goes to `X-Total-Count` header,
+    `_ndjson_meta=1` adds a trailing `{"_meta": {total, count, query, ...}}` line.
+    '''
+
+    def __init__(self, info):
+        pass
+
+    def __call__(self, value, system):
+        request = system.get('request')
+        response = request.response
+        response.content_type = 'application/x-ndjson'
+
+        if not isinstance(value, dict) or 'data' not in value:
+            return json_dumpb(value) + b'\n'
+
+        if value.get('total') is not None:
+            response.headers['X-Total-Count'] = str(value['total'])
+
+        specials = renderer_specials(system)
+        return iter_ndjson(value, meta=specials.asbool('_ndjson_meta', default=False))
+
+
+class ArrowRenderer(object):
+    '''
+    Arrow IPC stream or Parquet, picked by `_renderer=arrow|parquet` or the Accept header.
+    Columns are the plain `_fields` if any. Requires pyarrow.
+    '''
+
+    def __init__(self, info):
+        pass
+
+    def __call__(self, value, system):
+        from prf import arrow
+
+        if not arrow.pa:
+            raise prf.exc.HTTPBadRequest('arrow and parquet exports require pyarrow')
+
+        request = system.get('request')
+        response = request.response
+        specials = renderer_specials(system)
+
+        _format = specials.get('_renderer')
+        if _format not in ['arrow', 'parquet']:
+            _format = 'parquet' if arrow.PARQUET_MIME in request.accept else 'arrow'
+
+        if not isinstance(value, dict) or 'data' not in value:
+            value = {'data': [value]}
+
+        fields = specials._fields or []
+        columns = None
+        if fields and not any(each.startswith('-') or '*' in each for each in fields):
+            columns = tab_headers(fields)
+
+        #set by the view, see `BaseView._process`
+        get_types = request.environ.get('prf.field_types')
+
+        response.content_type = arrow.PARQUET_MIME if _format == 'parquet' else arrow.ARROW_MIME
+
+        return arrow.iter_arrow(value['data'] or [], columns=columns,
+                                types=get_types() if get_types else None, format_=_format)
@@ -0,0 +1,65 @@
+'''
+Reindex an index or alias with zero downtime: prf.es_reindex tweets --mapping mapping.json
+'''
+import sys
+import json
+import logging
+
+from argparse import ArgumentParser
+from slovar import slovar
+
+from prf.es import ES
+from prf.es_reindex import Reindexer
+from prf.utils.errors import DKeyError, DValueError
+
+log = logging
+
+
+class Script(object):
+    def __init__(self, argv):
+        parser = ArgumentParser(description=__doc__)
+        parser.add_argument('--urls', default='http://localhost:9200')
+        parser.add_argument('--new-index')
+        parser.add_argument('--mapping', help='json file with the mapping changes for the new index')
+        parser.add_argument('--slices', default='auto')
+        parser.add_argument('--poll', type=int, default=5, help='progress polling interval in seconds')
+        parser.add_argument('--no-swap', action='store_true')
+        parser.add_argument('--drop-source', action='store_true')
+        parser.add_argument('--updated-field',
+                            help='date field to catch up the docs updated during the reindex')
+        parser.add_argument('--tolerance', type=int, default=0,
+                            help='max docs count difference to still swap')
+        parser.add_argument('--force', action='store_true', help='swap even if the counts differ')
+
+        parser.add_argument('name', help='alias or index to reindex')
+
+        self.args = parser.parse_args(argv[1:])
+        self.parser = parser
+
+    def run(self):
+        log.basicConfig(level=logging.INFO)
+        ES.setup(slovar({'es.urls': self.args.urls}))
+
+        mapping = None
+        if self.args.mapping:
+            with open(self.args.mapping) as f:
+                mapping = json.load(f)
+
+        try:
+            stats = Reindexer(self.args.name,
+                              new_index=self.args.new_index,
+                              mapping=mapping,
+                              slices=self.args.slices,
+                              poll_interval=self.args.poll,
+                              keep_source=not self.args.drop_source,
+                              updated_field=self.args.updated_field,
+                              tolerance=self.args.tolerance,
+                              force=self.args.force).run(swap=not self.args.no_swap)
+        except (DKeyError, DValueError) as e:
+            sys.exit('error: %s' % e)
+
+        print(json.dumps(stats, indent=4))
+
+
+def run():
+    Script(sys.argv).run()
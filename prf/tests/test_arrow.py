@@ -0,0 +1,68 @@
+import io
+import mock
+import pytest
+from datetime import datetime
+from slovar import slovar
+
+pa = pytest.importorskip('pyarrow')
+
+from prf import arrow
+
+
+def items():
+    return [slovar(id=1, name='a', score='1.5', at='2020-01-02T00:00:00', geo={'lat': 1.0}),
+            slovar(id=2, name=None, score=2, at=datetime(2020, 1, 3), extra='x')]
+
+
+class TestArrow(object):
+
+    def test_ipc_stream(self):
+        data = items()
+        data[1].pop('extra')
+
+        chunks = list(arrow.iter_arrow(data, types={'score': 'double', 'at': 'date'},
+                                       chunk_rows=1))
+        assert len(chunks) == 3
+
+        table = pa.ipc.open_stream(b''.join(chunks)).read_all()
+        assert table.column_names == ['at', 'geo.lat', 'id', 'name', 'score']
+        assert table.schema.field('score').type == pa.float64()
+        assert table.schema.field('at').type == pa.timestamp('ms')
+        assert table.schema.field('id').type == pa.int64()
+        assert table.column('score').to_pylist() == [1.5, 2.0]
+        assert table.column('at').to_pylist() == [datetime(2020, 1, 2), datetime(2020, 1, 3)]
+
+    def test_schema_errors(self):
+        with pytest.raises(ValueError) as e:
+            list(arrow.iter_arrow(items(), chunk_rows=1))
+        assert 'extra' in str(e.value)
+
+        with pytest.raises(ValueError):
+            list(arrow.iter_arrow([{'a': 1}, {'a': 'x'}], chunk_rows=1))
+
+        with pytest.raises(ValueError):
+            list(arrow.iter_arrow([{'a': 1}, {'a': 1.5}], chunk_rows=1))
+
+        body = b''.join(arrow.iter_arrow([{'a': 1}, {'a': 2.0}, {'a': None}], chunk_rows=1))
+        assert pa.ipc.open_stream(body).read_all().column('a').to_pylist() == [1, 2, None]
+
+    def test_parquet_columns(self):
+        import pyarrow.parquet as pq
+
+        body = b''.join(arrow.iter_arrow(items(), columns=['id', 'extra'], format_='parquet'))
+        table = pq.read_table(io.BytesIO(body))
+        assert table.to_pylist() == [{'id': 1, 'extra': None}, {'id': 2, 'extra': 'x'}]
+
+    def test_mongo_field_types(self):
+        import mongoengine as mongo
+
+        class Address(mongo.EmbeddedDocument):
+            zip = mongo.IntField()
+
+        class User(mongo.Document):
+            name = mongo.StringField()
+            address = mongo.EmbeddedDocumentField(Address)
+
+        types = arrow.backend_field_types(mock.Mock(_document=User))
+        assert types['name'] == 'StringField'
+        assert types['address.zip'] == 'IntField'
@@ -0,0 +1,50 @@
+import pytest
+from datetime import datetime
+from decimal import Decimal
+from bson import ObjectId
+from slovar import slovar
+
+from prf.utils import utils
+
+pytest.importorskip('pytest_benchmark')
+
+
+def payload(count=1000):
+    #shaped like `BaseView._process` output for a mongo collection
+    return {
+        'total': 123456,
+        'count': count,
+        'query': {'_limit': count, 'status': 'active'},
+        '_meta': slovar(took=12),
+        'data': [slovar({
+            'id': ObjectId(),
+            'self': 'http://localhost/api/users/%s' % ix,
+            'name': 'user %s' % ix,
+            'email': 'user%s@example.com' % ix,
+            'score': Decimal('12.5'),
+            'tags': ['a', 'b', 'c'],
+            'created_at': datetime.utcnow(),
+            'address': slovar(city='Yerevan', zip='0010', geo=[40.18, 44.51]),
+        }) for ix in range(count)]
+    }
+
+
+@pytest.fixture(params=['json', 'orjson'])
+def backend(request):
+    if request.param == 'orjson' and not utils.orjson:
+        pytest.skip('orjson is not installed')
+
+    orig = utils.json_backend
+    yield utils.set_json_backend(request.param)
+    utils.json_backend = orig
+
+
+def test_json_backends_match(backend):
+    import json
+    data = payload(10)
+    assert json.loads(backend.dumpb(data)) == json.loads(utils.JSONBackend().dumpb(data))
+
+
+def test_bench_json_dumpb(benchmark, backend):
+    benchmark.group = 'json_dumpb'
+    benchmark(backend.dumpb, payload())
@@ -0,0 +1,47 @@
+import pytest
+
+from prf.utils import utils, Params
+
+pytest.importorskip('pytest_benchmark')
+
+
+def query():
+    #typical GET query string after `request.params.mixed()`
+    return Params({
+        'status': 'active',
+        'address.city': 'Yerevan',
+        'age__gte__asint': '21',
+        'tags__in': 'a,b,c',
+        'score__asfloat': '12.5',
+        'deleted_at': 'null',
+        '_sort': '-created_at,name',
+        '_fields': 'name,email,address.city',
+        '_limit': '50',
+        '_page': '2',
+    })
+
+
+def test_typecast_keys_cached():
+    utils.compile_typecast_key.cache_clear()
+    utils.parse_specials(utils.typecast(query()))
+    misses = utils.compile_typecast_key.cache_info().misses
+
+    params, specials = utils.parse_specials(utils.typecast(query()))
+
+    assert params == {'status': 'active', 'address__city': 'Yerevan', 'age__gte': 21,
+                      'tags__in': ['a', 'b', 'c'], 'score': 12.5, 'deleted_at': None}
+    assert specials._sort == ['-created_at', 'name']
+    assert specials._start == 100 and specials._limit == 50 and specials._end == 150
+
+    assert utils.compile_typecast_key.cache_info().misses == misses
+
+
+def test_bench_typecast(benchmark):
+    benchmark.group = 'params'
+    benchmark(utils.typecast, query())
+
+
+def test_bench_parse_specials(benchmark):
+    benchmark.group = 'params'
+    params = utils.typecast(query())
+    benchmark(utils.parse_specials, params)
@@ -0,0 +1,39 @@
+import mock
+import pytest
+from slovar import slovar
+from pyramid import testing
+
+from prf.view import BaseView
+
+pytest.importorskip('pytest_benchmark')
+
+
+def page(count=10000):
+    return [{
+        'id': ix,
+        'name': 'user %s' % ix,
+        'tags': ['a', 'b'],
+        'empty': '',
+        'address': {'city': 'Yerevan', 'zip': '0010', 'geo': {'lat': 40.18, 'lon': 44.51}},
+    } for ix in range(count)]
+
+
+@pytest.fixture(params=[0, 1000], ids=['per_item', 'bulk'])
+def view(request):
+    testing.setUp(settings={'prf.bulk_projection.min_items': request.param})
+
+    params = {'_flat': '*', '_flat_keep_lists': 1, '_fields': 'id,address', '_pop_empty': 1}
+    req = testing.DummyRequest(params=params)
+    req.params = slovar({'mixed': lambda: params})
+    req.content_type = 'application/json'
+    req.accept = 'application/json'
+
+    yield BaseView({}, req)
+    testing.tearDown()
+
+
+def test_bench_serialize_page(benchmark, view):
+    benchmark.group = 'serialize_page'
+    data, _, _ = benchmark(view.serialize, page(), True)
+    assert data[0] == {'id': 0, 'address.city': 'Yerevan', 'address.zip': '0010',
+                       'address.geo.lat': 40.18, 'address.geo.lon': 44.51}
@@ -0,0 +1,173 @@
+import time
+import mock
+from webtest import TestApp
+from pyramid.config import Configurator
+
+from prf.cache import ResponseCache, SqliteStore, SingleFlight, same_branch
+
+
+def make_app(**settings):
+    calls = []
+
+    def users(request):
+        calls.append(request.params.mixed())
+        if 'private' in request.params:
+            request.response.cache_control.private = True
+        if 'big' in request.params:
+            return {'n': len(calls), 'big': 'x' * 200}
+        return {'n': len(calls)}
+
+    def create_user(request):
+        return {}
+
+    settings.setdefault('response_cache.ttl', 60)
+    conf = Configurator(settings=settings)
+    conf.add_route('users', '/users')
+    conf.add_view(users, route_name='users', request_method='GET', renderer='json')
+    conf.add_view(create_user, route_name='users', request_method='POST', renderer='json')
+    conf.add_tween('prf.tweens.response_cache')
+
+    return TestApp(conf.make_wsgi_app()), calls
+
+
+class TestResponseCache(object):
+
+    def test_same_branch(self):
+        assert same_branch('/users', '/users/1/posts')
+        assert same_branch('/users/1', '/users')
+        assert not same_branch('/users', '/users_x')
+
+    def test_hit_and_normalized_key(self):
+        app, calls = make_app()
+
+        resp = app.get('/users?_sort=x&a=1&b=2')
+        assert resp.headers['X-Cache'] == 'MISS'
+
+        resp = app.get('/users?b=2&a=1&_s=x')
+        assert resp.headers['X-Cache'] == 'HIT'
+        assert resp.json == {'n': 1}
+        assert len(calls) == 1
+
+        app.get('/users?a=2')
+        assert len(calls) == 2
+
+        app.get('/users?_sort=x&a=1&b=2', headers={'Cache-Control': 'no-cache'})
+        assert len(calls) == 3
+
+    def test_not_cached(self):
+        app, calls = make_app(**{'response_cache.max_body_size': 100})
+
+        app.get('/users', headers={'Accept': 'application/json'})
+        app.get('/users', headers={'Accept': 'text/csv'})
+        assert len(calls) == 2
+
+        app.get('/users?private=1')
+        assert app.get('/users?private=1').headers['X-Cache'] == 'MISS'
+
+        app.get('/users?big=1')
+        assert app.get('/users?big=1').headers['X-Cache'] == 'MISS'
+
+        assert app.get('/users?small=1').headers['X-Cache'] == 'MISS'
+        assert app.get('/users?small=1').headers['X-Cache'] == 'HIT'
+
+    def test_purge_on_write(self):
+        app, calls = make_app()
+
+        app.get('/users')
+        app.post_json('/users', {'a': 1})
+        assert app.get('/users').headers['X-Cache'] == 'MISS'
+        assert len(calls) == 2
+
+    def test_stale_while_revalidate(self):
+        app, calls = make_app(**{'response_cache.ttl': 0, 'response_cache.stale': 60})
+
+        app.get('/users')
+        resp = app.get('/users')
+        assert resp.headers['X-Cache'] == 'STALE'
+        assert resp.json == {'n': 1}
+
+        for _ in range(50):
+            if len(calls) == 2:
+                break
+            time.sleep(0.01)
+        assert len(calls) == 2
+
+    def test_sqlite_store(self, tmpdir):
+        cache = ResponseCache(max_items=2, path=str(tmpdir.join('cache.db')))
+        request = mock.Mock(path='/users')
+        response = mock.Mock(status_code=200, headerlist=[('Content-Type', 'application/json')],
+                             body=b'{}')
+
+        for key in ['a', 'b', 'c']:
+            cache.set(key, request, response)
+            time.sleep(0.01)
+
+        assert cache.get('a') == (None, False)
+        entry, stale = cache.get('c')
+        assert entry.body == b'{}' and entry.headers == [['Content-Type', 'application/json']]
+
+        cache.purge('/users/1')
+        assert cache.get('c') == (None, False)
+
+
+class TestSingleFlight(object):
+
+    def run_concurrently(self, flight, func, n=5, timeout=5, copy=None):
+        import threading
+
+        results = []
+
+        def call():
+            try:
+                results.append(flight.do('key', func, timeout, copy=copy))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+
+        return results
+
+    def test_shared_result(self):
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'n': len(calls)}
+
+        results = self.run_concurrently(SingleFlight(), slow)
+        assert len(calls) == 1
+        assert results == [{'n': 1}] * 5
+
+    def test_copied_result(self):
+        import copy
+
+        def slow():
+            time.sleep(0.2)
+            return {'n': [1]}
+
+        results = self.run_concurrently(SingleFlight(), slow, copy=copy.deepcopy)
+        assert results == [{'n': [1]}] * 5
+        assert len(set(id(each['n']) for each in results)) == 5
+
+    def test_shared_error(self):
+        def fail():
+            time.sleep(0.2)
+            raise ValueError('boom')
+
+        results = self.run_concurrently(SingleFlight(), fail)
+        assert all(isinstance(each, ValueError) for each in results)
+
+    def test_timeout(self):
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.3)
+
+        self.run_concurrently(SingleFlight(), slow, n=3, timeout=0.05)
+        assert len(calls) == 3
@@ -23,3 +23,40 @@ class TestCSV():
         assert 'A\r\n1\r\n' == dict2tab([{'A':1}], 'a__as__A')
 
 
+
+    def render(self, data, accept='text/csv', **specials):
+        import mock
+        from prf.utils import TabRenderer, Params
+
+        request = mock.Mock(accept=[accept], environ={})
+        view = mock.Mock()
+        request.environ['prf.params'] = {view: (Params(), Params(specials))}
+
+        body = TabRenderer(None)({'data': iter(data)}, {'request': request, 'view': view})
+        body = b''.join(body)
+        return request.response.content_type, body if 'sheet' in accept else body.decode('utf-8')
+
+    def test_stream_csv(self):
+        data = [slovar(a=1, b={'c': datetime(2020, 1, 2)}), slovar(a=2, d=[1, 2])]
+
+        ctype, body = self.render(data)
+        assert ctype == 'text/csv'
+        assert body == 'a,b.c,d\r\n1,2020-01-02T00:00:00Z,\r\n2,,"[1, 2]"\r\n'
+
+        assert self.render(data, _csv_sample=1)[1] == 'a,b.c\r\n1,2020-01-02T00:00:00Z\r\n2,\r\n'
+        assert self.render(data, _csv_sample=1, _csv_schema='union')[1] == body
+        assert self.render(data, _csv_fields='a')[1] == 'a\r\n1\r\n2\r\n'
+
+    def test_stream_tsv(self):
+        ctype, body = self.render([slovar(a=1, b='x y')], _renderer='tsv')
+        assert ctype == 'text/tab-separated-values'
+        assert body == 'a\tb\r\n1\tx y\r\n'
+
+    def test_stream_xlsx(self):
+        from io import BytesIO
+        from prf.utils import XLSX_MIME
+        openpyxl = pytest.importorskip('openpyxl')
+
+        ctype, body = self.render([slovar(a=1)], accept=XLSX_MIME)
+        assert ctype == XLSX_MIME
+        assert list(openpyxl.load_workbook(BytesIO(body)).active.values) == [('a',), (1,)]
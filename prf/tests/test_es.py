@@ -0,0 +1,581 @@
+import mock
+import pytest
+from slovar import slovar
+
+pytest.importorskip('elasticsearch_dsl')
+
+from elasticsearch_dsl import Search
+from prf.es import ES, Aggregator
+from prf.utils import parse_specials
+from pyramid.httpexceptions import HTTPException
+import prf.exc
+
+
+@pytest.fixture
+def aggregator():
+    def _aggregator(**params):
+        _, specials = parse_specials(slovar(params))
+        with mock.patch.object(ES, 'get_doc_types', return_value=[]):
+            return Aggregator(specials, Search(index='test'), 'test')
+    return _aggregator
+
+
+@pytest.fixture
+def es():
+    #ES instance without the network calls of __init__
+    es = ES.__new__(ES)
+    es.index = es.name = 'test'
+    es.doc_types = []
+    return es
+
+
+@mock.patch('prf.es.ES.api', create=True)
+class TestAggregator(object):
+
+    def test_composite_transform(self, fake_api, aggregator):
+        agg = aggregator(_group='country,state', _composite=1, _limit=2)
+        results = agg.transform_composite({
+            'composite': {
+                'after_key': {'country': 'US', 'state': 'NY'},
+                'buckets': [
+                    {'key': {'country': 'US', 'state': 'CA'}, 'doc_count': 3},
+                    {'key': {'country': 'US', 'state': 'NY'}, 'doc_count': 1},
+                ]
+            }
+        })
+
+        assert [each.to_dict() for each in results] == [
+            {'country': 'US', 'state': 'CA', 'count': 3},
+            {'country': 'US', 'state': 'NY', 'count': 1},
+        ]
+        assert results._meta.after_key == {'country': 'US', 'state': 'NY'}
+
+    def test_composite_missing_bucket(self, fake_api, aggregator):
+        fake_api.search.return_value = {'aggregations': {'composite': {'buckets': []}}}
+
+        for version, missing in [[(6, 3), False], [(6, 4), True], [(7, 0), True]]:
+            agg = aggregator(_group='country', _composite=1, _limit=2)
+            with mock.patch.object(ES, 'version', slovar(major=version[0], minor=version[1])):
+                agg.do_group_composite()
+
+            source = agg.search_obj.to_dict()['aggs']['composite']['composite']['sources'][0]
+            assert ('missing_bucket' in source['country']['terms']) == missing
+
+    def test_composite_interval(self, fake_api, aggregator):
+        fake_api.search.return_value = {'aggregations': {'composite': {'buckets': []}}}
+
+        for version, interval, expected in [[6, 'month', 'interval'],
+                                            [7, 'month', 'calendar_interval'],
+                                            [7, '30m', 'fixed_interval']]:
+            agg = aggregator(_group='created__as__date_histogram', _interval=interval,
+                             _composite=1)
+            with mock.patch.object(ES, 'version', slovar(major=version, minor=0)):
+                agg.do_group_composite()
+
+            source = agg.search_obj.to_dict()['aggs']['composite']['composite']['sources'][0]
+            assert source['created__date_histogram']['date_histogram'] == {
+                'field': 'created', expected: interval, 'format': 'yyyy-MM-dd'}
+
+    def test_composite_after_key(self, fake_api, aggregator):
+        assert aggregator(_group='a').get_after_key() is None
+        assert aggregator(_group='a', _after='{"a": 1}').get_after_key() == {'a': 1}
+        assert aggregator(_group='a', _after={'a': 1}).get_after_key() == {'a': 1}
+
+        with pytest.raises(Exception):
+            aggregator(_group='a', _after='bad').get_after_key()
+
+
+class TestES(object):
+
+    def test_process_hits(self):
+        source = {'a': 1}
+        data = ES.process_hits([{'_source': source, '_index': 'test', '_id': 'x1', '_score': 1.0}])
+
+        assert data[0] is source
+        assert data[0] == {'a': 1, '_index': 'test', '_id': 'x1', '_score': 1.0, '_type': None}
+
+    def test_esdoc(self):
+        import copy
+        from prf.es import ESDoc
+
+        doc = ESDoc({'a': 1, '_id': 'x1', '_index': 'test'}, index='test', doc_types=[])
+        assert doc.a == 1
+        assert doc._meta._id == 'x1'
+        assert doc._meta._index == 'test'
+
+        doc.b = 2
+        assert doc.to_dict() == {'a': 1, 'b': 2, '_id': 'x1', '_index': 'test'}
+        assert isinstance(doc.to_dict(), slovar)
+        assert doc.to_dict() is doc.to_dict()
+        assert not hasattr(doc, '__dict__')
+
+        with pytest.raises(AttributeError):
+            doc.c
+
+        assert copy.copy(doc).to_dict() == doc.to_dict()
+
+
+class TestAsyncES(object):
+
+    def test_get_collection(self):
+        import asyncio
+        from prf.es import AsyncES
+
+        pytest.importorskip('aiohttp')
+
+        async def fake_coro(value):
+            return value
+
+        api = mock.MagicMock()
+        api.search.return_value = fake_coro({
+            'took': 1,
+            'hits': {'hits': [{'_source': {'a': 1}, '_index': 'test', '_id': 'x1'}]}
+        })
+        api.count.return_value = fake_coro({'count': 1})
+
+        es = AsyncES('test')
+        es.doc_types = []
+        es._alias_meta = {}
+
+        with mock.patch.object(AsyncES, 'api', api, create=True), \
+             mock.patch.object(AsyncES, 'settings', slovar(), create=True), \
+             mock.patch.object(AsyncES, '_version_checked', True):
+            results = asyncio.get_event_loop().run_until_complete(es.get_collection(a=1, _limit=1))
+
+        assert results.total == 1
+        assert results[0].a == 1
+        assert results[0]._meta._id == 'x1'
+
+    def test_flush_and_drop(self):
+        import asyncio
+        from prf.es import AsyncES
+
+        async def fake_bulk(api, data, **kw):
+            return 1, [{'index': {'_id': 2, 'status': 400}}]
+
+        async def fake_coro(value):
+            return value
+
+        api = mock.MagicMock()
+        api.indices.delete.return_value = fake_coro({})
+        listener = mock.Mock()
+        loop = asyncio.get_event_loop()
+
+        with mock.patch.object(AsyncES, 'api', api, create=True), \
+             mock.patch.object(AsyncES, 'settings', slovar(), create=True), \
+             mock.patch('elasticsearch.helpers.async_bulk', fake_bulk), \
+             mock.patch('prf.es.ES.flush_listeners', [listener]), \
+             mock.patch.dict(AsyncES._field_types, {'test': {'a': 'text'}}):
+            loop.run_until_complete(AsyncES.flush([{'_id': 1}, {'_id': 2}]))
+            listener.assert_called_once_with([{'_id': 1}])
+
+            assert 'test' not in ES._field_types
+            loop.run_until_complete(AsyncES('test').drop_collection())
+            assert 'test' not in AsyncES._field_types
+
+    def test_aggregator(self):
+        import asyncio
+        from prf.es import AsyncES, AsyncAggregator
+
+        async def fake_coro(value):
+            return value
+
+        api = mock.MagicMock()
+        api.search.side_effect = lambda **kw: fake_coro({'aggregations': {'total': {'value': 5}}})
+
+        _, specials = parse_specials(slovar(_group='a'))
+        agg = AsyncAggregator(specials, Search(index='test'), 'test', doc_types=[], alias={})
+
+        with mock.patch.object(AsyncES, 'api', api, create=True), \
+             mock.patch.object(AsyncES, 'version', slovar(major=6, minor=3, patch=0)):
+            assert agg.version.minor == 3
+            assert asyncio.get_event_loop().run_until_complete(agg.do_count()) == 5
+            asyncio.get_event_loop().run_until_complete(agg.check_total('too many'))
+
+
+@mock.patch('prf.es.ES.settings', slovar(), create=True)
+class TestESWrites(object):
+
+    def test_get_refresh(self):
+        assert ES.get_refresh() == 'true'
+        assert ES.get_refresh(False) == 'false'
+        assert ES.get_refresh('wait_for') == 'wait_for'
+        assert ES.get_refresh(default='false') == 'false'
+
+        with pytest.raises(ValueError):
+            ES.get_refresh('sometimes')
+
+    def test_process_bulk_errors(self):
+        data = [{'_id': 1}, {'_id': 2}, {'_id': 3}]
+        errors = [
+            {'update': {'_id': 1, 'status': 429}},
+            {'index': {'_id': 2, 'status': 400}},
+        ]
+
+        success, errors, retries = ES.process_bulk_errors(data, 1, errors)
+        assert retries == [{'_id': 1}]
+        assert errors == [{'index': {'_id': 2, 'status': 400}}]
+
+    @mock.patch('prf.es.ES.version', slovar(major=7, minor=0, patch=0))
+    @mock.patch('prf.es.ES.flush')
+    def test_save_many(self, fake_flush, es):
+        obj = mock.MagicMock()
+        obj._meta = slovar(_index='test', _id='x1', _type='_doc')
+
+        es.save_many([obj], {'a.b': 1}, refresh='wait_for')
+        actions, args = fake_flush.call_args[0]
+
+        assert actions == [{'_op_type': 'update', '_index': 'test', '_id': 'x1',
+                            'doc': {'a': {'b': 1}}, 'detect_noop': True}]
+        assert args == {'refresh': 'wait_for'}
+
+        es.delete_many([obj])
+        assert fake_flush.call_args[0][1] == {'refresh': 'false'}
+
+    @mock.patch('prf.es.ES.api', create=True)
+    def test_update_by_query(self, fake_api, es):
+        es.update_by_query({'a': 1}, {'b': 2}, refresh='wait_for')
+        kw = fake_api.update_by_query.call_args[1]
+
+        assert kw['body']['query'] == {'bool': {'filter': [{'term': {'a': 1}}]}}
+        assert kw['body']['script']['params'] == {'doc': {'b': 2}}
+        assert kw['refresh'] is True
+        assert kw['conflicts'] == 'proceed'
+
+
+MAPPING = {
+    'test': {
+        'mappings': {
+            'properties': {
+                'name': {'type': 'text', 'fields': {'raw': {'type': 'keyword'}}},
+                'age': {'type': 'integer'},
+                'tags': {'type': 'keyword'},
+                'location': {'type': 'geo_point'},
+                'items': {
+                    'type': 'nested',
+                    'properties': {
+                        'sku': {'type': 'keyword'},
+                    }
+                },
+                'status': {'type': 'keyword'},
+            }
+        }
+    }
+}
+
+
+@mock.patch('prf.es.ES.settings', slovar(), create=True)
+@mock.patch('prf.es.ES.get_meta', mock.MagicMock(return_value=MAPPING))
+class TestMappingAware(object):
+
+    def setup_method(self, method):
+        ES.reset_field_types()
+
+    @pytest.fixture(autouse=True)
+    def setup_es(self, es):
+        self.es = es
+
+    def search(self, **params):
+        _params, specials = parse_specials(slovar(params))
+        return self.es.build_search_object(_params, specials).to_dict()['query']['bool']['filter'][0]
+
+    def test_process_mapping(self):
+        fields = ES.process_mapping(MAPPING)
+
+        assert fields['name'] == {'type': 'text', 'nested': None, 'keyword': 'name.raw'}
+        assert fields['name.raw'].type == 'keyword'
+        assert fields['items'].nested == 'items'
+        assert fields['items.sku'] == {'type': 'keyword', 'nested': 'items', 'keyword': None}
+        assert fields['status'] == {'type': 'keyword', 'nested': None, 'keyword': None}
+
+    def test_empty_mapping_not_cached(self):
+        with mock.patch('prf.es.ES.get_meta', return_value={}):
+            assert ES.get_field_types('missing') == {}
+
+        assert ES.get_field_types('missing')['items'].nested == 'items'
+
+    def test_keyword_subfield(self):
+        assert self.search(name='Joe') == {'term': {'name.raw': 'Joe'}}
+        assert self.search(age=10) == {'term': {'age': 10}}
+
+    def test_terms(self):
+        assert self.search(tags='a,b') == {'terms': {'tags': ['a', 'b']}}
+        assert self.search(tags='a*,b')['bool']['should'][0] == {'prefix': {'tags': 'a'}}
+
+    def test_nested_detection(self):
+        assert self.search(items__sku='x') == {
+            'nested': {'path': 'items', 'query': {'term': {'items.sku': 'x'}}}}
+
+    def test_invalid_ops(self):
+        with pytest.raises(Exception):
+            self.search(age='1*')
+
+        with pytest.raises(Exception):
+            self.search(age__geobb='1,2,3,4')
+
+        self.search(location__geobb='1,2,3,4')
+
+
+@mock.patch('prf.es.ES.settings', slovar(mapping_aware=False), create=True)
+@mock.patch('prf.es.ES.api', create=True)
+class TestPaginate(object):
+
+    def page(self, *ids):
+        return {'_scroll_id': 'sid',
+                'hits': {'hits': [{'_source': {}, '_index': 'test', '_id': ix} for ix in ids]}}
+
+    def test_partial_last_page(self, fake_api, es):
+        fake_api.search.return_value = self.page(1, 2)
+        fake_api.scroll.side_effect = [self.page(3, 4), self.page(5, 6)]
+
+        pages = list(es.paginate(2, 5, slovar()))
+
+        assert [[each._id for each in page] for page in pages] == [[1, 2], [3, 4], [5]]
+        assert fake_api.search.call_args[1]['body']['size'] == 2
+        assert fake_api.search.call_args[1]['body']['sort'] == ['_doc']
+        fake_api.clear_scroll.assert_called_once_with(scroll_id='sid', ignore=(404,))
+
+    def test_zero_limit(self, fake_api, es):
+        assert list(es.paginate(2, 0, slovar())) == []
+        assert not fake_api.search.called
+        assert not fake_api.clear_scroll.called
+
+    def test_groups_count(self, fake_api, es):
+        with pytest.raises(HTTPException) as e:
+            list(es.get_collection_paged(2, _group='a', _composite=1, _count=1))
+
+        assert e.value.status_code == 400
+        assert not fake_api.search.called
+
+    def test_clear_on_early_exit(self, fake_api, es):
+        fake_api.search.return_value = self.page(1, 2)
+        fake_api.scroll.return_value = self.page(3, 4)
+
+        for page in es.paginate(2, -1, slovar()):
+            break
+
+        fake_api.clear_scroll.assert_called_once_with(scroll_id='sid', ignore=(404,))
+
+    def test_clear_on_error(self, fake_api, es):
+        fake_api.search.return_value = self.page(1, 2)
+        fake_api.scroll.side_effect = ValueError
+
+        with pytest.raises(ValueError):
+            list(es.paginate(2, -1, slovar()))
+
+        fake_api.clear_scroll.assert_called_once_with(scroll_id='sid', ignore=(404,))
+
+
+@mock.patch('prf.es.ES.api', create=True)
+class TestColumnarTransform(object):
+
+    AGGS = {
+        'country': {
+            'sum_other_doc_count': 0,
+            'buckets': [
+                {'key': 'US', 'doc_count': 3, 'state': {'buckets': [
+                    {'key': 'CA', 'doc_count': 2, 'age_avg': {'value': 30}},
+                    {'key': 'NY', 'doc_count': 1, 'age_avg': {'value': 40}},
+                ]}},
+                {'key': 'FR', 'doc_count': 1, 'state': {'buckets': [
+                    {'key': 'IDF', 'doc_count': 1, 'age_avg': {'value': 50}},
+                ]}},
+            ]
+        }
+    }
+
+    def test_rows(self, fake_api, aggregator):
+        agg = aggregator(_group='country,state', _agg_avg='age', _group_format='rows',
+                         _bucket_items='buckets.state__as__region')
+        results = agg.transform(self.AGGS)
+
+        assert results.total == 3
+        assert [each.to_dict() for each in results] == [
+            {'country': 'US', 'region': 'CA', 'count': 2, 'age_avg': 30},
+            {'country': 'US', 'region': 'NY', 'count': 1, 'age_avg': 40},
+            {'country': 'FR', 'region': 'IDF', 'count': 1, 'age_avg': 50},
+        ]
+
+    def test_columns(self, fake_api, aggregator):
+        agg = aggregator(_group='country,state', _group_format='columns')
+        results = agg.transform(self.AGGS)
+
+        assert results[0].to_dict() == {
+            'country': ['US', 'US', 'FR'],
+            'state': ['CA', 'NY', 'IDF'],
+            'count': [2, 1, 1],
+        }
+
+    def test_group_op(self, fake_api, aggregator):
+        agg = aggregator(_group='created__as__date_histogram', _interval='month',
+                         _group_format='rows')
+        agg.process_field(agg.specials._group[0])
+
+        results = agg.transform({'created__date_histogram': {'buckets': [
+            {'key': 1, 'key_as_string': '2020-01-01', 'doc_count': 2}]}})
+
+        assert [each.to_dict() for each in results] == [{'created': '2020-01-01', 'count': 2}]
+
+        agg = aggregator(_group='country', _group_format='rows', _raw_=1)
+        assert agg.transform(self.AGGS) is self.AGGS
+
+    def test_tree(self, fake_api, aggregator):
+        agg = aggregator(_group='country,state', _agg_avg='age',
+                         _bucket_items='buckets.state__as__region')
+        results = agg.transform(self.AGGS)
+
+        assert results[0].to_dict()['buckets'][0] == {'region': 'CA', 'count': 2, 'age_avg': 30}
+
+
+@mock.patch('prf.es.ES.settings', slovar(), create=True)
+@mock.patch('prf.es.ES.api', create=True)
+class TestSavedSearches(object):
+
+    def searches(self):
+        from prf.percolator import SavedSearches
+        return SavedSearches('tweets')
+
+    def test_match(self, fake_api):
+        fake_api.search.return_value = {'hits': {'hits': [
+            {'_id': 'mentions', 'fields': {'_percolator_document_slot': [0, 2]}},
+            {'_id': 'english', 'fields': {'_percolator_document_slot': [2]}},
+        ]}}
+
+        docs = [{'_id': 1, '_source': {'text': 'prf'}}, {'_id': 2, 'text': 'x'}, {'_id': 3, 'text': 'prf'}]
+        assert self.searches().match(docs) == {0: ['mentions'], 2: ['mentions', 'english']}
+
+        body = fake_api.search.call_args[1]['body']
+        assert body['query']['percolate']['documents'] == [{'text': 'prf'}, {'text': 'x'}, {'text': 'prf'}]
+        assert fake_api.search.call_count == 1
+
+    def test_match_pages(self, fake_api):
+        def hit(name):
+            return {'_id': name, 'sort': [name], 'fields': {'_percolator_document_slot': [0]}}
+
+        fake_api.search.side_effect = [
+            {'hits': {'hits': [hit('a'), hit('b')]}},
+            {'hits': {'hits': [hit('c')]}},
+        ]
+
+        from prf.percolator import SavedSearches
+
+        with mock.patch.object(SavedSearches, 'settings', slovar()), \
+             mock.patch.object(SavedSearches, 'matches_index', None):
+            SavedSearches.setup(slovar({'es.percolator.page_size': 2}))
+            assert self.searches().match([{'text': 'prf'}]) == {0: ['a', 'b', 'c']}
+
+        assert fake_api.search.call_args[1]['body']['search_after'] == ['b']
+
+    def test_includeme(self, fake_api):
+        from pyramid import testing
+        from prf.percolator import SavedSearches, includeme
+
+        config = testing.setUp(settings={'es.percolator.indices': 'tweets,news'})
+        try:
+            with mock.patch.dict(SavedSearches.registry, clear=True), \
+                 mock.patch.object(SavedSearches, 'settings', slovar()), \
+                 mock.patch('prf.es.ES.flush_listeners', []):
+                includeme(config)
+                assert sorted(SavedSearches.registry) == ['news', 'tweets']
+        finally:
+            testing.tearDown()
+
+        #no cluster calls until the searches are used
+        assert not fake_api.method_calls
+
+    @mock.patch('prf.es.ES.flush')
+    def test_on_flush(self, fake_flush, fake_api):
+        from prf.percolator import SavedSearches
+
+        searches = self.searches()
+        with mock.patch.dict(SavedSearches.registry, {'tweets': searches}):
+            with mock.patch.object(searches, 'match', return_value={0: ['mentions']}) as fake_match:
+                SavedSearches.on_flush([
+                    {'_index': 'tweets', '_id': 1, 'text': 'prf'},
+                    {'_index': 'tweets', '_id': 2, '_op_type': 'delete'},
+                    {'_index': 'other', '_id': 3},
+                ])
+
+        assert fake_match.call_args[0][0] == [{'_index': 'tweets', '_id': 1, 'text': 'prf'}]
+        actions = fake_flush.call_args[0][0]
+        assert actions[0]['_id'] == 'tweets:mentions:1'
+        assert actions[0]['_source']['doc_id'] == 1
+
+    def test_notify_flush(self, fake_api):
+        listener = mock.Mock()
+        with mock.patch('prf.es.ES.flush_listeners', [listener]):
+            ES.notify_flush([{'_id': 1}, {'_id': 2}, {'_id': 3}],
+                            [{'index': {'_id': 2, 'status': 400}}], [{'_id': 3}])
+
+        listener.assert_called_once_with([{'_id': 1}])
+
+
+@mock.patch('prf.es.ES.version', slovar(major=7, minor=0, patch=0))
+@mock.patch('prf.es.ES.api', create=True)
+class TestReindexer(object):
+
+    def reindexer(self, fake_api, **kw):
+        from prf.es_reindex import Reindexer
+
+        fake_api.indices.get_alias.return_value = {'tweets_v1': {'aliases': {'tweets': {}}}}
+        fake_api.indices.get_mapping.return_value = {'tweets_v1': {'mappings': {
+            'properties': {'text': {'type': 'text'}}}}}
+        fake_api.indices.get_settings.return_value = {'tweets_v1': {'settings': {'index': {
+            'uuid': 'x', 'number_of_shards': '3', 'number_of_replicas': '2'}}}}
+        fake_api.reindex.return_value = {'task': 'node:1'}
+        fake_api.tasks.get.return_value = {'completed': True, 'response': {'failures': []},
+            'task': {'status': {'total': 10, 'created': 10, 'updated': 0, 'deleted': 0}}}
+        fake_api.count.return_value = {'count': 10}
+
+        return Reindexer('tweets', new_index='tweets_v2', poll_interval=0, **kw)
+
+    def test_run(self, fake_api):
+        stats = self.reindexer(fake_api, mapping={'properties': {'lang': {'type': 'keyword'}}}).run()
+        assert stats.swapped and stats.done == 10
+
+        body = fake_api.indices.create.call_args[1]['body']
+        assert body['settings']['index'] == {'number_of_shards': '3',
+                                             'number_of_replicas': 0, 'refresh_interval': '-1'}
+        assert body['mappings']['properties'] == {'text': {'type': 'text'}, 'lang': {'type': 'keyword'}}
+
+        assert fake_api.indices.put_settings.call_args[1]['body'] == {
+            'index': {'refresh_interval': None, 'number_of_replicas': '2'}}
+        assert fake_api.indices.update_aliases.call_args[1]['body']['actions'] == [
+            {'add': {'index': 'tweets_v2', 'alias': 'tweets'}},
+            {'remove': {'index': 'tweets_v1', 'alias': 'tweets'}}]
+
+    def test_count_mismatch(self, fake_api):
+        reindexer = self.reindexer(fake_api)
+        fake_api.count.side_effect = [{'count': 10}, {'count': 9}]
+
+        assert not reindexer.run().swapped
+        assert not fake_api.indices.update_aliases.called
+
+    def test_tolerance(self, fake_api):
+        fake_api.count.side_effect = [{'count': 10}, {'count': 9}]
+        assert self.reindexer(fake_api, tolerance=1).run().swapped
+
+        fake_api.count.side_effect = [{'count': 10}, {'count': 8}]
+        assert self.reindexer(fake_api, force=True).run().swapped
+
+    def test_catch_up(self, fake_api):
+        stats = self.reindexer(fake_api, updated_field='updated_at').run()
+        assert stats.caught_up == 10
+
+        body = fake_api.reindex.call_args[1]['body']
+        assert 'gte' in body['source']['query']['range']['updated_at']
+        assert body['dest']['version_type'] == 'external'
+
+    def test_typed_mapping(self, fake_api):
+        reindexer = self.reindexer(fake_api, mapping={'properties': {'lang': {'type': 'keyword'}}})
+        mappings = reindexer.merge_mapping({'_doc': {'properties': {'text': {'type': 'text'}}}})
+
+        assert mappings == {'_doc': {'properties': {'text': {'type': 'text'},
+                                                    'lang': {'type': 'keyword'}}}}
+
+    def test_not_found(self, fake_api):
+        from prf.es_reindex import Reindexer
+
+        fake_api.indices.get_alias.return_value = {}
+        with pytest.raises(KeyError):
+            Reindexer('tweets')
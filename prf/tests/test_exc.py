@@ -82,3 +82,9 @@ class TestExc(object):
             resource = res
         )
         assert out.json['resource'] == {'self': 'http://location', 'id': 1}
+
+    def test_not_modified(self):
+        out = prf.exc.HTTPNotModified(headers=[('ETag', '"abc"')])
+        assert out.status_code == 304
+        assert out.etag == 'abc'
+        assert not out.body
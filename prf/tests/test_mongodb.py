@@ -9,3 +9,102 @@ class TestMongoDB(PrfTestCase):
         super(TestMongoDB, self).setUp()
         self.drop_databases()
 
+
+
+class FakeCursor(object):
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+
+class TestAsyncMongo(object):
+
+    def get_doc_cls(self):
+        import mongoengine as mongo
+        from prf.mongodb import DynamicBase
+
+        class AsyncUser(DynamicBase):
+            name = mongo.StringField(db_field='n')
+            age = mongo.IntField()
+
+        return AsyncUser
+
+    def test_aget_collection(self):
+        import asyncio
+        import mock
+        from bson import ObjectId
+
+        AsyncUser = self.get_doc_cls()
+        collection = mock.MagicMock()
+
+        async def count_documents(query):
+            return 3
+
+        collection.count_documents = count_documents
+        collection.find.return_value = FakeCursor([{'_id': ObjectId(), 'n': 'bob'}])
+
+        with mock.patch.object(AsyncUser, 'get_motor_collection', return_value=collection):
+            results = asyncio.run(AsyncUser.aget_collection(
+                name='bob', age__gte=18, _sort='-age', _limit=1, _start=1, _fields='name'))
+
+        assert results._total == 3
+        assert results[0].name == 'bob'
+
+        query = collection.find.call_args[0][0]
+        kw = collection.find.call_args[1]
+        assert query == {'n': 'bob', 'age': {'$gte': 18}}
+        assert kw['sort'] == [('age', -1)]
+        assert kw['projection'] == {'n': 1}
+        assert kw['skip'] == 1 and kw['limit'] == 1
+
+        collection.find.return_value = FakeCursor([{'_id': ObjectId(), 'n': 'bob'}])
+        with mock.patch.object(AsyncUser, 'get_motor_collection', return_value=collection):
+            results = asyncio.run(AsyncUser.aget_collection(name='bob'))
+
+        assert len(results) == 1
+        kw = collection.find.call_args[1]
+        assert kw['skip'] == 0 and kw['limit'] == 0
+
+    def test_aget_group(self):
+        import asyncio
+        import mock
+
+        AsyncUser = self.get_doc_cls()
+        collection = mock.MagicMock()
+        collection.aggregate.return_value = FakeCursor([{'count': 2}])
+
+        with mock.patch.object(AsyncUser, 'get_motor_collection', return_value=collection):
+            total = asyncio.run(AsyncUser.aget_collection(_group='name', _count=1))
+
+        assert total == 2
+        assert collection.aggregate.call_args[0][0][-1] == {'$group': {'_id': None, 'count': {'$sum': 1}}}
+
+    def test_collection_version(self):
+        import mock
+        import mongoengine as mongo
+        from datetime import datetime
+        from prf.mongodb import DynamicBase
+
+        class VersionedUser(DynamicBase):
+            updated_at = mongo.DateTimeField(db_field='u')
+
+        collection = mock.MagicMock()
+        collection.estimated_document_count.return_value = 3
+        collection.find_one.return_value = {'u': datetime(2020, 1, 1)}
+
+        with mock.patch.object(VersionedUser, '_get_collection', return_value=collection), \
+             mock.patch.object(VersionedUser, 'check_indexes_exist') as fake_check:
+            assert VersionedUser.get_collection_version() == '3:2020-01-01 00:00:00'
+            VersionedUser.get_collection_version()
+
+        assert collection.find_one.call_args[1]['sort'] == [('u', -1)]
+        fake_check.assert_called_once_with(['updated_at'])
+
+        assert self.get_doc_cls().get_collection_version() is None
@@ -33,3 +33,30 @@ class TestPRF(PrfTestCase):
     def test_add_error_view(self):
         conf = Configurator(settings=self.settings)
         prf.add_error_view(conf, KeyError)
+
+    def test_add_batch_view(self):
+        from webtest import TestApp
+        import prf.exc
+
+        conf = Configurator(settings=self.settings)
+        prf.includeme(conf)
+        conf.add_batch_view()
+
+        conf.add_route('echo', '/echo')
+        conf.add_view(lambda request: dict(request.params), route_name='echo', renderer='json')
+        conf.add_route('url', '/url')
+        conf.add_view(lambda request: {'url': request.url}, route_name='url', renderer='json')
+        conf.add_route('fail', '/fail')
+        conf.add_view(lambda request: prf.exc.HTTPNotFound('nope'), route_name='fail')
+
+        app = TestApp(conf.make_wsgi_app())
+        resp = app.post_json('/_batch', {'requests': ['/echo?a=1', '/fail']})
+
+        assert resp.json[0] == {'url': '/echo?a=1', 'status': 200, 'body': {'a': '1'}}
+        assert resp.json[1]['status'] == 404
+
+        app.post_json('/_batch', {'requests': ['/_batch']}, status=400)
+
+        resp = app.post_json('/_batch', {'requests': ['/url']},
+                             extra_environ={'SCRIPT_NAME': '/api', 'HTTP_HOST': 'example.com'})
+        assert resp.json[0]['body'] == {'url': 'http://example.com/api/url'}
@@ -0,0 +1,61 @@
+import json
+import mock
+from slovar import slovar
+
+from prf.utils import Params
+from prf.renderers import NdjsonRenderer
+
+
+class TestNdjsonRenderer(object):
+
+    def render(self, value, **specials):
+        request = mock.Mock(environ={})
+        request.response.headers = {}
+        view = mock.Mock()
+        request.environ['prf.params'] = {view: (Params(), Params(specials))}
+
+        body = NdjsonRenderer(None)(value, {'request': request, 'view': view})
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+
+        return request.response, [json.loads(each) for each in body.decode('utf-8').splitlines()]
+
+    def test_collection(self):
+        value = {'total': 10, 'count': None, 'query': {'a': 1}, '_meta': slovar(),
+                 'data': iter([slovar(a=1), slovar(a=2)])}
+
+        response, lines = self.render(value)
+        assert response.content_type == 'application/x-ndjson'
+        assert response.headers['X-Total-Count'] == '10'
+        assert lines == [{'a': 1}, {'a': 2}]
+
+    def test_meta_line(self):
+        value = {'total': 10, 'query': {}, '_meta': {'took': 1}, 'data': iter([{'a': 1}])}
+
+        _, lines = self.render(value, _ndjson_meta=1)
+        assert lines == [{'a': 1},
+                         {'_meta': {'took': 1, 'total': 10, 'count': 1, 'query': {}}}]
+
+    def test_resource(self):
+        _, lines = self.render({'a': 1})
+        assert lines == [{'a': 1}]
+
+
+class TestArrowRenderer(object):
+
+    def test_render(self):
+        import pytest
+        from prf.renderers import ArrowRenderer
+        pa = pytest.importorskip('pyarrow')
+
+        request = mock.Mock(environ={}, accept=['application/vnd.apache.arrow.stream'])
+        view = mock.Mock()
+        request.environ['prf.params'] = {view: (Params(), Params(_fields=['a']))}
+        request.environ['prf.field_types'] = lambda: {'a': 'FloatField'}
+
+        body = ArrowRenderer(None)({'data': iter([{'a': 1, 'b': 2}])},
+                                   {'request': request, 'view': view})
+
+        assert request.response.content_type == 'application/vnd.apache.arrow.stream'
+        table = pa.ipc.open_stream(b''.join(body)).read_all()
+        assert table.to_pylist() == [{'a': 1.0}]
@@ -0,0 +1,82 @@
+import gzip
+import pytest
+from webob import Request
+from pyramid.config import Configurator
+from pyramid.response import Response
+
+
+def make_app(**settings):
+    def big(request):
+        response = Response(body=b'x' * 2000, content_type='application/json')
+        response.etag = 'abc'
+        return response
+
+    def small(request):
+        return Response(body=b'x' * 10, content_type='application/json')
+
+    def stream(request):
+        return Response(app_iter=iter([b'a' * 1000, b'b' * 1000]), content_type='text/csv')
+
+    conf = Configurator(settings=settings)
+    for name, view in [['big', big], ['small', small], ['stream', stream]]:
+        conf.add_route(name, '/' + name)
+        conf.add_view(view, route_name=name)
+    conf.add_tween('prf.tweens.compression')
+
+    wsgi_app = conf.make_wsgi_app()
+
+    class App(object):
+        #webtest decodes the bodies, so the tests call the wsgi app directly
+        def get(self, path, headers={}):
+            return Request.blank(path, headers=headers).get_response(wsgi_app)
+
+    return App()
+
+
+class TestCompression(object):
+
+    def test_gzip(self):
+        app = make_app(**{'compression.encodings': 'gzip'})
+
+        resp = app.get('/big', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.headers['ETag'] == 'W/"abc"'
+        assert gzip.decompress(resp.body) == b'x' * 2000
+
+        resp = app.get('/big')
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert resp.headers['ETag'] == '"abc"'
+
+        assert 'Content-Encoding' not in app.get('/big', headers={'Accept-Encoding': 'br'}).headers
+        assert 'Content-Encoding' not in app.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+
+    def test_weak_etag_matches(self):
+        request = Request.blank('/', headers={'If-None-Match': 'W/"abc"'})
+        assert 'abc' in request.if_none_match
+
+    def test_streaming(self):
+        app = make_app()
+
+        resp = app.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(resp.body) == b'a' * 1000 + b'b' * 1000
+
+    def test_route_settings(self):
+        app = make_app(**{'compression.routes.big.level': '0',
+                          'compression.routes.stream.encodings': 'gzip'})
+
+        assert 'Content-Encoding' not in app.get('/big', headers={'Accept-Encoding': 'gzip'}).headers
+
+        resp = app.get('/stream', headers={'Accept-Encoding': 'zstd, gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+
+    def test_zstd(self):
+        zstandard = pytest.importorskip('zstandard')
+        app = make_app()
+
+        resp = app.get('/stream', headers={'Accept-Encoding': 'gzip;q=0.5, zstd'})
+        assert resp.headers['Content-Encoding'] == 'zstd'
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(resp.body)
+        assert body == b'a' * 1000 + b'b' * 1000
@@ -11,6 +11,15 @@ class TestUtils(object):
         assert "1685-03-31T01:01:01" in json_dumps(
             dict(a=datetime(1685,0o3,31,0o1,0o1,0o1,0o1)))
 
+    def test_orjson_fallback(self):
+        if not orjson:
+            pytest.skip('orjson is not installed')
+
+        backend = OrjsonBackend()
+        assert backend.dumps({'a': [1, 2]}) == '{"a":[1,2]}'
+        assert backend.dumps({'a': float('nan')}) == '{"a":null}'
+        assert backend.dumps({'a': 2 ** 70}) == '{"a": %s}' % 2 ** 70
+
     def test_split_strip(self):
         assert split_strip('') == []
         assert split_strip('a,  ') == ['a']
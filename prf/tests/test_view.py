@@ -1,4 +1,8 @@
+import mock
+import copy
 import unittest
+from pyramid.threadlocal import manager
+from concurrent.futures import ThreadPoolExecutor
 from slovar import slovar
 
 from prf.view import BaseView
@@ -57,3 +61,260 @@ class TestView(PrfTestCase):
 
         with pytest.raises(ValueError):
             view._params = 'whatever the fuck I want'
+
+    def test_gather(self):
+        import time
+
+        request = self.request()
+        view = BaseView({}, request)
+
+        def slow():
+            time.sleep(0.2)
+            return 'slow'
+
+        started = time.time()
+        result = view.gather({'a': slow, 'b': slow, 'c': lambda: 1})
+
+        assert result == {'a': 'slow', 'b': 'slow', 'c': 1}
+        assert time.time() - started < 0.4
+        assert set(view._specials._meta.gather.keys()) == set(['a', 'b', 'c'])
+
+        def one():
+            return 1
+
+        view._specials._meta.gather.clear()
+        assert view.gather([lambda: 1, lambda: 2, one, slow, slow]) == [1, 2, 1, 'slow', 'slow']
+        assert set(view._specials._meta.gather.keys()) == set(['0', '1', 'one', '3', '4'])
+
+    def test_nested_gather(self):
+        request = self.request()
+        view = BaseView({}, request)
+
+        def nested():
+            return view.gather([lambda: 1, lambda: 2])
+
+        #more nested calls than pool workers must not deadlock
+        with mock.patch('prf.view._gather_pool', ThreadPoolExecutor(1, thread_name_prefix='prf-gather')):
+            assert view.gather([nested, nested], timeout=5) == [[1, 2], [1, 2]]
+
+    def test_gather_queued_timeout(self):
+        import time
+
+        request = self.request()
+        view = BaseView({}, request)
+
+        def slow():
+            time.sleep(0.2)
+            return 'slow'
+
+        #the second call waits for the only worker, that time does not count for its timeout
+        with mock.patch('prf.view._gather_pool', ThreadPoolExecutor(1, thread_name_prefix='prf-gather')):
+            assert view.gather([slow, slow], timeout=0.3) == ['slow', 'slow']
+
+    def test_gather_threadlocals(self):
+        from pyramid.threadlocal import get_current_request
+
+        request = self.request()
+        view = BaseView({}, request)
+
+        with mock.patch.dict(manager.get(), {'request': request}):
+            assert view.gather([get_current_request]) == [request]
+
+    def test_gather_errors(self):
+        import time
+        import pytest
+        from pyramid.httpexceptions import HTTPException
+
+        request = self.request()
+        view = BaseView({}, request)
+
+        with pytest.raises(HTTPException) as e:
+            view.gather({'fail': lambda: 1/0})
+        assert e.value.status_code == 500
+
+        with pytest.raises(HTTPException) as e:
+            view.gather({'slow': lambda: time.sleep(1)}, timeout=0.1)
+        assert e.value.status_code == 504
+
+    def test_etag(self):
+        request = self.request()
+        request.if_none_match = []
+        view = BaseView({}, request)
+        view.collection_version = mock.Mock(return_value='10:2')
+
+        view.index = mock.Mock(return_value=[{'a': 1}])
+        view._index()
+        etag = request.response.etag
+        assert etag
+
+        request.if_none_match = [etag]
+        resp = view._index()
+        assert resp.status_code == 304
+        assert view.index.call_count == 1
+
+        view.collection_version.return_value = '11:2'
+        view._index()
+        assert request.response.etag != etag
+        assert view.index.call_count == 2
+        assert 'Accept' in request.response.vary
+
+        etag = request.response.etag
+        request.override_renderer = 'tab'
+        request.headers['Accept'] = 'text/csv'
+        view._index()
+        assert request.response.etag != etag
+        assert view.index.call_count == 3
+
+    def test_single_flight(self):
+        request = self.request()
+        view = BaseView({}, request)
+        view.show = mock.Mock(return_value=[{'a': 1}])
+
+        with mock.patch('prf.view._single_flight') as fake_flight:
+            fake_flight.do.side_effect = lambda key, func, timeout, copy: func()
+            view._show()
+            assert not fake_flight.do.called
+
+            view._single_flight = True
+            view._show()
+            assert fake_flight.do.call_args[1] == {'copy': copy.deepcopy}
+
+    def test_params_cached(self):
+        from prf.utils import typecast
+
+        params = {'a': '1', '_sort': 'a'}
+        request = self.request(params=params)
+        request.query_string = 'a=1&_sort=a&test_params_cached'
+
+        with mock.patch('prf.view.typecast', side_effect=typecast) as fake_typecast:
+            view = BaseView({}, request)
+            view._params['b'] = 2
+            view._specials['_limit'] = 1
+
+            view = BaseView({}, request)
+            assert fake_typecast.call_count == 1
+            assert view._params == {'a': '1', '_sort': 'a', '_limit': 20}
+            assert view._specials._limit == 20
+            assert view._specials._sort == ['a']
+
+            request = self.request(params=params)
+            request.query_string = 'a=1&_sort=a&test_params_cached'
+            BaseView({}, request)
+            assert fake_typecast.call_count == 1
+
+            #what the renderers read is private to the request
+            from prf.utils import renderer_specials
+            renderer_specials({'request': request, 'view': BaseView})._sort.append('b')
+            request.environ['prf.params'][BaseView][1]._sort.append('c')
+
+            request = self.request(params=params)
+            request.query_string = 'a=1&_sort=a&test_params_cached'
+            assert BaseView({}, request)._specials._sort == ['a']
+
+    def test_streaming_index(self):
+        request = self.request(params={'_renderer': 'csv', '_fields': 'a'})
+        view = BaseView({}, request)
+        assert request.override_renderer == 'tab'
+        assert view.streaming
+
+        items = [{'a': 1, 'b': 1}, {'a': 2, 'b': 2}]
+        view.index = mock.Mock(return_value=items)
+        result = view._index()
+
+        assert not isinstance(result['data'], list)
+        assert result['total'] == 2 and result['count'] is None
+        assert list(result['data']) == [{'a': 1}, {'a': 2}]
+
+    def test_ndjson_pages(self):
+        request = self.request(params={'_renderer': 'ndjson'})
+        view = BaseView({}, request)
+        assert request.override_renderer == 'ndjson'
+
+        view.index = mock.Mock(return_value=iter([[{'a': 1}], [{'a': 2}, {'a': 3}]]))
+        result = view._index()
+        assert list(result['data']) == [{'a': 1}, {'a': 2}, {'a': 3}]
+
+    def test_bulk_projection(self):
+        from prf.utils import Params
+
+        items = [{'a': {'b': 1, 'c': {'d': ''}}, 'b': [1, {'c': 2}], 'e': '', 'f': 1},
+                 {'a': {}, 'b': [], 'f': {'g': None}},
+                 {'x': 1},
+                 {'a': {'x': 1}, 'a_b': 2, 'f': 3}]
+
+        for params in [{'_flat': '*'},
+                       {'_flat': '*', '_flat_keep_lists': 1},
+                       {'_flat': '*', '_fields': 'f,a', '_pop_empty': 1},
+                       {'_flat': '*', '_fields': 'b,x', '_flat_sep': '_'},
+                       {'_flat': '*', '_fields': 'f,a', '_flat_sep': '_', '_flat_keep_lists': 1},
+                       {'_flat': 'a,b'},
+                       {'_flat': 'b,f,a', '_flat_keep_lists': 1},
+                       {'_flat': 'f,x', '_fields': 'f,a,b', '_flat_sep': '_'}]:
+            request = self.request(params=params)
+            view = BaseView({}, request)
+
+            view.get_settings = mock.Mock(return_value=Params({'prf.bulk_projection.min_items': 0}))
+            expected, _, _ = view.serialize([dict(each) for each in items], many=True)
+
+            view.get_settings.return_value = Params({'prf.bulk_projection.min_items': 2})
+            assert view.compile_page_processor() is not None
+            data, _, _ = view.serialize([dict(each) for each in items], many=True)
+
+            #same keys in the same order
+            assert [list(each.items()) for each in data] == [list(each.items()) for each in expected]
+
+        for params in [{'_fields': 'a'}, {'_flat': 'a.b'}, {'_flat': '*', '_fields': 'a.b'}]:
+            view = BaseView({}, self.request(params=params))
+            assert view.compile_page_processor() is None
+
+    def test_compiled_serialize(self):
+        request = self.request(params={'_tr': 'prf.tests.test_view.Upper', '_fields': 'a,b'})
+        view = BaseView({}, request)
+
+        with mock.patch('prf.tests.test_view.Upper.__init__', return_value=None) as fake_init:
+            data, total, _ = view.serialize([{'a': 'x', 'b': 'y', 'c': 'z'}] * 3, many=True)
+
+        assert fake_init.call_count == 1
+        assert data == [{'a': 'X', 'b': 'Y'}] * 3
+
+
+class Upper(object):
+    def __call__(self, item):
+        return slovar((kk, vv.upper()) for kk, vv in item.items())
+
+
+class TestAddMeta(object):
+
+    def setup_method(self, method):
+        from pyramid import testing
+        testing.setUp(settings={})
+
+    def teardown_method(self, method):
+        from pyramid import testing
+        testing.tearDown()
+
+    def view(self, params={}):
+        from pyramid import testing
+
+        request = testing.DummyRequest(params=params)
+        request.params = slovar({'mixed': lambda: params})
+        request.content_type = 'application/json'
+        request.accept = 'application/json'
+        request.current_route_url = mock.Mock(return_value='http://localhost/users?_limit=2')
+
+        return BaseView({}, request)
+
+    @mock.patch('prf.view.BaseView.resource', new_callable=mock.PropertyMock)
+    def test_self_links(self, fake_resource):
+        fake_resource.return_value = mock.Mock(id_name='id')
+        view = self.view()
+        data = view.add_meta([{'id': 'a b'}, {'id': 2}])
+
+        assert data == [{'id': 'a b', 'self': 'http://localhost/users/a%20b'},
+                        {'id': 2, 'self': 'http://localhost/users/2'}]
+        assert view.request.current_route_url.call_count == 1
+
+    def test_no_links(self):
+        view = self.view({'_links': '0'})
+        assert view.add_meta([{'id': 1}]) == [{'id': 1}]
+        assert not view.request.current_route_url.called
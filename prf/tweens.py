@@ -153,13 +153,198 @@ def cache_control(handler, registry):
             if 'Cache-Control' in header:
                 add_header = False
         if add_header:
-            response.cache_expires(0)
+            if response.etag:
+                #cacheable, but clients must revalidate with If-None-Match
+                response.headers['Cache-Control'] = 'no-cache'
+            else:
+                response.cache_expires(0)
 
         return response
 
     return cache_control
 
 
+def response_cache(handler, registry):
+    '''
+    Caches 200 GET responses, see `prf.cache.ResponseCache` for the settings.
+    `Cache-Control: no-cache` in the request skips the cache.
+    '''
+    from slovar import slovar
+    from pyramid.response import Response
+    from prf.cache import ResponseCache, cache_key
+
+    cache = ResponseCache.from_settings(slovar(registry.settings))
+    registry['prf.response_cache'] = cache
+
+    log.info('response_cache enabled: ttl=%s, stale=%s, store=%s',
+             cache.ttl, cache.stale, cache.store.__class__.__name__)
+
+    def response_cache(request):
+        if request.method in ['POST', 'PUT', 'PATCH', 'DELETE']:
+            response = handler(request)
+            if 200 <= response.status_code < 300:
+                cache.purge(request.path)
+            return response
+
+        if request.method != 'GET':
+            return handler(request)
+
+        key = cache_key(request)
+        revalidating = request.environ.get('prf.response_cache.revalidate')
+
+        if not revalidating and 'no-cache' not in request.headers.get('Cache-Control', ''):
+            entry, stale = cache.get(key)
+            if entry:
+                if stale:
+                    cache.revalidate(key, request)
+
+                response = Response(body=entry.body, status=entry.status,
+                                    headerlist=[tuple(each) for each in entry.headers])
+                response.headers['X-Cache'] = 'STALE' if stale else 'HIT'
+                return response
+
+        response = handler(request)
+
+        if cache.cacheable(response):
+            cache.set(key, request, response)
+
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    return response_cache
+
+
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+#already compressed, not worth compressing again
+COMPRESSION_SKIP_TYPES = ['image/', 'video/', 'audio/', 'application/zip', 'application/gzip',
+                          'application/vnd.apache.parquet',
+                          'application/vnd.openxmlformats-officedocument']
+
+
+def get_compressor(encoding, level):
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    import zlib
+    #wbits=31 writes the gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def iter_compressed(app_iter, compressor):
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def compression(handler, registry):
+    '''
+    Compresses the responses with the best `Accept-Encoding` match of `compression.encodings`
+    (default `zstd,gzip`, zstd needs `zstandard`). Streamed bodies are compressed chunk by chunk,
+    the others only if at least `compression.min_size` bytes.
+
+    Settings:
+        compression.encodings = zstd,gzip
+        compression.min_size = 1024
+        compression.gzip.level = 6
+        compression.zstd.level = 3
+        compression.routes.<route name>.encodings = gzip
+        compression.routes.<route name>.level = 1   #0 disables the compression for the route
+
+    List it above `prf.tweens.response_cache`, so the cache keeps the uncompressed bodies.
+    Compressible responses get `Vary: Accept-Encoding`, compressed ones a weak ETag, since
+    the bytes differ from the uncompressed representation.
+    '''
+    from slovar import slovar
+
+    settings = slovar(registry.settings).unflat().get('compression', slovar())
+
+    encodings = settings.aslist('encodings', default=['zstd', 'gzip'])
+    if 'zstd' in encodings:
+        try:
+            import zstandard
+        except ImportError:
+            log.warning('compression: zstandard is not installed, zstd disabled')
+            encodings.remove('zstd')
+
+    min_size = settings.asint('min_size', default=COMPRESSION_MIN_SIZE)
+    levels = {each: settings.get(each, slovar()).asint('level', default=COMPRESSION_LEVELS[each])
+              for each in COMPRESSION_LEVELS}
+    routes = settings.get('routes', slovar())
+
+    log.info('compression enabled: encodings=%s, min_size=%s', encodings, min_size)
+
+    def compression(request):
+        response = handler(request)
+
+        if request.method == 'HEAD' \
+                or response.status_code < 200 or response.status_code in [204, 304] \
+                or response.content_encoding \
+                or any(each in (response.content_type or '') for each in COMPRESSION_SKIP_TYPES):
+            return response
+
+        #the shared caches must not serve the compressed body to the clients without Accept-Encoding
+        vary = tuple(response.vary or ())
+        if 'Accept-Encoding' not in vary:
+            response.vary = vary + ('Accept-Encoding',)
+
+        if 'Accept-Encoding' not in request.headers:
+            return response
+
+        _encodings = encodings
+        _levels = levels
+
+        route = getattr(getattr(request, 'matched_route', None), 'name', None)
+        if route in routes:
+            route_settings = routes[route]
+            if 'encodings' in route_settings:
+                _encodings = [each for each in route_settings.aslist('encodings')
+                              if each in encodings]
+            if 'level' in route_settings:
+                level = route_settings.asint('level')
+                if not level:
+                    return response
+                _levels = dict.fromkeys(levels, level)
+
+        offers = request.accept_encoding.acceptable_offers(_encodings)
+        if not offers:
+            return response
+
+        encoding = offers[0][0]
+
+        if response.content_length is None:
+            #streamed by the renderer
+            compressor = get_compressor(encoding, _levels[encoding])
+            response.app_iter = iter_compressed(response.app_iter, compressor)
+            response.content_length = None
+
+        else:
+            if response.content_length < min_size:
+                return response
+
+            compressor = get_compressor(encoding, _levels[encoding])
+            response.body = compressor.compress(response.body) + compressor.flush()
+
+        response.content_encoding = encoding
+
+        #`If-None-Match` parses the weak ETags too, so the 304s still work
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.headers['ETag'] = 'W/' + etag
+
+        return response
+
+    return compression
+
+
 def ssl(handler, registry):
     log.info('ssl enabled')
 
@@ -1,5 +1,7 @@
 import logging
 from pyramid.view import view_config
+from pyramid.request import Request
+from pyramid.httpexceptions import HTTPException
 from pyramid.security import remember, forget, NO_PERMISSION_REQUIRED
 
 from slovar import slovar
@@ -132,6 +134,73 @@ class APIView(BaseView):
                     for r in list(self._get_routes().values())])}
 
 
+class BatchView(BaseView):
+    '''
+    Runs GET requests as sub-requests and returns their responses in one call.
+
+    POST /_batch {"requests": ["/users?_limit=10", "/users/1"]}
+    -> [{"url": "/users?_limit=10", "status": 200, "body": {...}}, ...]
+    '''
+
+    max_requests = 50
+    shared_headers = ['Authorization', 'Cookie', 'Accept', 'X-Requested-With']
+
+    def build_subrequest(self, url):
+        if not isinstance(url, str) or not url.startswith('/'):
+            raise prf.exc.HTTPBadRequest('`%s` is not a relative url' % url)
+
+        if url.split('?')[0].rstrip('/') == self.request.path.rstrip('/'):
+            raise prf.exc.HTTPBadRequest('Can not batch `%s`' % url)
+
+        headers = {}
+        for name in self.shared_headers:
+            if name in self.request.headers:
+                headers[name] = self.request.headers[name]
+
+        req = Request.blank(url, headers=headers, method='GET',
+                            base_url=self.request.application_url)
+        #share the auth context already resolved for this request
+        if 'REMOTE_USER' in self.request.environ:
+            req.environ['REMOTE_USER'] = self.request.environ['REMOTE_USER']
+        return req
+
+    def invoke(self, url, subrequest):
+        try:
+            resp = self.request.invoke_subrequest(subrequest, use_tweens=True)
+        except HTTPException as e:
+            resp = e
+        except Exception as e:
+            log.error('batch `%s` failed: %s', url, e)
+            return slovar(url=url, status=500, body={'detail': str(e)})
+
+        try:
+            body = resp.json_body
+        except ValueError:
+            body = resp.text
+
+        return slovar(url=url, status=resp.status_code, body=body)
+
+    def create(self):
+        settings = self.get_settings(self.request)
+        urls = self._params.aslist('requests')
+
+        max_requests = settings.asint('prf.batch.max_requests', default=self.max_requests)
+        if len(urls) > max_requests:
+            raise prf.exc.HTTPBadRequest('Max %s requests per batch. Got %s'
+                                         % (max_requests, len(urls)))
+
+        calls = []
+        for url in urls:
+            subrequest = self.build_subrequest(url)
+            calls.append(lambda url=url, subrequest=subrequest: self.invoke(url, subrequest))
+
+        #GETs are safe to run concurrently
+        if settings.asbool('prf.batch.concurrent', default=True):
+            return self.gather(calls)
+
+        return [call() for call in calls]
+
+
 class AccountView(BaseView):
     _default_params = {
         '_limit': 20
@@ -1,13 +1,13 @@
 from slovar import process_fields
-from prf.utils.utils import (JSONEncoder, json_dumps,
+from prf.utils.utils import (JSONEncoder, json_dumps, json_dumpb, set_json_backend,
                              process_limit, snake2camel, camel2snake,
-                             maybe_dotted, parse_specials,typecast,
+                             maybe_dotted, parse_specials,typecast, flat_dict,
                              with_metaclass, resolve_host_to,
                              split_strip, sanitize_url, to_dunders, validate_url, is_url,
                              chunks, encoded_dict, urlencode, pager, dl2ld, d2inv,
                              ld2dd, qs2dict, str2dt, str2rdt, TODAY, NOW, cleanup_url, raise_or_log, Params,
                              join, process_key, rextract, Throttler, get_dt_unique_name, urlify,
-                             dict2tab, TabRenderer
+                             dict2tab, TabRenderer, XLSX_MIME, renderer_specials, tab_headers
                             )
 from prf.utils.pandas import (
     get_csv_header, get_csv_total, get_json_total, get_json_total, csv2dict, json2dict,
@@ -1,4 +1,5 @@
 import re
+import copy
 import json
 import dateutil
 import logging
@@ -9,7 +10,7 @@ from bson import ObjectId
 from urllib.parse import urlparse, parse_qs, parse_qsl
 from datetime import date, datetime
 import requests
-from functools import partial
+from functools import partial, lru_cache
 from time import time, sleep
 
 from slovar.strings import split_strip, str2dt, str2rdt
@@ -18,11 +19,27 @@ from slovar import slovar
 
 from prf.utils.errors import DValueError, DKeyError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
 
 OPERATORS = ['ne', 'lt', 'lte', 'gt', 'gte', 'in', 'all',
              'startswith', 'exists', 'range', 'geobb', 'size']
 
+#typecast operator -> cast it runs
+TYPECAST_OPS = dict(
+    [(op, 'aslist') for op in ('in', 'nin', 'all')] +
+    [(op, 'asint') for op in ('exists', 'size', 'max_distance', 'min_distance', 'empty')] +
+    [('near', 'near')] +
+    [(op, op) for op in ('asbool', 'asint', 'asfloat', 'asstr', 'aslist',
+                         'asset', 'asdt', 'asobj', 'asdtob')]
+)
+
+TYPECAST_KEYS_CACHE_SIZE = 4096
+
 
 class Params(slovar):
     'Subclass of slovar that will raise D* exceptions'
@@ -36,18 +53,82 @@ class Params(slovar):
         return DKeyError(e)
 
 
+def json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat().split(".")[0]
+    #ObjectId, DBRef, Decimal and anything else
+    return str(obj)
+
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, (datetime, date)):
-            return obj.isoformat().split(".")[0]
+        return json_default(obj)
+
+
+class JSONBackend(object):
+    '''stdlib json encoding, see `set_json_backend`'''
+    name = 'json'
+
+    def dumps(self, body):
+        return json.dumps(body, cls=JSONEncoder)
+
+    def dumpb(self, body):
+        return self.dumps(body).encode('utf-8')
+
+
+class OrjsonBackend(JSONBackend):
+    '''
+    orjson encoding. Datetimes go through `json_default` so the values match the stdlib backend,
+    but the output differs: no spaces after `,` and `:`, NaN and Infinity floats are null.
+    Bodies orjson can not encode (e.g. ints over 64 bits) fall back to the stdlib backend.
+    '''
+    name = 'orjson'
+
+    def __init__(self):
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, body):
+        return self.dumpb(body).decode('utf-8')
+
+    def dumpb(self, body):
         try:
-            return super(JSONEncoder, self).default(obj)
-        except TypeError:
-            return str(obj)  # fallback to unicode
+            return orjson.dumps(body, default=json_default, option=self.options)
+        except orjson.JSONEncodeError as e:
+            log.debug('orjson failed, using json: %s', e)
+            return JSONBackend.dumps(self, body).encode('utf-8')
+
+
+JSON_BACKENDS = {
+    'json': JSONBackend,
+    'orjson': OrjsonBackend,
+}
+
+json_backend = OrjsonBackend() if orjson else JSONBackend()
+
+
+def set_json_backend(name='auto'):
+    '''`auto` picks orjson when installed'''
+    global json_backend
+
+    if name == 'auto':
+        name = 'orjson' if orjson else 'json'
+
+    if name not in JSON_BACKENDS:
+        raise DValueError('Unknown json backend `%s`. Choices: %s' % (name, list(JSON_BACKENDS)))
+
+    if name == 'orjson' and not orjson:
+        raise DValueError('`orjson` json backend requires orjson package')
+
+    json_backend = JSON_BACKENDS[name]()
+    return json_backend
 
 
 def json_dumps(body):
-    return json.dumps(body, cls=JSONEncoder)
+    return json_backend.dumps(body)
+
+
+def json_dumpb(body):
+    return json_backend.dumpb(body)
 
 
 def process_limit(start, page, limit):
@@ -97,6 +178,22 @@ def process_key(key, suffix=''):
     return ('%s.%s' % (key, suffix) if suffix else key), (op if op in OPERATORS else '')
 
 
+def flat_dict(_dict, sep='.', keep_lists=True, prefix='', _flat=None):
+    '''same as `slovar.flat` on plain dicts, without building slovars'''
+    _flat = {} if _flat is None else _flat
+
+    for key, val in _dict.items():
+        if val and isinstance(val, list) and not keep_lists:
+            #list items are flattened by their position, e.g. `a.0`
+            flat_dict(dict(enumerate(val)), sep, keep_lists, '%s%s%s' % (prefix, key, sep), _flat)
+        elif isinstance(val, dict) and val:
+            flat_dict(val, sep, keep_lists, '%s%s%s' % (prefix, key, sep), _flat)
+        else:
+            _flat['%s%s' % (prefix, key)] = val
+
+    return _flat
+
+
 def parse_specials(orig_params):
     specials = Params(
         _sort=None,
@@ -119,49 +216,55 @@ def parse_specials(orig_params):
         _tr=None
     )
 
+    #one pass: `_` keys go to `_specials`, the rest is typecast into `params`
+    params = Params()
+    _specials = Params()
+
+    for key, val in orig_params.items():
+        if key.startswith('_'):
+            _specials[key] = val
+            continue
+
+        if '.' in key:
+            key = key.replace('.', '__')
+
+        params[key] = val
+        typecast_param(params, key)
+
     def short(name):
         _n = name[:2]
-        if _n in params:
+        if _n in _specials:
             return _n
         else:
             return name
 
-    params = orig_params.copy()
-
-    specials._sort = params.aslist(short('_sort'), default=[], pop=True)
-    specials._fields = params.aslist(short('_fields'), default=[], pop=True)
-    specials._flat = params.aslist(short('_flat'), default=[], pop=True)
-    specials._group = params.aslist(short('_group'), default=[], pop=True)
+    specials._sort = _specials.aslist(short('_sort'), default=[], pop=True)
+    specials._fields = _specials.aslist(short('_fields'), default=[], pop=True)
+    specials._flat = _specials.aslist(short('_flat'), default=[], pop=True)
+    specials._group = _specials.aslist(short('_group'), default=[], pop=True)
 
-    specials._count = short('_count') in params; params.pop(short('_count'), False)
+    specials._count = short('_count') in _specials; _specials.pop(short('_count'), False)
 
-    params.asint('_start', allow_missing=True)
-    params.asint('_page', allow_missing=True)
-    params.asint('_limit', allow_missing=True)
+    _specials.asint('_start', allow_missing=True)
+    _specials.asint('_page', allow_missing=True)
+    _specials.asint('_limit', allow_missing=True)
 
-    if not specials._count and params.get('_limit'):
+    if not specials._count and _specials.get('_limit'):
         specials._start, specials._limit = process_limit(
-                                        params.pop('_start', None),
-                                        params.pop('_page', None),
-                                        params.asint(short('_limit'), pop=True))
+                                        _specials.pop('_start', None),
+                                        _specials.pop('_page', None),
+                                        _specials.asint(short('_limit'), pop=True))
 
         specials._end = specials._start+specials._limit\
                          if specials._limit > -1 else None
 
-    specials._flat_keep_lists = params.asbool('_flat_keep_lists', default=False)
-    specials._flat_sep = params.asstr('_flat_sep', default='.')
-
-    specials._asdict = params.pop('_asdict', False)
-    specials._pop_empty = params.pop('_pop_empty', False)
-
-    for each in list(params.keys()):
-        if each.startswith('_'):
-            specials[each] = params.pop(each)
+    specials._flat_keep_lists = _specials.asbool('_flat_keep_lists', default=False)
+    specials._flat_sep = _specials.asstr('_flat_sep', default='.')
 
-        if '.' in each and each in params:
-            params[each.replace('.', '__')] = params.pop(each)
+    specials._asdict = _specials.pop('_asdict', False)
+    specials._pop_empty = _specials.pop('_pop_empty', False)
 
-    params = typecast(params)
+    specials.update(_specials)
 
     #deduce fields from the query
     if 'AUTO' in specials._fields:
@@ -175,75 +278,66 @@ def parse_specials(orig_params):
     return params, specials
 
 
-def typecast(params):
-    params = Params(params)
-
-    list_ops = ('in', 'nin', 'all')
-    int_ops = ('exists', 'size', 'max_distance', 'min_distance', 'empty')
-    geo_ops = ('near',)
-    types = ('asbool', 'asint', 'asfloat', 'asstr', 'aslist',
-                'asset', 'asdt', 'asobj', 'asdtob')
-
-
-    for key in list(params.keys()):
-        if params[key] == 'null':
-            params[key] = None
-            continue
+@lru_cache(maxsize=TYPECAST_KEYS_CACHE_SIZE)
+def compile_typecast_key(key):
+    '''
+    Returns (new_key, cast) for a param key or (key, None) if the key has no typecast operator.
+    `a__b__asint` -> (`a__b`, `asint`), `a__in` -> (`a__in`, `aslist`)
+    '''
+    parts = key.split('__')
+    if len(parts) <= 1:
+        return key, None
+
+    for part in reversed(parts):
+        if part in TYPECAST_OPS:
+            op = part
+            break
+    else:
+        return key, None
 
-        parts = key.split('__')
-        if len(parts) <= 1:
-            continue
+    cast = TYPECAST_OPS[op]
+    if cast != op:
+        #query operators keep their key
+        return key, cast
 
-        suf = []
-        op = ''
+    return '__'.join([e for e in parts if e != op]), cast
 
-        for ix in range(len(parts)-1, -1, -1):
-            part = parts[ix]
-            if part in list_ops+int_ops+geo_ops+types:
-                op = part
-                break
 
-        if not op:
-            continue
+def typecast_param(params, key):
+    if params[key] == 'null':
+        params[key] = None
+        return
 
-        new_key = '__'.join([e for e in parts if e != op])
+    new_key, cast = compile_typecast_key(key)
+    if not cast:
+        return
 
-        if op in geo_ops:
-            coords = params.aslist(key)
+    if cast == 'near':
+        coords = params.aslist(key)
 
-            try:
-                coords = [float(e) for e in coords]
-                if len(coords) != 2:
-                    raise ValueError
+        try:
+            coords = [float(e) for e in coords]
+            if len(coords) != 2:
+                raise ValueError
 
-            except ValueError:
-                raise DValueError('`near` operator takes pair of'
-                                ' numeric elements. Got `%s` instead' % coords)
+        except ValueError:
+            raise DValueError('`near` operator takes pair of'
+                            ' numeric elements. Got `%s` instead' % coords)
 
-            params[key] = coords
-            continue
+        params[key] = coords
 
-        if op in list_ops:
-            new_key = key
-            op = 'aslist'
+    elif cast == 'asobj':
+        params[new_key] = ObjectId(params.pop(key))
 
-        if op in int_ops:
-            new_key = key
-            op = 'asint'
+    else:
+        params[new_key] = getattr(params, cast)(key, pop=True)
 
-        if not op.startswith('as') and not op in types:
-            continue
 
-        if op == 'asobj':
-            params[new_key]=ObjectId(params.pop(key))
-            continue
+def typecast(params):
+    params = Params(params)
 
-        try:
-            method = getattr(params, op)
-            if isinstance(method, collections.Callable):
-                params[new_key] = method(key, pop=True)
-        except (KeyError, AttributeError) as e:
-            raise DValueError('Unknown typecast operator `%s`' % op)
+    for key in list(params.keys()):
+        typecast_param(params, key)
 
     return params
 
@@ -573,21 +667,42 @@ class Throttler:
             self.pause()
 
 
-def dict2tab(data, fields=None, format_='csv', skip_headers=False):
-    import tablib
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+TAB_CONTENT_TYPES = collections.OrderedDict([
+    ('csv', 'text/csv'),
+    ('tsv', 'text/tab-separated-values'),
+    ('xlsx', XLSX_MIME),
+    ('xls', 'text/xls'),
+])
 
-    def render(each, key):
-        val = each.get(key)
-        if isinstance(val, (datetime, date)):
-            val = val.strftime('%Y-%m-%dT%H:%M:%SZ')  # iso
+TAB_SAMPLE_SIZE = 100
+TAB_CHUNK_ROWS = 500
 
-        elif isinstance(val, (list, tuple)):
-            val = json.dumps(val)
 
-        if val is None:
-            val = ''
+def tab_value(val):
+    if isinstance(val, (datetime, date)):
+        val = val.strftime('%Y-%m-%dT%H:%M:%SZ')  # iso
 
-        return val
+    elif isinstance(val, (list, tuple)):
+        val = json.dumps(val)
+
+    if val is None:
+        val = ''
+
+    return val
+
+
+def tab_headers(fields):
+    headers = []
+    for each in split_strip(fields):
+        aa, _, bb = each.partition('__as__')
+        headers.append((bb or aa).split(':')[0])
+    return headers
+
+
+def dict2tab(data, fields=None, format_='csv', skip_headers=False):
+    import tablib
 
     data = data or []
 
@@ -597,10 +712,7 @@ def dict2tab(data, fields=None, format_='csv', skip_headers=False):
     headers = []
 
     if fields:
-        for each in split_strip(fields):
-            aa, _, bb = each.partition('__as__')
-            name = (bb or aa).split(':')[0]
-            headers.append(name)
+        headers = tab_headers(fields)
     else:
         #get the headers from the first item in the data.
         #Note, data IS schemaless, so other items could have different fields.
@@ -615,37 +727,172 @@ def dict2tab(data, fields=None, format_='csv', skip_headers=False):
             row = []
 
             for col in headers:
-                row.append(render(each, col))
+                row.append(tab_value(each.get(col)))
 
             tabdata.append(row)
 
         return getattr(tabdata, format_)
 
     except Exception as e:
+        import prf.exc as prf_exc
         log.error('Headers:%s, Format:%s\nData:%s',
                   tabdata.headers, format_, each)
         raise prf_exc.HTTPBadRequest('dict2tab error: %r' % e)
 
 
+def tab_schema(data, fields=None, schema='sample', sample=TAB_SAMPLE_SIZE):
+    '''
+    Returns (headers, data) for the streaming tab writers. Without `fields` the headers are the
+    flat keys of the first `sample` items, or of all items if `schema` is `union`.
+    `union` reads `data` twice: the items are spooled to a temp file, not kept in memory.
+    '''
+    import pickle
+    import tempfile
+    from itertools import islice, chain
+
+    if fields:
+        return tab_headers(fields), data
+
+    data = iter(data)
+    keys = set()
+
+    if schema != 'union':
+        head = list(islice(data, sample))
+        for each in head:
+            keys.update(slovar(each).flat(keep_lists=1).keys())
+        return sorted(keys), chain(head, data)
+
+    spool = tempfile.TemporaryFile()
+    for each in data:
+        keys.update(slovar(each).flat(keep_lists=1).keys())
+        pickle.dump(each, spool, pickle.HIGHEST_PROTOCOL)
+
+    def replay():
+        with spool:
+            spool.seek(0)
+            while True:
+                try:
+                    yield pickle.load(spool)
+                except EOFError:
+                    return
+
+    return sorted(keys), replay()
+
+
+def tab_rows(headers, data):
+    for each in data:
+        each = slovar(each).flat(keep_lists=1)
+        yield [tab_value(each.get(col)) for col in headers]
+
+
+def iter_csv(headers, data, delimiter=',', skip_headers=False, chunk_rows=TAB_CHUNK_ROWS):
+    '''yields utf-8 csv chunks of `chunk_rows` rows as `data` is iterated'''
+    import csv
+
+    class Line(object):
+        #`writerow` returns what `write` returns
+        def write(self, line):
+            return line
+
+    writer = csv.writer(Line(), delimiter=delimiter)
+    lines = [] if skip_headers else [writer.writerow(headers)]
+
+    for row in tab_rows(headers, data):
+        lines.append(writer.writerow(row))
+        if len(lines) >= chunk_rows:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+
+def iter_xlsx(headers, data, skip_headers=False, chunk_size=64*1024):
+    '''
+    writes `data` with a write-only openpyxl workbook into a temp file and yields the file
+    in chunks. Not streamed: nothing is sent before the last row is written.
+    '''
+    import tempfile
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+
+    if not skip_headers:
+        ws.append(headers)
+
+    for row in tab_rows(headers, data):
+        ws.append(row)
+
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield chunk
+
+
+def renderer_specials(system):
+    #parsed by the view already, see `BaseView.process_params`. renderers modify it, so copy.
+    request = system['request']
+    parsed = request.environ.get('prf.params', {})
+    if system['view'] in parsed:
+        return copy.deepcopy(parsed[system['view']][1])
+    return system['view'](None, request).process_params(request)[1]
+
+
 class TabRenderer(object):
+    '''
+    Renders the collection as csv, tsv, xlsx or xls, picked by `_renderer` or the Accept header.
+    csv and tsv rows are written as the items come from the view, see `BaseView.streaming`.
+    xlsx rows go to a temp file, sent once the workbook is complete (see `iter_xlsx`).
+
+    Specials:
+        _csv_fields: columns, default is the flat keys of the items
+        _csv_schema: `sample` (default) takes the columns from the first `_csv_sample` items,
+                     `union` from all items
+    '''
+
     def __init__(self, info):
         pass
 
     def __call__(self, value, system):
+        import prf.exc as prf_exc
 
         request = system.get('request')
         response = request.response
-        _, specials = system['view'](None, request).process_params(request)
+        specials = renderer_specials(system)
+
+        _format = specials.get('_renderer')
+        if _format not in TAB_CONTENT_TYPES:
+            for fmt, ctype in TAB_CONTENT_TYPES.items():
+                if ctype in request.accept:
+                    _format = fmt
+                    break
+            else:
+                raise prf_exc.HTTPBadRequest(
+                    'Unsupported Accept Header `%s`' % request.accept)
 
-        if 'text/csv' in request.accept:
-            response.content_type = 'text/csv'
-            _format = 'csv'
-        elif 'text/xls' in request.accept:
-            _format = 'xls'
-        else:
-            raise prf_exc.HTTPBadRequest(
-                'Unsupported Accept Header `%s`' % request.accept)
+        fields = specials.aslist('_csv_fields', default=[])
+        data = value.get('data', [])
+
+        if _format == 'xls':
+            return dict2tab(list(data or []), fields=fields, format_=_format)
+
+        if _format == 'xlsx':
+            try:
+                import openpyxl
+            except ImportError:
+                raise prf_exc.HTTPBadRequest('xlsx export requires openpyxl')
+
+        headers, data = tab_schema(data or [], fields=fields,
+                                   schema=specials.get('_csv_schema', 'sample'),
+                                   sample=specials.asint('_csv_sample', default=TAB_SAMPLE_SIZE))
+        if not headers:
+            return ''
+
+        response.content_type = TAB_CONTENT_TYPES[_format]
+
+        if _format == 'xlsx':
+            return iter_xlsx(headers, data)
 
-        return dict2tab(value.get('data', []),
-                        fields=specials.aslist('_csv_fields', default=[]),
-                        format_=_format)
+        return iter_csv(headers, data, delimiter='\t' if _format == 'tsv' else ',')
@@ -1,12 +1,19 @@
 import re
 import json
+import time
+import hashlib
 import logging
+import threading
 import urllib.request, urllib.parse, urllib.error
 from datetime import datetime
 import uuid
+import copy
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
 
 from pyramid.request import Request
 from pyramid.response import Response
+from pyramid.threadlocal import manager
+from pyramid.httpexceptions import HTTPException
 
 from slovar import slovar
 from slovar.utils import maybe_dotted
@@ -15,7 +22,8 @@ import prf.exc
 from prf.utils import json_dumps, urlencode
 from prf.serializer import DynamicSchema
 from prf import resource
-from prf.utils import typecast, Params, parse_specials
+from prf.utils import typecast, Params, parse_specials, process_fields, flat_dict, XLSX_MIME
+from prf.cache import SingleFlight, MemoryStore, cache_key
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +36,48 @@ CONSTANTS = {
 
 MAX_NB_PARAMS = 512
 MAX_QS_LENGTH = 8000
+GATHER_MAX_WORKERS = 16
+GATHER_TIMEOUT = 30
+GATHER_THREAD_PREFIX = 'prf-gather'
+BULK_PROJECTION_MIN_ITEMS = 1000
+
+SINGLE_FLIGHT_TIMEOUT = 30
+PARAMS_CACHE_SIZE = 1000
+
+#renderers that write the collection items as they are serialized
+STREAM_RENDERERS = ['tab', 'ndjson', 'arrow']
+TAB_FORMATS = ['csv', 'tsv', 'xlsx', 'tab']
+NDJSON_MIME = 'application/x-ndjson'
+ARROW_MIMES = ['application/vnd.apache.arrow.stream', 'application/vnd.apache.parquet']
+
+_gather_pool = None
+_gather_pool_lock = threading.Lock()
+_single_flight = SingleFlight()
+#parsed GET params and specials by view class and query string
+_params_cache = MemoryStore(PARAMS_CACHE_SIZE)
+
+
+def get_gather_pool(settings):
+    #one pool per process, shared by all views, so fan-outs can not exhaust the threads
+    global _gather_pool
+
+    with _gather_pool_lock:
+        if _gather_pool is None:
+            _gather_pool = ThreadPoolExecutor(
+                max_workers=settings.asint('prf.gather.max_workers', default=GATHER_MAX_WORKERS),
+                thread_name_prefix=GATHER_THREAD_PREFIX)
+
+    return _gather_pool
+
+
+def run_inline(call, *args):
+    #runs `call` right away, returning a done future like `executor.submit`
+    future = Future()
+    try:
+        future.set_result(call(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 
 class ViewMapper(object):
@@ -99,6 +149,8 @@ class BaseView(object):
     _default_params = {
         '_limit': 20
     }
+    #coalesce identical concurrent GETs, also enabled by `prf.single_flight.routes`
+    _single_flight = False
 
     def __init__(self, context, request):
         self.context = context
@@ -135,10 +187,18 @@ class BaseView(object):
         self.__params = Params(val)
 
     def set_renderer(self):
-        if self._params.get('_renderer') in ['csv', 'tab'] and self.request.method == 'GET':
+        if self._params.get('_renderer') in TAB_FORMATS and self.request.method == 'GET':
             self.request.override_renderer = 'tab'
             return
 
+        if self._params.get('_renderer') == 'ndjson' and self.request.method == 'GET':
+            self.request.override_renderer = 'ndjson'
+            return
+
+        if self._params.get('_renderer') in ['arrow', 'parquet'] and self.request.method == 'GET':
+            self.request.override_renderer = 'arrow'
+            return
+
         # no accept headers, use default
         if '' in self.request.accept:
             self.request.override_renderer = self._default_renderer
@@ -149,11 +209,51 @@ class BaseView(object):
         elif 'text/plain' in self.request.accept:
             self.request.override_renderer = 'string'
 
+        elif NDJSON_MIME in self.request.accept:
+            self.request.override_renderer = 'ndjson'
+
+        elif any(each in self.request.accept for each in ARROW_MIMES):
+            self.request.override_renderer = 'arrow'
+
         elif ('text/csv' in self.request.accept or
-                                         'text/xls' in self.request.accept):
+                'text/tab-separated-values' in self.request.accept or
+                'text/xls' in self.request.accept or
+                XLSX_MIME in self.request.accept):
             self.request.override_renderer = 'tab'
 
+    @property
+    def streaming(self):
+        return self.request.method == 'GET' and \
+                getattr(self.request, 'override_renderer', None) in STREAM_RENDERERS
+
     def process_params(self, request):
+        '''
+        Returns (params, specials). The result is kept in `request.environ['prf.params']`
+        per view class, so the renderers do not parse the params again, and GETs are
+        cached by query string.
+        '''
+        parsed = request.environ.setdefault('prf.params', {})
+        if type(self) not in parsed:
+            parsed[type(self)] = self._process_params(request)
+
+        _params, _specials = parsed[type(self)]
+        return copy.deepcopy(_params), copy.deepcopy(_specials)
+
+    def _process_params(self, request):
+        if request.method == 'GET':
+            settings = self.get_settings(request)
+            qs_limit = settings.asint('prf.request.max_qs_length', default=MAX_QS_LENGTH)
+
+            if len(request.query_string) > qs_limit:
+                raise prf.exc.HTTPRequestURITooLong('Max query string length is %s characters. Got %s' %
+                                    (qs_limit, len(request.query_string)))
+
+            #the cached entry is shared by the requests, they only get copies of it
+            key = (type(self), request.query_string)
+            cached = request.query_string and _params_cache.get(key)
+            if cached:
+                return copy.deepcopy(cached)
+
         ctype = request.content_type
 
         _params = Params(request.params.mixed())
@@ -170,22 +270,19 @@ class BaseView(object):
         _params = Params(typecast(_params))
 
         if request.method == 'GET':
-            settings = self.get_settings(request)
-
             param_limit = settings.asint('prf.request.max_params', default=MAX_NB_PARAMS)
-            qs_limit = settings.asint('prf.request.max_qs_length', default=MAX_QS_LENGTH)
 
             if len(_params) > param_limit:
                 raise prf.exc.HTTPRequestURITooLong('Max limit of params is %s. Got %s' %
                                     (param_limit, len(_params)))
 
-            if len(request.query_string) > qs_limit:
-                raise prf.exc.HTTPRequestURITooLong('Max query string length is %s characters. Got %s' %
-                                    (qs_limit, len(request.query_string)))
-
             _params = _params.merge_with(self._default_params)
 
         _, _specials = parse_specials(_params.copy())
+
+        if request.method == 'GET' and request.query_string:
+            _params_cache.set(key, copy.deepcopy((_params, _specials)))
+
         return _params, _specials
 
     def process_variables(self):
@@ -241,33 +338,170 @@ class BaseView(object):
                     log.error(msg)
         return item
 
-    def serialize(self, obj, many):
+    def compile_transform(self):
+        if type(self).transform_item is not BaseView.transform_item:
+            return self.transform_item
+
+        transformers = []
+        for tr in self._specials._tr:
+            try:
+                transformers.append([tr, maybe_dotted(tr)()])
+            except (TypeError, ImportError) as e:
+                raise prf.exc.HTTPBadRequest('`%s` transformer error: %s' % (tr, e))
+
+        if not transformers:
+            return None
+
+        def transform(item):
+            for tr, tr_obj in transformers:
+                try:
+                    item = tr_obj(item)
+                except TypeError as e:
+                    raise prf.exc.HTTPBadRequest('`%s` transformer error: %s' % (tr, e))
+            return item
+
+        return transform
+
+    def compile_extract(self):
+        if type(self).extract_item_fields is not BaseView.extract_item_fields:
+            return self.extract_item_fields
+
+        fields = self._specials._fields
+        if not fields:
+            return None
+
+        op = process_fields(fields)
+
+        #plain top level fields are picked directly, the rest goes through `extract`
+        if op.star or op.exclude or op.show_as or op.transforms or op.assignments \
+                or op.flats or op.unflats or op.envelope \
+                or any('.' in fld or '*' in fld for fld in op.exp_only):
+            return lambda item: item.extract(fields)
+
+        only = op.exp_only
+        return lambda item: slovar([[fld, item[fld]] for fld in only if fld in item])
+
+    def compile_item_processor(self):
+        '''
+        Compiles `_tr`, `_pop_empty`, `_fields` and `_flat` into one function applied to each item.
+        '''
+        specials = self._specials
+
+        transform = self.compile_transform()
+        extract = self.compile_extract()
+        pop_empty = specials._pop_empty
+
+        flat = specials._flat
+        if flat and '*' in flat:
+            flat = ''
+        flat_keep_lists = specials._flat_keep_lists
+        flat_sep = specials._flat_sep
 
         def process_dict(_d):
             _d = slovar(_d)
-            _d = self.transform_item(_d)
 
-            if self._specials._pop_empty:
+            if transform:
+                _d = transform(_d)
+
+            if pop_empty:
                 _d = _d.pop_by_values([[], {}, ''])
 
-            _d = self.extract_item_fields(_d)
+            if extract:
+                _d = extract(_d)
+
+            if specials._flat:
+                _d = _d.flat(flat, keep_lists=flat_keep_lists, sep=flat_sep)
+
+            return _d
 
-            if self._specials._flat:
-                if '*' in self._specials._flat:
-                    fl_keys = ''
+        return process_dict
+
+    def bulk_projection(self, items):
+        #page processor for the big pages of dicts, see `compile_page_processor`
+        min_items = self.get_settings(self.request).asint('prf.bulk_projection.min_items',
+                                                          default=BULK_PROJECTION_MIN_ITEMS)
+        if min_items <= 0 or len(items) < min_items:
+            return None
+
+        if not all(isinstance(each, dict) or hasattr(each, 'to_dict') for each in items):
+            return None
+
+        return self.compile_page_processor()
+
+    def compile_page_processor(self):
+        '''
+        Page version of `compile_item_processor` for the pages of at least
+        `prf.bulk_projection.min_items` items (0 disables it). Same output, key order included:
+        top level `_fields` are picked from plain dicts and flattened with `flat_dict`,
+        without building slovars and running `extract`/`flat` per item.
+        Only for `_flat=*` or top level `_flat` fields and top level `_fields`, otherwise None.
+        '''
+        specials = self._specials
+
+        if not specials._flat:
+            return None
+
+        flat_all = '*' in specials._flat
+        if not flat_all and any('.' in fld or '*' in fld for fld in specials._flat):
+            return None
+
+        if type(self).extract_item_fields is not BaseView.extract_item_fields:
+            return None
+
+        only = None
+        if specials._fields:
+            op = process_fields(specials._fields)
+            if op.star or op.exclude or op.show_as or op.transforms or op.assignments \
+                    or op.flats or op.unflats or op.envelope \
+                    or any('.' in fld or '*' in fld for fld in op.exp_only):
+                return None
+            only = op.exp_only
+
+        transform = self.compile_transform()
+        pop_empty = specials._pop_empty
+        flat_keys = specials._flat
+        keep_lists = specials._flat_keep_lists
+        sep = specials._flat_sep
+        empty = [[], {}, '']
+
+        def process_page(items):
+            rows = []
+            for each in items:
+                each = each.to_dict() if hasattr(each, 'to_dict') else each
+                if transform:
+                    each = transform(slovar(each))
+                if pop_empty:
+                    each = {kk: vv for kk, vv in each.items() if vv not in empty}
+                #pick before flattening, so `a` does not pick a `a_b` key with `_flat_sep=_`
+                if only is not None:
+                    each = {fld: each[fld] for fld in only if fld in each}
+
+                if flat_all:
+                    each = flat_dict(each, sep, keep_lists)
                 else:
-                    fl_keys = self._specials._flat
+                    #like `slovar.flat_keys`, the flattened fields go to the end
+                    each = dict(each)
+                    for key in flat_keys:
+                        if key in each:
+                            each.update(flat_dict({key: each.pop(key)}, sep, keep_lists))
 
-                _d = _d.flat(fl_keys,
-                        keep_lists=self._specials._flat_keep_lists,
-                        sep=self._specials._flat_sep)
+                rows.append(slovar(each))
 
-            return _d
+            return rows
+
+        return process_page
+
+    def serialize(self, obj, many, lazy=False):
+        '''
+        Returns (data, total, meta). With `lazy` the collection items are processed as they
+        are iterated, so the streaming renderers do not hold them all in memory.
+        '''
+        process_dict = self.compile_item_processor()
 
         _total = getattr(obj, 'total', None)
         _meta = getattr(obj, '_meta', None)
 
-        if many and 'data' in obj:
+        if many and isinstance(obj, dict) and 'data' in obj:
             if 'total' in obj:
                 _total = obj['total']
             else:
@@ -279,32 +513,59 @@ class BaseView(object):
             return _d, _total or len(_d), _meta
 
         elif isinstance(obj, list):
-            data = []
-            for each in obj:
+            def process(each):
                 if isinstance(each, dict):
-                    each = process_dict(each)
+                    return process_dict(each)
                 elif hasattr(each, 'to_dict'):
-                    each = process_dict(each.to_dict())
-                data.append(each)
+                    return process_dict(each.to_dict())
+                return each
 
+            if lazy:
+                return map(process, obj), _total or len(obj), _meta
+
+            process_page = self.bulk_projection(obj)
+            if process_page:
+                data = process_page(obj)
+            else:
+                data = [process(each) for each in obj]
             return data, _total or len(data), _meta
 
         else:
             if many:
                 if hasattr(obj, '_total'):
                     _total = obj._total
-                data = [process_dict(each.to_dict()) for each in obj]
+
+                if lazy:
+                    return map(process_dict, self.iter_items(obj)), _total, _meta
+
+                items = list(obj)
+                process_page = self.bulk_projection(items)
+                if process_page:
+                    data = process_page(items)
+                else:
+                    data = [process_dict(each.to_dict()) for each in items]
             else:
                 data = process_dict(obj.to_dict())
 
             return data, _total or len(data), _meta
 
 
+    @staticmethod
+    def iter_items(obj):
+        #items of a cursor or of a generator of pages (eg `ES.paginate`)
+        for each in obj:
+            if isinstance(each, list):
+                for item in each:
+                    yield item.to_dict() if hasattr(item, 'to_dict') else item
+            else:
+                yield each.to_dict() if hasattr(each, 'to_dict') else each
+
     def _process(self, data, many):
         def wrap2dict(data, total, meta=None):
             wrapper = {
                 'total': total,
-                'count': len(data),
+                #unknown for the lazy collections
+                'count': len(data) if isinstance(data, (list, dict)) else None,
                 'query': self._params,
                 '_meta': slovar(),
             }
@@ -323,15 +584,97 @@ class BaseView(object):
         if not data:
             return wrap2dict([], 0)
 
-        serialized, _total, _meta = self.serialize(data, many=many)
+        if many and getattr(self.request, 'override_renderer', None) == 'arrow':
+            from prf.arrow import backend_field_types
+            #column types for the arrow renderer, looked up only when the renderer runs
+            self.request.environ['prf.field_types'] = \
+                lambda: backend_field_types(data, self._model_class)
+
+        serialized, _total, _meta = self.serialize(data, many=many,
+                                                   lazy=many and self.streaming)
         return wrap2dict(self.add_meta(serialized), _total, _meta)
 
 
+    def collection_version(self):
+        '''
+        Version of the data behind the view, used for ETags. None disables them.
+        Uses `_model_class.get_collection_version` when `prf.etag` is on. ES views can return
+        `ES(index).get_collection_version()`.
+        '''
+        if not self.get_settings(self.request).asbool('prf.etag', default=False):
+            return
+
+        get_version = getattr(self._model_class, 'get_collection_version', None)
+        if get_version:
+            return get_version()
+
+    def check_etag(self):
+        if self.request.method not in ['GET', 'HEAD']:
+            return
+
+        version = self.collection_version()
+        if version is None:
+            return
+
+        #the same params render differently depending on the negotiated renderer and Accept
+        etag = hashlib.md5(('%s:%s:%s:%s:%s:%s' % (
+                    self.request.path,
+                    sorted(self._params.flat().items()),
+                    getattr(self.request, 'override_renderer', None),
+                    self.request.headers.get('Accept', ''),
+                    getattr(self.request, 'authenticated_userid', None),
+                    version)).encode('utf-8')).hexdigest()
+
+        if etag in self.request.if_none_match:
+            return prf.exc.HTTPNotModified(headers=[('ETag', '"%s"' % etag), ('Vary', 'Accept')])
+
+        response = self.request.response
+        response.etag = etag
+        if 'Accept' not in (response.vary or ()):
+            response.vary = tuple(response.vary or ()) + ('Accept',)
+
+    def single_flight(self, func):
+        '''
+        Runs `func` once for the concurrent GETs with the same path, normalized params and
+        principals. The others wait up to `prf.single_flight.timeout` seconds for a copy of
+        its result.
+        '''
+        if self.request.method != 'GET':
+            return func()
+
+        settings = self.get_settings(self.request)
+
+        if not self._single_flight:
+            route = getattr(getattr(self.request, 'matched_route', None), 'name', None)
+            if route not in settings.aslist('prf.single_flight.routes', default=[]):
+                return func()
+
+        return _single_flight.do(cache_key(self.request), func,
+                    settings.asfloat('prf.single_flight.timeout', default=SINGLE_FLIGHT_TIMEOUT),
+                    copy=copy.deepcopy)
+
     def _index(self, **kw):
-        return self._process(self.index(**kw), many=True)
+        not_modified = self.check_etag()
+        if not_modified:
+            return not_modified
+
+        if self.streaming:
+            #lazy data can not be shared with the other requests
+            return self._process(self.index(**kw), many=True)
+
+        return self.single_flight(lambda: self._process(self.index(**kw), many=True))
 
     def _show(self, **kw):
-        data = self._process(self.show(**kw), many=self.returns_many)
+        not_modified = self.check_etag()
+        if not_modified:
+            return not_modified
+
+        def show():
+            data = self._process(self.show(**kw), many=self.returns_many)
+            return data, self.returns_many
+
+        #`show` may set `returns_many`, waiters get it from the shared result
+        data, self.returns_many = self.single_flight(show)
         if not data:
             if not self.returns_many:
                 if self.raise_not_found:
@@ -388,6 +731,89 @@ class BaseView(object):
 
         return self.request.invoke_subrequest(req)
 
+    def gather(self, callables, timeout=None):
+        '''
+        Runs independent calls concurrently on the shared pool.
+        `callables` is a dict of name:callable (returns a dict) or a list (returns a list).
+        Each call must finish within `timeout` seconds (`prf.gather.timeout`) of when it starts
+        running, the time it waits for a free worker is not counted. Its time in ms
+        goes to `_meta.gather`, keyed by the dict key or, for lists, by the function name
+        (the position for lambdas and repeated names).
+        The calls see the same `get_current_request`/`get_current_registry` as the view.
+        Nested gathers (e.g. in `_batch` sub-requests) run inline, without `timeout`,
+        so they can not wait on the pool they are running in.
+
+        Example:
+            res = self.gather({
+                'users': lambda: User.get_total(**self._params),
+                'stats': lambda: ES('stats').get_collection(_group='country'),
+            })
+        '''
+
+        if isinstance(callables, dict):
+            names = list(callables.keys())
+            calls = list(callables.values())
+        else:
+            calls = list(callables)
+            names = [getattr(each, '__name__', None) for each in calls]
+            names = [name if name and name != '<lambda>' and names.count(name) == 1 else str(ix)
+                        for ix, name in enumerate(names)]
+
+        if timeout is None:
+            timeout = self.get_settings(self.request).asfloat(
+                                            'prf.gather.timeout', default=GATHER_TIMEOUT)
+
+        if threading.current_thread().name.startswith(GATHER_THREAD_PREFIX):
+            submit = run_inline
+        else:
+            submit = get_gather_pool(self.get_settings(self.request)).submit
+
+        timings = self._specials._meta.setdefault('gather', slovar())
+        threadlocals = manager.get()
+        starts = {}
+        running = {name: threading.Event() for name in names}
+
+        def timed(name, call):
+            #pool threads do not have the request threadlocals
+            manager.push(threadlocals)
+            starts[name] = time.time()
+            running[name].set()
+            try:
+                return call()
+            finally:
+                timings[name] = round((time.time() - starts[name]) * 1000, 2)
+                manager.pop()
+
+        futures = [submit(timed, name, call) for name, call in zip(names, calls)]
+        results = []
+
+        try:
+            for name, future in zip(names, futures):
+                try:
+                    #the timeout starts when the call does, not while it is queued in the pool
+                    running[name].wait()
+                    results.append(future.result(max(0, starts[name] + timeout - time.time())))
+
+                except TimeoutError:
+                    raise prf.exc.HTTPGatewayTimeout(
+                                '`%s` did not finish in %ss' % (name, timeout))
+
+                except HTTPException:
+                    raise
+
+                except Exception as e:
+                    raise prf.exc.HTTPInternalServerError(
+                                '`%s` failed: %s' % (name, e), extra=dict(call=name))
+        finally:
+            #do not let the calls that did not start yet hold the pool
+            for future in futures:
+                future.cancel()
+
+        if isinstance(callables, dict):
+            return slovar(zip(names, results))
+
+        return results
+
     def needs_confirmation(self):
         if self._conf_keyword in self._params:
             self._params.pop(self._conf_keyword)
@@ -411,28 +837,45 @@ class BaseView(object):
         return prf.exc.HTTPOk('Deleted %s %s objects' % (count,
                        self._model_class.__name__))
 
+    def get_self_link_prefix(self):
+        url = urllib.parse.urlparse(self.request.current_route_url())._replace(query='').geturl()
+        id_name = self.resource.id_name
+
+        if self.returns_many == True: # show action returned a collection
+            return id_name, '%s?%s=' % (url, id_name)
+        else:
+            return id_name, '%s/' % url
+
     def add_meta(self, collection):
+        #`_links=0` skips the `self` links
+        if not self._specials.asbool('_links', default=True):
+            return collection
+
         try:
-            for each in collection:
-                try:
-                    url = urllib.parse.urlparse(self.request.current_route_url())._replace(query='')
-                    id_name = self.resource.id_name
-                    val = urllib.parse.quote(str(each[id_name]))
+            #built once, each item only adds its quoted id
+            id_name, prefix = self.get_self_link_prefix()
+        except Exception:
+            return collection
 
-                    if self.returns_many == True: # show action returned a collection
-                        _id = '?%s=%s' % (id_name, val)
-                    else:
-                        _id = '/%s' % val
+        quote = urllib.parse.quote
 
-                    each.setdefault('self', '%s%s' % (url.geturl(), _id))
+        def add_link(each):
+            try:
+                each.setdefault('self', prefix + quote(str(each[id_name])))
+            except (TypeError, KeyError, AttributeError):
+                pass
+            return each
 
-                except TypeError:
-                    pass
-        except (TypeError, KeyError):
-            pass
-        finally:
+        if isinstance(collection, list):
+            for each in collection:
+                add_link(each)
             return collection
 
+        if isinstance(collection, dict):
+            return collection
+
+        return map(add_link, collection)
+
     def get_settings(self, request):
         return Params(request.registry.settings)
 
@@ -40,6 +40,7 @@ setup(
         ],
         'console_scripts':[
             'prf.mongo_index = prf.scripts.mongo_index:run',
+            'prf.es_reindex = prf.scripts.es_reindex:run',
         ]
 
     },